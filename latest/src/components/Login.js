@@ -4,6 +4,7 @@ import axios from 'axios';
 import { LockClosedIcon } from '@heroicons/react/24/solid';
 import toast, { Toaster } from 'react-hot-toast';
 import 'react-toastify/dist/ReactToastify.css';
+import { startSession } from '../session';
 
 const Login = () => {
   const [username, setUsername] = useState('');
@@ -27,9 +28,10 @@ const Login = () => {
         username, 
         password,
       });
-      const { adminId, name } = response.data;
+      const { adminId, name, token } = response.data;
       if (adminId) { 
         localStorage.setItem('adminId', adminId);
+        startSession(token);
         toast.success(`Welcome, ${name}!`);
         setTimeout(() => navigate(`/users/${adminId}`), 1000);
       } else {
@@ -3,6 +3,7 @@ import toast from 'react-hot-toast';
 import { useNavigate } from 'react-router-dom';
 import { Sun, Moon, Bed, Sofa, ChefHat, LampFloor, Mic, MicOff, Loader2, ClipboardList ,FileClock ,LogOut, User } from 'lucide-react';
 import axios from 'axios';
+import { endSession, withSessionToken } from '../session';
 
 // Import images
 import kitchenImage from './kitchen1.png';
@@ -41,6 +42,7 @@ const VirtualHome = () => {
   }, [navigate]);
 
   const handleLogout = () => {
+    endSession();
     localStorage.removeItem('currentUser');
     navigate('/');
   };
@@ -106,6 +108,29 @@ useEffect(() => {
   fetchUserPreferences();
 }, [userId]); // Only trigger when `userId` changes
 
+  // Follow the household's light state, so commands from any tab or device show up here
+  useEffect(() => {
+    const adminId = localStorage.getItem('adminId');
+    if (!adminId) {
+      return;
+    }
+
+    const events = new EventSource(withSessionToken(`http://localhost:5000/light-state/${adminId}/events`));
+    events.addEventListener('state', (event) => {
+      const { rooms } = JSON.parse(event.data);
+      setBulbStates(prev => {
+        const next = { ...prev };
+        Object.entries(rooms).forEach(([room, state]) => {
+          const roomKey = mapAreaToRoom(room);
+          next[roomKey] = { ...prev[roomKey], intensity: state.level };
+        });
+        return next;
+      });
+    });
+
+    return () => events.close();
+  }, []);
+
 useEffect(() => {
   const fetchLogs = async () => {
     try {
@@ -186,6 +211,20 @@ useEffect(() => {
             ...prev,
             [room]: { ...prev[room], intensity: newIntensity }
           }));
+
+          // Share the change with the household's other dashboards
+          const adminId = localStorage.getItem('adminId');
+          const roomName = { bedroom1: 'master', bedroom2: 'guest' }[room] || room;
+          if (adminId) {
+            axios.post(`http://localhost:5000/light-state/${adminId}`, {
+              userId,
+              commands: [{
+                room: roomName,
+                intent: newIntensity === 0 ? 'off' : 'on',
+                intensity: newIntensity === 0 ? null : newIntensity === 1 ? 'low' : 'high',
+              }],
+            }).catch(error => console.error('Error updating light state:', error));
+          }
         }}
         className="w-full h-2 bg-gray-200 rounded-lg appearance-none cursor-pointer"
       />
@@ -239,20 +278,19 @@ useEffect(() => {
       const formData = new FormData();
       formData.append('audioFile', audioBlob, 'recording.wav');
   
-      const axiosInstance = axios.create({
-        baseURL: 'http://localhost:5000',
-        timeout: 120000,
-      });
-  
+      // The global axios sends the session token and logs out on 401; transcriptions get a longer timeout
       const userId = localStorage.getItem('userId');
-      const response = await axiosInstance.post(`/transcribe/${userId}`, formData, {
+      const response = await axios.post(`http://localhost:5000/transcribe/${userId}`, formData, {
         headers: { 'Accept': 'application/json' },
+        timeout: 120000,
         maxBodyLength: Infinity,
         maxContentLength: Infinity,
       });
   
       if (response.data) {
-        handleVoiceCommand(response.data);
+        // One utterance can contain several commands ("kitchen on and hall off")
+        const commands = response.data.commands?.length ? response.data.commands : [response.data];
+        commands.forEach(handleVoiceCommand);
         addLog('Voice command processed successfully');
       }
     } catch (error) {
@@ -1,5 +1,6 @@
 import React, { useState, useEffect, useRef } from 'react';
 import axios from 'axios';
+import { endSession } from '../session';
 import toast from 'react-hot-toast';
 import { useNavigate } from 'react-router-dom';
 import { UserPlus, Edit2, User, Camera ,LogOut } from 'lucide-react';
@@ -93,6 +94,7 @@ const UserProfileSelection = () => {
 
 
   const handleLogout = () => {
+    endSession();
     localStorage.removeItem('currentUser');
     navigate('/');
     toast.success('Logged out successfully');
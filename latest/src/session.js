@@ -0,0 +1,55 @@
+// Session token from /login, sent with every API request (the backend needs it when AUTH_REQUIRED is on)
+import axios from 'axios';
+
+const TOKEN_KEY = 'sessionToken';
+
+export const getSessionToken = () => localStorage.getItem(TOKEN_KEY);
+
+const applyToken = (token) => {
+  if (token) {
+    axios.defaults.headers.common.Authorization = `Bearer ${token}`;
+  } else {
+    delete axios.defaults.headers.common.Authorization;
+  }
+};
+
+export const startSession = (token) => {
+  localStorage.setItem(TOKEN_KEY, token);
+  applyToken(token);
+};
+
+// Ends the session on the server too, so the token stops working before it expires
+export const endSession = async () => {
+  if (getSessionToken()) {
+    try {
+      await axios.post('http://localhost:5000/logout');
+    } catch (error) {
+      console.error('Logout error:', error.response?.data || error.message);
+    }
+  }
+  localStorage.removeItem(TOKEN_KEY);
+  applyToken(null);
+};
+
+// EventSource can't send headers, so event streams take the token as a query parameter
+export const withSessionToken = (url) => {
+  const token = getSessionToken();
+  return token ? `${url}?token=${encodeURIComponent(token)}` : url;
+};
+
+// Restore the session after a page reload. Requests must go through this global axios: instances from
+// axios.create() don't get the interceptor below, and only copy the defaults set before they were created
+applyToken(getSessionToken());
+
+// An expired or ended session sends the user back to the login page
+axios.interceptors.response.use(
+  (response) => response,
+  (error) => {
+    if (error.response?.status === 401 && getSessionToken() && !error.config?.url?.endsWith('/login')) {
+      localStorage.removeItem(TOKEN_KEY);
+      applyToken(null);
+      window.location.assign('/');
+    }
+    return Promise.reject(error);
+  }
+);
@@ -1,31 +1,282 @@
-import hashlib
-import uuid
+import io
+import time
+
+# Measure how long the app takes to become importable (see /stats)
+_import_started = time.monotonic()
 
-from flask import Flask, request, jsonify, json, send_from_directory
-from transformers import pipeline
+import uuid
+import wave
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from flask import Flask, Request, Response, request, jsonify, json, send_from_directory, stream_with_context, url_for, g
+import atexit
+import base64
+import hmac
 import os
 from flask_cors import CORS
 import mysql.connector
 
+import numpy as np
+
+from audio import decode_audio, SAMPLE_RATE
+from asr import (asr_config, TranscriptionScheduler, SchedulerBusy, TranscriptionTimeout, ASRUnavailable,
+                 resident_memory)
+from streaming import stream_config, StreamingSession, StreamSessions
+from keyword_spotter import kws_config, KeywordSpotter
+from command_parser import AREA_TO_ROOM, process_text
+from cache import transcript_cache_config, TranscriptCache, audio_key, profile_cache_config, ProfileCache
+from write_behind import audio_log_config, WriteBehindLog
+from preferences import PreferenceIndex
+from retention import retention_config, RetentionWorker
+from light_state import light_state_config, LightStateStore
+from metrics import metrics
+from provisioning import provisioning_config, Provisioner
+from images import image_config, ImageStore
+from preprocess import preprocess_config, AudioPreprocessor
+from storage import storage_config, create_pool
+from auth import password_config, session_config, PasswordHasher, SessionTokens, InvalidToken
+
+# Audio ingestion configuration (can be overridden through the environment)
+audio_config = {
+    # Keep a copy of every uploaded command under uploads/<user_id>/ (written in the background)
+    'persist': os.environ.get('AUDIO_PERSIST', '1') == '1',
+    'max_upload_mb': int(os.environ.get('MAX_UPLOAD_MB', 25)),
+}
+
+# Route protection (can be overridden through the environment)
+auth_config = {
+    # Only serve household routes to a session token (from /login) of that household
+    'required': os.environ.get('AUTH_REQUIRED', '0') == '1',
+    # Key for the routes that write to any household (see OPERATOR_ENDPOINTS), sent as X-Operator-Key
+    'operator_key': os.environ.get('AUTH_OPERATOR_KEY') or None,
+}
+
+# Batch command configuration (can be overridden through the environment)
+command_batch_config = {
+    # Text and audio commands accepted by one /commands request
+    'max_commands': int(os.environ.get('COMMAND_BATCH_MAX', 50)),
+}
+
+
+class InMemoryRequest(Request):
+    # Keep uploaded files in memory instead of spooling larger ones to temporary files;
+    # MAX_CONTENT_LENGTH bounds how much that can be
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return io.BytesIO()
+
+
 # Initialize the Flask app
 app = Flask(__name__)
+app.request_class = InMemoryRequest
+app.config['MAX_CONTENT_LENGTH'] = audio_config['max_upload_mb'] * 1024 * 1024
+
+# Recordings are written to disk off the request path (stopped by shutdown_audio_storage)
+audio_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='audio-writer')
+
+# Whisper runs in dedicated worker processes behind a batching queue. Nothing is loaded at import time:
+# workers start on the first transcription, or in the background at startup when warmup is enabled
+asr_scheduler = TranscriptionScheduler(**asr_config)
+atexit.register(asr_scheduler.shutdown)
+
+# Fast first stage for short canonical commands; Whisper only runs when it isn't confident
+keyword_spotter = KeywordSpotter(**kws_config)
+
+# Normalises clips and trims their silence before they are queued for Whisper
+audio_preprocessor = AudioPreprocessor(**preprocess_config)
+
+# Transcripts of audio that was already decoded once, keyed by a hash of the samples
+transcript_cache = TranscriptCache(**transcript_cache_config)
+
+# User details and household listings; dropped by the profile write paths
+profile_cache = ProfileCache(**profile_cache_config)
+
+# Every user's room preferences, so commands are resolved without a database query
+preference_index = PreferenceIndex()
+
+# Current light state of every household, pushed to dashboards as it changes
+light_state = LightStateStore(**light_state_config)
+atexit.register(light_state.shutdown)
+
+# Profile images, stored by content hash with thumbnails generated in the background
+image_store = ImageStore(**image_config)
+atexit.register(image_store.shutdown)
+
+# Password hashes, and the session tokens /login hands out and the other routes check
+password_hasher = PasswordHasher(**password_config)
+session_tokens = SessionTokens(**session_config)
 
-# Load the Whisper pipeline (CPU mode: device=-1, GPU: device=0)
-whisper = pipeline('automatic-speech-recognition', model='openai/whisper-medium', device=-1)
+# Latency histograms and counters behind /metrics
+atexit.register(metrics.shutdown)
 
-CORS(app, resources={r"/*": {
+# Utterances currently being streamed to /transcribe-stream
+stream_sessions = StreamSessions(stream_config['session_ttl'])
+
+# Set by the multi-process launcher (see serve.py) to pass changes to the in-memory state above on to
+# the other worker processes; None when this process serves alone
+peer_bus = None
+
+
+def notify_peers(kind, **message):
+    if peer_bus is not None:
+        peer_bus.publish({'kind': kind, **message})
+
+
+def apply_peer_message(message):
+    """Applies a change another worker process made (see notify_peers) to this process' state."""
+    kind = message['kind']
+    if kind == 'invalidate':
+        profile_cache.invalidate(*(tuple(key) for key in message['keys']))
+    elif kind == 'preferences':
+        if message['replace']:
+            preference_index.replace(message['user_id'], message['preferences'])
+        else:
+            preference_index.update(message['user_id'], message['preferences'])
+    elif kind == 'light_state':
+        light_state.receive(message['admin_id'], message['state'])
+    elif kind == 'revoke':
+        session_tokens.revoke(message['jti'], message['exp'])
+
+
+def invalidate_profiles(*keys):
+    profile_cache.invalidate(*keys)
+    notify_peers('invalidate', keys=keys)
+
+
+def store_preferences(user_id, preferences, replace=False):
+    if replace:
+        preference_index.replace(user_id, preferences)
+    else:
+        preference_index.update(user_id, preferences)
+    notify_peers('preferences', user_id=user_id, preferences=preferences, replace=replace)
+
+
+light_state.publish_hook = lambda admin_id, state: notify_peers('light_state', admin_id=admin_id, state=state)
+
+cors_config = {
     "origins": ["http://localhost:3000"],
     "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
-    "allow_headers": ["Content-Type", "Authorization"],
+    "allow_headers": ["Content-Type", "Authorization", metrics.profile_header],
+    "expose_headers": ["ETag", "Link", "X-Next-Cursor", "Server-Timing"],
     "max_age": 3600
-}})
+}
+CORS(app, resources={r"/*": cors_config})
+
+
+@app.before_request
+def start_request_trace():
+    g.request_started = time.perf_counter()
+    g.trace_token = metrics.start_trace()
+
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    Records every request's latency by route, and when the request carries the profile header
+    (see metrics_config), returns its stage breakdown in a Server-Timing header.
+    """
+    if 'trace_token' not in g:
+        return response
+    seconds = time.perf_counter() - g.request_started
+    stages = metrics.end_trace(g.pop('trace_token'))
+    metrics.observe('http_request_seconds', seconds, method=request.method, route=request.endpoint or 'unmatched',
+                    status=response.status_code)
+    if metrics.profile_header in request.headers:
+        response.headers['Server-Timing'] = metrics.server_timing(stages, seconds)
+    return response
+
 
-# Database connection configuration
+# Routes that don't need a session token, even with AUTH_REQUIRED
+PUBLIC_ENDPOINTS = {'login', 'register', 'get_readiness', 'get_stats', 'get_metrics', 'serve_uploaded_file', 'static'}
+
+# Routes whose requests can touch several households, which no household's session token may make
+OPERATOR_ENDPOINTS = {'provision'}
+OPERATOR_KEY_HEADER = 'X-Operator-Key'
+
+
+@app.before_request
+def check_session():
+    """
+    Verifies the request's session token, if it has one, and leaves its claims in g.session. With
+    AUTH_REQUIRED, every route but the public ones needs a token, and one of the household the URL
+    refers to (directly or through one of its users).
+    """
+    g.session = None
+    if request.method == 'OPTIONS':
+        return None
+    header = request.headers.get('Authorization')
+    if not header and request.endpoint == 'stream_light_state' and request.args.get('token'):
+        # EventSource can't send headers, so event streams take the token from the query string
+        header = f"Bearer {request.args['token']}"
+    try:
+        g.session = session_tokens.verify_header(header)
+    except InvalidToken as e:
+        return jsonify({"error": str(e)}), 401
+
+    if request.endpoint in OPERATOR_ENDPOINTS:
+        error = operator_error(request.headers.get(OPERATOR_KEY_HEADER), g.session)
+        return (jsonify(error[0]), error[1]) if error else None
+    if not auth_config['required'] or request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    try:
+        error = authorization_error(g.session, request_household(request.view_args or {}))
+    except mysql.connector.Error as err:
+        print(f"Could not check access: {err}")
+        return jsonify({"error": "Could not check access, please retry"}), 503
+    if error:
+        return jsonify(error[0]), error[1]
+    return None
+
+
+def request_household(view_args):
+    # The household a route's URL refers to, or None when it refers to none (or to a user that doesn't exist)
+    if 'admin_id' in view_args:
+        return view_args['admin_id']
+    user_id = view_args.get('user_id')
+    try:
+        uuid.UUID(user_id)
+    except (TypeError, ValueError):
+        return None
+    user, _ = profile_cache.get_or_load(('user', user_id), lambda: load_user_details(user_id))
+    return user['adminId'] if user else None
+
+
+def operator_error(key, claims):
+    """
+    Returns the (payload, status) refusing a request to an operator route made with operator `key`
+    and session `claims`, or None when it may go ahead. Operator routes need the operator key once
+    AUTH_REQUIRED is on or a key is configured; a household's session token is never enough.
+    """
+    expected = auth_config['operator_key']
+    if not auth_config['required'] and expected is None:
+        return None
+    if key is not None and expected is not None and hmac.compare_digest(key.encode(), expected.encode()):
+        return None
+    if key is None and claims is None:
+        return {"error": "Authentication required"}, 401
+    return {"error": "Only the operator key may provision households"}, 403
+
+
+def authorization_error(claims, admin_id):
+    """
+    Returns the (payload, status) refusing a request for household `admin_id` (None for routes not
+    tied to one) made with session `claims`, or None when the request may go ahead.
+    """
+    if claims is None:
+        return {"error": "Authentication required"}, 401
+    if admin_id is not None and admin_id != claims['sub']:
+        return {"error": "Not allowed for this household"}, 403
+    return None
+
+
+# MySQL connection configuration, used with DB_BACKEND=mysql (can be overridden through the environment)
 db_config = {
-    'user': 'root',
-    'password': 'Dharm-aduty8',
-    'host': 'localhost',
-    'database': 'voice_control_system',
+    'user': os.environ.get('DB_USER', 'root'),
+    'password': os.environ.get('DB_PASSWORD', ''),
+    'host': os.environ.get('DB_HOST', 'localhost'),
+    'port': int(os.environ.get('DB_PORT', 3306)),
+    'database': os.environ.get('DB_NAME', 'voice_control_system'),
     'ssl_disabled': True,
     'time_zone': '+00:00',
 }
@@ -53,6 +304,7 @@ CREATE TABLE user_preferences (
     room ENUM('kitchen', 'master', 'guest', 'hall') NOT NULL,
     intent TINYINT(1) NOT NULL DEFAULT 0,
     intensity TINYINT(1) NOT NULL DEFAULT 0,
+    UNIQUE KEY uq_user_room (userId, room),
     FOREIGN KEY (userId) REFERENCES users(userId) ON DELETE CASCADE
 );
 
@@ -61,72 +313,199 @@ CREATE TABLE audio_files (
     user_id VARCHAR(36) NOT NULL, -- UUID for the user ID
     file_path VARCHAR(255) NOT NULL,
     transcribed_text TEXT,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    KEY idx_audio_files_user_created (user_id, created_at)
+);
+
+CREATE TABLE audio_files_archive (
+    id VARCHAR(36) PRIMARY KEY,
+    user_id VARCHAR(36) NOT NULL,
+    file_path VARCHAR(255) NOT NULL,
+    transcribed_text TEXT,
+    created_at TIMESTAMP NOT NULL,
+    KEY idx_audio_files_archive_user_created (user_id, created_at)
+);
+
+CREATE TABLE retention_policies (
+    adminId VARCHAR(36) PRIMARY KEY,
+    compress_after_days INT, -- NULL columns fall back to the RETENTION_* defaults, 0 disables the step
+    archive_after_days INT,
+    delete_after_days INT,
+    quota_mb INT,
+    FOREIGN KEY (adminId) REFERENCES admin(adminId) ON DELETE CASCADE
 );
 '''
 # Directory for storing audio files
 AUDIO_DIR = os.path.join(os.getcwd(), 'backend/audio_files')
 os.makedirs(AUDIO_DIR, exist_ok=True)  # Ensure the directory exists
 
-# Helper function to establish database connection
+# Connection pool configuration (sizes and timeouts can be overridden through the environment)
+pool_config = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+    'checkout_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+    'health_check_interval': float(os.environ.get('DB_POOL_HEALTH_CHECK', 30)),
+    'recycle': float(os.environ.get('DB_POOL_RECYCLE', 3600)),
+}
+
+
+# MySQL, or the embedded SQLite database (see storage.py)
+db_pool = create_pool(db_config, pool_config, **storage_config)
+
+# Helper function to check a connection out of the pool; it is returned when the block exits
+@contextmanager
 def get_db_connection():
     try:
-        connection = mysql.connector.connect(**db_config)
-        return connection
-    except mysql.connector.Error as err:
-        print("Database connection error:", err)
+        connection = db_pool.acquire()
+    except mysql.connector.Error:
+        metrics.increment('db_errors_total', operation='connect')
         raise
-
-# Helper function to execute a query
-def execute_query(query, params=None, fetch_one=False):
-    connection = get_db_connection()
-    cursor = connection.cursor(dictionary=True)
     try:
-        cursor.execute(query, params or ())
-        if fetch_one:
-            return cursor.fetchone()
-        return cursor.fetchall()
-    except mysql.connector.Error as err:
-        print("Query execution error:", err)
+        yield connection
+    except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+        # The connection itself is broken, don't put it back in the pool
+        db_pool.release(connection, discard=True)
+        connection = None
         raise
     finally:
-        cursor.close()
-        connection.close()
+        if connection is not None:
+            db_pool.release(connection)
+
+# Helper function to execute a query
+def execute_query(query, params=None, fetch_one=False):
+    with metrics.stage('db', 'db_query_seconds', operation='query'), get_db_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute(query, params or ())
+            if fetch_one:
+                result = cursor.fetchone()
+                cursor.fetchall()  # Drain remaining rows so the connection can be reused
+                return result
+            return cursor.fetchall()
+        except mysql.connector.Error as err:
+            print("Query execution error:", err)
+            metrics.increment('db_errors_total', operation='query')
+            raise
+        finally:
+            cursor.close()
 
 # Helper function to execute an insert/update/delete operation
 def execute_commit(query, params=None):
-    connection = get_db_connection()
-    cursor = connection.cursor()
-    try:
-        cursor.execute(query, params or ())
-        connection.commit()
-        return cursor.lastrowid
-    except mysql.connector.Error as err:
-        print("Query execution error:", err)
-        raise
-    finally:
-        cursor.close()
-        connection.close()
+    with metrics.stage('db', 'db_query_seconds', operation='commit'), get_db_connection() as connection:
+        cursor = connection.cursor()
+        try:
+            cursor.execute(query, params or ())
+            connection.commit()
+            return cursor.lastrowid
+        except mysql.connector.Error as err:
+            print("Query execution error:", err)
+            metrics.increment('db_errors_total', operation='commit')
+            raise
+        finally:
+            cursor.close()
+
+# Helper function to run several statements as one transaction on a single pooled connection
+@contextmanager
+def transaction():
+    with metrics.stage('db', 'db_query_seconds', operation='transaction'), get_db_connection() as connection:
+        cursor = connection.cursor(dictionary=True)
+        try:
+            connection.start_transaction()
+            yield cursor
+            connection.commit()
+        except Exception as err:
+            print("Transaction rolled back:", err)
+            metrics.increment('db_errors_total', operation='transaction')
+            try:
+                connection.rollback()
+            except mysql.connector.Error:
+                pass
+            raise
+        finally:
+            cursor.close()
+
+# Helper function to insert a batch of `audio_files` rows with one multi-row statement
+def insert_audio_file_rows(rows):
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+    insert_query = f"""
+        INSERT INTO audio_files (id, user_id, file_path, transcribed_text, created_at)
+        VALUES {placeholders}
+        ON DUPLICATE KEY UPDATE id = id
+    """
+    params = [value for row in rows for value in row]
+    with transaction() as cursor:
+        cursor.execute(insert_query, params)
+
+
+# Conversation log rows are written behind the response, in batches
+audio_log = WriteBehindLog('audio_files', insert_audio_file_rows, **audio_log_config)
+
+
+def shutdown_audio_storage():
+    # Recordings still being saved append their rows to the log, so the writer has to finish first
+    audio_writer.shutdown(wait=True)
+    audio_log.shutdown()
+
+
+atexit.register(shutdown_audio_storage)
+
+
+# Helper function to record a transcribed command in `audio_files` without waiting for the database
+def log_audio_file(file_id, user_id, file_path, transcribed_text):
+    created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+    audio_log.append([file_id, user_id, file_path, transcribed_text, created_at])
+
+
+# Old recordings and conversation rows are compressed, archived and deleted in the background
+retention_worker = RetentionWorker(execute_query, transaction, **retention_config)
+atexit.register(retention_worker.shutdown)
 
-def map_area_to_room(area):
-    area_map = {
-        'kitchen': 'kitchen',
-        'living': 'hall',
-        'bedroom1': 'master',
-        'bedroom2': 'guest'
-    }
 
+# Helper function to insert or update a user's room preferences in a single round-trip
+def upsert_preferences(cursor, user_id, preferences):
+    if not preferences:
+        return
+    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(preferences))
+    params = []
+    for pref in preferences:
+        params.extend((str(uuid.uuid4()), user_id, pref['room'], pref['intent'], pref['intensity']))
+    upsert_query = f"""
+        INSERT INTO user_preferences (preferenceId, userId, room, intent, intensity)
+        VALUES {placeholders}
+        ON DUPLICATE KEY UPDATE intent = VALUES(intent), intensity = VALUES(intensity)
+    """
+    cursor.execute(upsert_query, params)
+
+# Helper function to answer a GET with a cached payload, or 304 when the client already has it
+def conditional_response(payload, etag):
+    response = jsonify(payload)
+    response.set_etag(etag)
+    # Let browsers keep the body but revalidate it on every poll
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+def map_area_to_room(area):
     # If the area is a dictionary, extract the room
     if isinstance(area, dict):
         room = area.get('room', '')
-        return area_map.get(room, room)
+        return AREA_TO_ROOM.get(room, room)
 
     # For string inputs, use the mapping
-    return area_map.get(area, area)
+    return AREA_TO_ROOM.get(area, area)
 
 @app.route('/uploads/images/<path:filename>')
 def serve_uploaded_file(filename):
-    return send_from_directory('uploads/images', filename)
+    """
+    Serves profile images and their variants, with conditional and Range request support. Images
+    stored by content hash never change, so browsers may keep them for a year without revalidating.
+    """
+    served, immutable = image_store.locate(filename)
+    if not immutable:
+        # Revalidated on every use (with the ETag), since the file behind the name can change
+        return send_from_directory(image_store.directory, served)
+    response = send_from_directory(image_store.directory, served, max_age=31536000)
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/register', methods=['POST'])
@@ -144,7 +523,6 @@ def register():
         for pref in preferences
     ]
 
-    print(mapped_preferences)
     # Validate input fields
     if not all([name, username, password]):
         return jsonify({"error": "All fields are required"}), 400
@@ -152,18 +530,20 @@ def register():
     try:
         # Generate a unique admin ID (UUID) and hash the password
         admin_id = str(uuid.uuid4())
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
+        hashed_password = password_hasher.hash(password)
 
-        # Insert into admin table
+        # Insert the admin and its owner profile in one transaction
         insert_admin_query = """
             INSERT INTO admin (adminId, name, username, password, houseAddress)
             VALUES (%s, %s, %s, %s, %s)
         """
-        execute_commit(insert_admin_query, (admin_id, name, username, hashed_password, house_address))
+        with transaction() as cursor:
+            cursor.execute(insert_admin_query, (admin_id, name, username, hashed_password, house_address))
 
-        role = 'owner'  # Default role is 'admin'
-        # Add user with preferences
-        add_user_with_preferences(name, admin_id, role, mapped_preferences, None)
+            role = 'owner'  # Default role is 'admin'
+            # Add user with preferences
+            user_id = add_user_with_preferences(name, admin_id, role, mapped_preferences, None, cursor=cursor)
+        store_preferences(user_id, mapped_preferences)
 
         return jsonify({"message": "Admin registered successfully", "adminId": admin_id, "name": name}), 201
 
@@ -181,30 +561,56 @@ def login():
         return jsonify({"error": "Username and password are required"}), 400
 
     try:
-        # Hash the input password for comparison
-        hashed_password = hashlib.sha256(password.encode()).hexdigest()
-
         # Fetch the admin details for the given username
-        select_query = """
-            SELECT adminId, name, password FROM admin WHERE username = %s
-        """
-        result = execute_query(select_query, (username,), fetch_one=True)
-
-        if result:
-            # Compare the hashed password
-            if result['password'] == hashed_password:
-                return jsonify({
-                    "adminId": result['adminId'],
-                    "name": result['name']
-                }), 200
-            else:
-                return jsonify({"error": "Invalid username or password"}), 401
-        else:
-            return jsonify({"error": "Invalid username or password"}), 401
+        result = execute_query(LOGIN_QUERY, (username,), fetch_one=True)
+        payload, status = login_result(result, password)
+        return jsonify(payload), status
 
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
+
+LOGIN_QUERY = """
+    SELECT adminId, name, password FROM admin WHERE username = %s
+"""
+
+
+def login_result(result, password):
+    """
+    Checks `password` against the admin row fetched with LOGIN_QUERY (or None when the username
+    doesn't exist) and returns the (payload, status) of the /login response, which carries the
+    session token for the other routes. A hash in an outdated format is replaced on the way.
+    """
+    # An unknown username costs a full hash as well, so response times don't tell which usernames exist
+    matches, outdated = password_hasher.verify(password, result['password'] if result else None)
+    if not matches:
+        return {"error": "Invalid username or password"}, 401
+    if outdated:
+        upgrade_password_hash(result['adminId'], result['password'], password)
+    token, claims = session_tokens.issue(result['adminId'])
+    return {"adminId": result['adminId'], "name": result['name'], "token": token, "expiresAt": claims['exp']}, 200
+
+
+def upgrade_password_hash(admin_id, old_hash, password):
+    # Only replaces the hash that was just checked, in case the password changed meanwhile
+    try:
+        execute_commit("UPDATE admin SET password = %s WHERE adminId = %s AND password = %s",
+                       (password_hasher.hash(password), admin_id, old_hash))
+    except mysql.connector.Error as err:
+        print(f"Could not upgrade the password hash of admin {admin_id}: {err}")
+
+
+@app.route('/logout', methods=['POST'])
+def logout():
+    """
+    Endpoint ending the session of the request's token before it expires, on every worker process.
+    """
+    if g.session is None:
+        return jsonify({"error": "Authentication required"}), 401
+    session_tokens.revoke(g.session['jti'], g.session['exp'])
+    notify_peers('revoke', jti=g.session['jti'], exp=g.session['exp'])
+    return jsonify({"message": "Logged out"}), 200
+
 @app.route('/add-profile/<admin_id>', methods=['POST'])
 def add_profile(admin_id):
     # Validate inputs
@@ -233,18 +639,18 @@ def add_profile(admin_id):
 
 
     if image:
-        # Save the image locally
-        image_dir = "uploads\images"
-        os.makedirs(image_dir, exist_ok=True)
-        image_path = os.path.join(image_dir, image.filename)
-        image.save(image_path)
+        # Save the image by content hash, its thumbnails are generated in the background
+        try:
+            with metrics.stage('image_save'):
+                image_path = image_store.save(image.read())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
     try:
-        # Generate a unique user ID
-        user_id = str(uuid.uuid4())
-
         # Add user with preferences
-        add_user_with_preferences(name, admin_id, role, preferences, image_path)
+        user_id = add_user_with_preferences(name, admin_id, role, preferences, image_path)
+        invalidate_profiles(('household', admin_id))
+        store_preferences(user_id, preferences)
 
         # Return the inserted user's details
         return jsonify({
@@ -256,22 +662,31 @@ def add_profile(admin_id):
             "role": role,
             "preferences": preferences or [],
             "imagePath": image_path,
+            "imageVariants": image_store.variants(image_path),
         }), 201
 
     except mysql.connector.Error as err:
         return jsonify({"error": str(err)}), 500
 
 
-def add_user_with_preferences(name, admin_id, role, preferences, image_path):
+def add_user_with_preferences(name, admin_id, role, preferences, image_path, cursor=None):
     """
     Adds a new user to the `users` table and their preferences to the `user_preferences` table,
-    including intensity for preferences.
+    including intensity for preferences. The user row and all preferences are written in a single
+    transaction; pass `cursor` to join a transaction that is already open.
 
     :param name: Name of the user.
     :param admin_id: Admin ID to associate the user with.
     :param role: Role of the user (e.g., 'owner', 'resident').
     :param preferences: List of preferences, each containing a 'room', 'intent', and 'intensity'.
+    :param image_path: Path of the user's profile image, or None.
+    :param cursor: Optional cursor of an open transaction.
+    :return: The generated userId.
     """
+    if cursor is None:
+        with transaction() as cursor:
+            return add_user_with_preferences(name, admin_id, role, preferences, image_path, cursor=cursor)
+
     try:
         # Generate a unique user ID
         user_id = str(uuid.uuid4())
@@ -281,19 +696,12 @@ def add_user_with_preferences(name, admin_id, role, preferences, image_path):
               VALUES (%s, %s, %s, %s, %s)
           """
 
-        execute_commit(insert_user_query, (user_id, name, admin_id, role, image_path ))
-        print(f"User {name} added with userId: {user_id}")
+        cursor.execute(insert_user_query, (user_id, name, admin_id, role, image_path))
 
-        # Insert user preferences into the `user_preferences` table
-        if preferences:
-            for pref in preferences:
-                preference_id = str(uuid.uuid4())
-                insert_preference_query = """
-                    INSERT INTO user_preferences (preferenceId, userId, room, intent, intensity)
-                    VALUES (%s, %s, %s, %s, %s)
-                """
-                execute_commit(insert_preference_query, (preference_id, user_id, pref['room'], pref['intent'], pref['intensity']))
-                print(f"Preference added for room {pref['room']} with intent {pref['intent']} and intensity {pref['intensity']}")
+        # Insert all user preferences into the `user_preferences` table at once
+        upsert_preferences(cursor, user_id, preferences)
+        print(f"User {name} added with userId: {user_id} and {len(preferences or [])} preferences")
+        return user_id
 
     except mysql.connector.Error as err:
         print(f"Database error: {err}")
@@ -309,7 +717,6 @@ def edit_profile(user_id):
        :return: JSON response with the updated user details or an error message.
        """
 
-    print(user_id)
     # Validate inputs
     uuid.UUID(user_id)
 
@@ -323,91 +730,88 @@ def edit_profile(user_id):
     if not name:
         return jsonify({"error": "Name is required"}), 400
 
-    try:
-        # Save image if provided
-        image_path = None
-        if image:
-            image_dir = "uploads\images"
-            os.makedirs(image_dir, exist_ok=True)
-            image_path = os.path.join(image_dir, image.filename)
-            image.save(image_path)
+    # Save image if provided
+    image_path = None
+    if image:
+        try:
+            with metrics.stage('image_save'):
+                image_path = image_store.save(image.read())
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        # Connect to the database
-        connection = mysql.connector.connect(**db_config)
-        cursor = connection.cursor(dictionary=True)
+    try:
+        with transaction() as cursor:
+            # Check if the user exists in the users table (and lock the row for this update)
+            check_user_query = "SELECT * FROM users WHERE userId = %s FOR UPDATE"
+            cursor.execute(check_user_query, (user_id,))
+            user = cursor.fetchone()
+
+            if not user:
+                return jsonify({"error": "User not found"}), 404
+
+            # Update user's details
+            if image_path:
+                # If new image is uploaded, update both name and image path
+                update_query = "UPDATE users SET name = %s, imagePath = %s WHERE userId = %s"
+                cursor.execute(update_query, (name, image_path, user_id))
+            else:
+                # If no new image, only update name
+                update_query = "UPDATE users SET name = %s WHERE userId = %s"
+                cursor.execute(update_query, (name, user_id))
 
-        # Update user's details
-        if image_path:
-            # If new image is uploaded, update both name and image path
-            update_query = "UPDATE users SET name = %s, imagePath = %s WHERE userId = %s"
-            execute_commit(update_query, (name, image_path, user_id))
-        else:
-            # If no new image, only update name
-            update_query = "UPDATE users SET name = %s WHERE userId = %s"
-            execute_commit(update_query, (name, user_id))
-
-        # Update preferences if provided
-        if preferences:
-            for pref in preferences:
-                # Check if preference exists for the user and room
-                check_preference_query = """
-                       SELECT * FROM user_preferences 
-                       WHERE userId = %s AND room = %s
-                   """
-                cursor.execute(check_preference_query, (user_id, pref['room']))
-                existing_preference = cursor.fetchone()
-
-                if existing_preference:
-                    # Update existing preference
-                    update_preference_query = """
-                           UPDATE user_preferences 
-                           SET intent = %s, intensity = %s 
-                           WHERE userId = %s AND room = %s
-                       """
-                    execute_commit(update_preference_query,
-                                   (pref['intent'], pref['intensity'], user_id, pref['room']))
-                else:
-                    # Insert new preference if it doesn't exist
-                    insert_preference_query = """
-                           INSERT INTO user_preferences (preferenceId, userId, room, intent, intensity)
-                           VALUES (%s, %s, %s, %s, %s)
-                       """
-                    preference_id = str(uuid.uuid4())
-                    execute_commit(insert_preference_query,
-                                   (preference_id, user_id, pref['room'], pref['intent'], pref['intensity']))
-
-        # Check if the user exists in the users table
-        check_user_query = "SELECT * FROM users WHERE userId = %s"
-        cursor.execute(check_user_query, (user_id,))
-        user = cursor.fetchone()
+            # Insert or update preferences keyed on (userId, room)
+            upsert_preferences(cursor, user_id, preferences)
 
-        if user:
             # Fetch updated preferences
             preferences_query = "SELECT room, intent, intensity FROM user_preferences WHERE userId = %s"
             cursor.execute(preferences_query, (user_id,))
             updated_preferences = cursor.fetchall()
 
-            response = {
-                "message": "User updated successfully",
-                "userId": user['userId'],
-                "name": user['name'],
-                "adminId": user['adminId'],
-                "role": user['role'],
-                "preferences": updated_preferences,
-                "imagePath": image_path if image_path else user.get('imagePath')  # Preserve old image if no new image
-            }
-            return jsonify(response), 200
-        else:
-            return jsonify({"error": "User not found"}), 404
+        invalidate_profiles(('user', user_id), ('household', user['adminId']))
+        store_preferences(user_id, updated_preferences, replace=True)
+
+        response = {
+            "message": "User updated successfully",
+            "userId": user['userId'],
+            "name": name,
+            "adminId": user['adminId'],
+            "role": user['role'],
+            "preferences": updated_preferences,
+            "imagePath": image_path if image_path else user.get('imagePath'),  # Preserve old image if no new image
+            "imageVariants": image_store.variants(image_path or user.get('imagePath')),
+        }
+        return jsonify(response), 200
 
     except mysql.connector.Error as err:
         print(f"Database error: {err}")
         return jsonify({"error": "An error occurred while updating the profile"}), 500
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+
+
+# Bulk onboarding, written in batches of multi-row inserts
+provisioner = Provisioner(transaction, password_hasher.hash, **provisioning_config)
+
+
+@app.route('/provision', methods=['POST'])
+def provision():
+    """
+    Endpoint for onboarding many households at once. The body is newline-delimited JSON with one
+    household, resident or preferences record per line (see Provisioner) and may be streamed with
+    chunked transfer encoding. Every line is accepted or rejected on its own; the response lists
+    the ids created for each accepted line and the error of each rejected one.
+    """
+    summary = provisioner.run(request.stream, provisioned)
+    if summary['aborted']:
+        return jsonify(summary), 503
+    return jsonify(summary), 200
+
+
+def provisioned(admin_ids, users):
+    # Called after every committed batch, like the single-profile write paths
+    invalidate_profiles(*(('household', admin_id) for admin_id in admin_ids),
+                        *(('user', user_id) for user_id, _ in users))
+    for user_id, preferences in users:
+        store_preferences(user_id, preferences)
+
 
 @app.route('/users/<admin_id>', methods=['GET'])
 def get_users_by_admin(admin_id):
@@ -415,39 +819,33 @@ def get_users_by_admin(admin_id):
         # Validate admin_id format
         uuid.UUID(admin_id)
 
-        # Connect to the database
-        connection = mysql.connector.connect(**db_config)
-        cursor = connection.cursor(dictionary=True)
-
-        # Query to fetch users by adminId
-        select_query = """
-            SELECT *
-            FROM users 
-            WHERE adminId = %s
-            ORDER BY 
-                CASE WHEN role = 'owner' THEN 0 ELSE 1 END, 
-                name ASC
-        """
-        cursor.execute(select_query, (admin_id,))
-        results = cursor.fetchall()
+        results, etag = profile_cache.get_or_load(
+            ('household', admin_id),
+            lambda: execute_query(USERS_BY_ADMIN_QUERY, (admin_id,)) or None,
+        )
 
         # If no results are found, return an appropriate message
         if not results:
             return jsonify({"message": "No users found for this admin ID."}), 404
 
         # Return the results as JSON
-        return jsonify(results), 200
+        return conditional_response(results, etag)
 
     except ValueError:
         return jsonify({"error": "Invalid admin ID format"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        # Close the database connection
-        if 'cursor' in locals():
-            cursor.close()
-        if 'connection' in locals():
-            connection.close()
+
+
+# Query to fetch users by adminId
+USERS_BY_ADMIN_QUERY = """
+    SELECT *
+    FROM users 
+    WHERE adminId = %s
+    ORDER BY 
+        CASE WHEN role = 'owner' THEN 0 ELSE 1 END, 
+        name ASC
+"""
 
 
 @app.route('/user-details/<user_id>', methods=['GET'])
@@ -461,49 +859,154 @@ def get_user_details(user_id):
     except ValueError:
         return jsonify({"error": "Invalid userId format"}), 400
 
-    connection = None
-    cursor = None
-
     try:
-        # Connect to the database
-        connection = mysql.connector.connect(**db_config)
-        cursor = connection.cursor(dictionary=True)
+        response, etag = profile_cache.get_or_load(('user', user_id), lambda: load_user_details(user_id))
 
-        # Fetch user details
-        user_query = "SELECT userId, name, role, adminId, imagePath FROM users WHERE userId = %s"
-        cursor.execute(user_query, (user_id,))
-        user = cursor.fetchone()
-
-        if not user:
+        if not response:
             return jsonify({"error": "User not found"}), 404
 
-        # Fetch user preferences
-        preferences_query = "SELECT room, intent, intensity FROM user_preferences WHERE userId = %s"
-        cursor.execute(preferences_query, (user_id,))
-        preferences = cursor.fetchall()
-
-        # Construct response
-        response = {
-            "userId": user['userId'],
-            "name": user['name'],
-            "role": user['role'],
-            "adminId": user['adminId'],
-            "imagePath": user['imagePath'],
-            "preferences": preferences or []  # Default to empty list if no preferences
-        }
-
-        return jsonify(response), 200
+        return conditional_response(response, etag)
 
     except mysql.connector.Error as err:
         print(f"Database error: {err}")
         return jsonify({"error": "An error occurred while fetching user details"}), 500
 
-    finally:
-        # Ensure cursors and connections are closed even if an error occurs
-        if cursor:
-            cursor.close()
-        if connection:
-            connection.close()
+
+def load_user_details(user_id):
+    """
+    Reads a user's record and preferences from the database, or returns None if the user doesn't exist.
+    """
+    # Fetch user details
+    user = execute_query(USER_QUERY, (user_id,), fetch_one=True)
+
+    if not user:
+        return None
+
+    # Fetch user preferences
+    preferences = execute_query(USER_PREFERENCES_QUERY, (user_id,))
+    return user_details(user, preferences)
+
+
+USER_QUERY = "SELECT userId, name, role, adminId, imagePath FROM users WHERE userId = %s"
+USER_PREFERENCES_QUERY = "SELECT room, intent, intensity FROM user_preferences WHERE userId = %s"
+
+
+def user_details(user, preferences):
+    # Construct response
+    return {
+        "userId": user['userId'],
+        "name": user['name'],
+        "role": user['role'],
+        "adminId": user['adminId'],
+        "imagePath": user['imagePath'],
+        "imageVariants": image_store.variants(user['imagePath']),
+        "preferences": preferences or []  # Default to empty list if no preferences
+    }
+
+
+@app.route('/light-state/<admin_id>', methods=['GET'])
+def get_light_state(admin_id):
+    """
+    Endpoint returning the household's current light state: on/off, intensity and dashboard level
+    (0 off, 1 warm, 2 bright) for every room, with a version that increases on every change.
+    """
+    try:
+        uuid.UUID(admin_id)
+    except ValueError:
+        return jsonify({"error": "Invalid admin ID format"}), 400
+    return jsonify(light_state.get(admin_id) or light_state.initial_state()), 200
+
+
+@app.route('/light-state/<admin_id>', methods=['POST'])
+def set_light_state(admin_id):
+    """
+    Endpoint for changes made on a dashboard (e.g. a brightness slider). Accepts
+    {"commands": [{"room", "intent", "intensity"}, ...]} and returns the new state.
+    """
+    try:
+        uuid.UUID(admin_id)
+    except ValueError:
+        return jsonify({"error": "Invalid admin ID format"}), 400
+
+    data = request.get_json(silent=True) or {}
+    commands = data.get('commands')
+    if not isinstance(commands, list):
+        return jsonify({"error": "A list of commands is required"}), 400
+    for command in commands:
+        if not isinstance(command, dict) or command.get('room') not in AREA_TO_ROOM.values():
+            return jsonify({"error": f"Invalid room in command: {command}"}), 400
+        if command.get('intent') not in ('on', 'off'):
+            return jsonify({"error": f"Invalid intent in command: {command}"}), 400
+        if command.get('intensity') not in (None, 'low', 'high'):
+            return jsonify({"error": f"Invalid intensity in command: {command}"}), 400
+
+    state = light_state.apply(admin_id, commands, data.get('userId'))
+    return jsonify(state or light_state.initial_state()), 200
+
+
+@app.route('/light-state/<admin_id>/events', methods=['GET'])
+def stream_light_state(admin_id):
+    """
+    Server-Sent Events stream of the household's light state: the current state on connect (once
+    there is one) and then every change as it happens.
+    """
+    try:
+        uuid.UUID(admin_id)
+    except ValueError:
+        return jsonify({"error": "Invalid admin ID format"}), 400
+    return Response(stream_with_context(light_state.events(admin_id)), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',  # Don't let a reverse proxy hold events back
+    })
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """
+    Endpoint exposing runtime statistics, e.g. connection pool usage and checkout wait times
+    or transcription queue depth and batch sizes.
+    """
+    return jsonify(collect_stats()), 200
+
+
+def collect_stats():
+    return {
+        "startup_seconds": startup_seconds,
+        "memory_bytes": resident_memory(),
+        "db_pool": db_pool.stats(),
+        "asr": asr_scheduler.stats(),
+        "streaming": stream_sessions.stats(),
+        "keyword_spotter": keyword_spotter.stats(),
+        "transcript_cache": transcript_cache.stats(),
+        "profile_cache": profile_cache.stats(),
+        "preference_index": preference_index.stats(),
+        "retention": retention_worker.stats(),
+        "light_state": light_state.stats(),
+        "audio_log": audio_log.stats(),
+        "provisioning": provisioner.stats(),
+        "images": image_store.stats(),
+        "preprocess": audio_preprocessor.stats(),
+        "passwords": password_hasher.stats(),
+        "sessions": session_tokens.stats(),
+    }
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Endpoint for Prometheus: request, stage, database and transcription latency histograms, plus
+    the numbers from /stats as gauges.
+    """
+    return Response(metrics.render(collect_stats()), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/ready', methods=['GET'])
+def get_readiness():
+    """
+    Readiness probe: returns 200 once the speech recognition model is loaded, 503 until then.
+    """
+    ready = asr_scheduler.is_ready()
+    return jsonify({"ready": ready, "model": asr_scheduler.model}), 200 if ready else 503
 
 
 # Define the route for transcription
@@ -516,163 +1019,499 @@ def transcribe_audio(user_id):
         return jsonify({"error": "Invalid user ID format"}), 400
 
     # Check for audio file in the request
-    if 'audioFile' not in request.files:
+    with metrics.stage('upload'):
+        files = request.files
+    if 'audioFile' not in files:
         return jsonify({"error": "No audio file provided"}), 400
 
     # Get the audio file from the request
-    audio_file = request.files['audioFile']
+    audio_file = files['audioFile']
     if audio_file.filename == '':
         return jsonify({"error": "Audio file name is empty"}), 400
 
-    # Save the audio file to a local folder
-    audio_folder = os.path.join("uploads", user_id)
-    os.makedirs(audio_folder, exist_ok=True)
-    audio_path = os.path.join(audio_folder, audio_file.filename)
-    audio_file.save(audio_path)
+    # Decode straight from the request into 16 kHz samples; every recognition stage works on them
+    audio_bytes = audio_file.read()
+    try:
+        with metrics.stage('decode'):
+            samples = decode_audio(audio_bytes)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Generate a unique ID for this audio file and keep a copy of the recording in the background
+    file_id = str(uuid.uuid4())
+    extension = os.path.splitext(audio_file.filename)[1].lower()
+    audio_path = save_audio_async(user_id, f"{file_id}{extension if extension[1:].isalnum() else ''}", audio_bytes)
 
     try:
-        # Perform speech-to-text recognition
-        result = whisper(audio_path)
-        transcribed_text = result['text']
+        transcribed_text, processed_result = recognize_command(user_id, samples)
         print("Transcribed Text: ", transcribed_text)
+        with metrics.stage('light_state'):
+            update_light_state(user_id, processed_result)
 
-        # Process the transcribed text
+        # Log the audio file location; the row is written to the database in the background
+        log_audio_file(file_id, user_id, audio_path, transcribed_text)
 
-        processed_result = process_text(transcribed_text)
+        # Return the processed result
+        return jsonify(processed_result), 200
+
+    except SchedulerBusy as e:
+        response = jsonify({"error": "Too many transcriptions in progress, please retry"})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    except TranscriptionTimeout as e:
+        return jsonify({"error": str(e)}), 504
+    except ASRUnavailable as e:
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route('/commands/<user_id>', methods=['POST'])
+def run_commands(user_id):
+    """
+    Endpoint for running several commands in one request, e.g. replaying a scene. Accepts JSON
+    {"commands": ["turn off the kitchen lights", ...]}, or multipart form data with any number of
+    `text` fields and `audioFile` recordings. Recordings go through the same stages as /transcribe,
+    and the ones that need Whisper are transcribed as one batch. Everything recognised is applied to
+    the household's light state as a single change.
+
+    Returns {"results": [...]}, one per command (texts first, then recordings, each in request
+    order): the /transcribe payload, or an error.
+    """
+    try:
+        uuid.UUID(user_id)
+    except ValueError:
+        return jsonify({"error": "Invalid user ID format"}), 400
 
-        # Generate a unique ID for this audio file
+    if request.is_json:
+        texts = (request.get_json(silent=True) or {}).get('commands')
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return jsonify({"error": "A list of text commands is required"}), 400
+        audio_files = []
+    else:
+        with metrics.stage('upload'):
+            texts = request.form.getlist('text')
+            audio_files = request.files.getlist('audioFile')
+    if not texts and not audio_files:
+        return jsonify({"error": "No commands provided"}), 400
+    if len(texts) + len(audio_files) > command_batch_config['max_commands']:
+        return jsonify({"error": f"At most {command_batch_config['max_commands']} commands per request"}), 400
+
+    results = [resolve_command(user_id, text) for text in texts]
+
+    # Decode every recording first, so the ones Whisper has to transcribe are queued together
+    clips = []
+    audio_results = []
+    for audio_file in audio_files:
+        audio_bytes = audio_file.read()
+        try:
+            with metrics.stage('decode'):
+                samples = decode_audio(audio_bytes)
+        except ValueError as e:
+            audio_results.append({"error": str(e), "file": audio_file.filename})
+            continue
         file_id = str(uuid.uuid4())
+        extension = os.path.splitext(audio_file.filename or '')[1].lower()
+        audio_path = save_audio_async(user_id, f"{file_id}{extension if extension[1:].isalnum() else ''}", audio_bytes)
+        clips.append((len(audio_results), file_id, audio_path, samples))
+        audio_results.append(None)
+
+    recognized = recognize_commands(user_id, [samples for _, _, _, samples in clips])
+    for (index, file_id, audio_path, _), result in zip(clips, recognized):
+        filename = audio_files[index].filename
+        if isinstance(result, SchedulerBusy):
+            audio_results[index] = {"error": "Too many transcriptions in progress, please retry",
+                                    "retryAfter": result.retry_after, "file": filename}
+        elif isinstance(result, Exception):
+            audio_results[index] = {"error": str(result), "file": filename}
+        else:
+            transcribed_text, processed_result = result
+            log_audio_file(file_id, user_id, audio_path, transcribed_text)
+            audio_results[index] = {**processed_result, "file": filename}
+    results += audio_results
 
-        # Save the audio file location to the database
-        connection = mysql.connector.connect(**db_config)
-        cursor = connection.cursor()
-        insert_query = """
-            INSERT INTO audio_files (id, user_id, file_path, transcribed_text)
-            VALUES (%s, %s, %s, %s)
-        """
-        cursor.execute(insert_query, (file_id, user_id, audio_path, transcribed_text))
-        connection.commit()
+    with metrics.stage('light_state'):
+        update_light_state(user_id, {'commands': [command for result in results
+                                                  for command in result.get('commands') or []]})
+    return jsonify({"results": results}), 200
 
-        # Return the processed result
-        return jsonify(json.loads(processed_result)), 200
 
+def save_audio_async(user_id, filename, data):
+    """
+    Queues a recording to be written to uploads/<user_id>/<filename> and returns that path, or
+    an empty path when AUDIO_PERSIST is disabled.
+    """
+    if not audio_config['persist']:
+        return ""
+    audio_path = os.path.join("uploads", user_id, filename)
+
+    def write():
+        try:
+            with metrics.stage('audio_save'):
+                os.makedirs(os.path.dirname(audio_path), exist_ok=True)
+                with open(audio_path, 'wb') as audio_out:
+                    audio_out.write(data() if callable(data) else data)
+        except OSError as e:
+            print(f"Failed to save audio {audio_path}: {e}")
+
+    audio_writer.submit(write)
+    return audio_path
+
+
+def encode_wav(samples, sample_rate=SAMPLE_RATE):
+    # 16-bit mono WAV bytes of float32 samples
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def recognize_command(user_id, samples):
+    """
+    Turns decoded 16 kHz samples into text and a parsed command, cheapest stage first: the
+    transcript cache, then the keyword spotter, and only then Whisper.
+
+    :return: Tuple of (transcribed_text, processed_result).
+    """
+    (result,) = recognize_commands(user_id, [samples])
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def recognize_commands(user_id, clips):
+    """
+    recognize_command for several clips at once. Every clip goes through the transcript cache and
+    the keyword spotter first; the ones still unknown are then queued for Whisper together, so the
+    scheduler can transcribe them in the same batch.
+
+    :return: One (transcribed_text, processed_result) per clip, or the exception that clip failed with.
+    """
+    deadline = time.monotonic() + asr_scheduler.request_timeout
+    results = [None] * len(clips)
+    queued = []
+    for index, samples in enumerate(clips):
+        with metrics.stage('transcript_cache'):
+            # Whisper transcribes the preprocessed clip, so its settings are part of what produced the transcript
+            cache_key = audio_key(samples, f"{asr_scheduler.model}:{asr_scheduler.backend}:"
+                                           f"{audio_preprocessor.fingerprint}")
+            cached = transcript_cache.get(cache_key)
+        if cached is not None:
+            results[index] = cached['text'], resolve_command(user_id, cached['text'])
+            continue
+
+        # Try the keyword spotter first and only fall back to Whisper when it isn't confident
+        with metrics.stage('keyword_spotter'):
+            spotted_label = keyword_spotter.spot(user_id, samples)
+        if spotted_label and not keyword_spotter.shadow:
+            results[index] = spotted_label, resolve_command(user_id, spotted_label)
+            continue
+
+        started = time.monotonic()
+        try:
+            # Only Whisper gets the trimmed clip; cache keys and the spotter's templates use the decoded audio
+            future = asr_scheduler.submit({'raw': audio_preprocessor.process(samples), 'sampling_rate': SAMPLE_RATE})
+        except SchedulerBusy as e:
+            results[index] = e
+            continue
+        queued.append((index, samples, cache_key, spotted_label, future, started))
+
+    for index, samples, cache_key, spotted_label, future, started in queued:
+        try:
+            with metrics.stage('asr'):
+                transcribed_text = asr_scheduler.wait(future, max(deadline - time.monotonic(), 0))
+        except Exception as e:
+            results[index] = e
+            continue
+        # What was actually said, without the user's defaults: a template learned as "kitchen on low" when only
+        # "kitchen on" was said would override the stored intensity on every later spotter hit. Both paths
+        # resolve the defaults afterwards, in resolve_command
+        spoken_command = process_text(transcribed_text, default_intensity=None)
+        keyword_spotter.record_whisper(time.monotonic() - started, spotted_label, spoken_command)
+        keyword_spotter.learn(user_id, samples, spoken_command, transcribed_text)
+        transcript_cache.set(cache_key, transcribed_text, spoken_command)
+        results[index] = transcribed_text, resolve_command(user_id, transcribed_text)
+    return results
+
+
+def resolve_command(user_id, text):
+    """
+    Parses `text` into the user's command, filling in whatever they left out (e.g. the intensity)
+    from their stored room preferences. The preferences come from memory, not the database.
+    """
+    preference_index.ensure_loaded(load_all_preferences)
+    with metrics.stage('parse'):
+        return process_text(text, preference_index.defaults(user_id))
+
+
+def update_light_state(user_id, processed_result):
+    """
+    Applies a recognised command to the speaker's household, which pushes the new state to every
+    connected dashboard.
+    """
+    if not processed_result.get('commands'):
+        return
+    try:
+        user, _ = profile_cache.get_or_load(('user', user_id), lambda: load_user_details(user_id))
+        if user:
+            light_state.apply(user['adminId'], processed_result['commands'], user_id)
     except Exception as e:
+        # The command was still recognised; dashboards catch up with the next change
+        print(f"Could not update light state for user {user_id}: {e}")
+
+
+def load_all_preferences():
+    return execute_query("SELECT userId, room, intent, intensity FROM user_preferences") or []
+
+
+# Define the route for streaming transcription
+@app.route('/transcribe-stream/<user_id>', methods=['POST'])
+def transcribe_stream(user_id):
+    """
+    Endpoint for streaming voice commands. The body is raw mono PCM (`format` s16le or f32le, at
+    `rate` Hz) and may be sent with chunked transfer encoding while it is being recorded. The
+    response comes back as soon as the command is known, possibly before the upload has finished.
+
+    To send one utterance over several requests, add `final=0` to the first request and pass the
+    `session` id it returns to the following ones; add `final=1` to the last request to force a
+    decision.
+    """
+    try:
+        uuid.UUID(user_id)
+    except ValueError:
+        return jsonify({"error": "Invalid user ID format"}), 400
+
+    sample_format = request.args.get('format', 's16le')
+    if sample_format not in ('s16le', 'f32le'):
+        return jsonify({"error": f"Unsupported sample format: {sample_format}"}), 400
+    try:
+        sample_rate = int(request.args.get('rate', stream_config['sample_rate']))
+    except ValueError:
+        return jsonify({"error": "Invalid sample rate"}), 400
+
+    session_id = request.args.get('session')
+    if (session_id or request.args.get('final') == '0') and not stream_config['sessions']:
+        return jsonify({"error": "This server runs several worker processes, so each utterance must be sent "
+                                 "in a single request"}), 400
+    session = stream_sessions.get(session_id) if session_id else None
+    if session_id and session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+    if session is None:
+        session = StreamingSession(user_id, asr_scheduler.transcribe, lambda text: resolve_command(user_id, text),
+                                   stream_config, sample_rate=sample_rate, sample_format=sample_format)
+        stream_sessions.add(session)
+
+    try:
+        with session.lock:
+            while not session.done:
+                chunk = request.stream.read(4096)
+                if not chunk:
+                    break
+                session.feed(chunk)
+
+            # Unless the client keeps the session open, the request body is the whole utterance
+            if not session.done and request.args.get('final', '0' if session_id else '1') == '1':
+                session.finish()
+
+    # On any error part of the utterance is lost, so the session is closed and the client starts it again
+    except SchedulerBusy as e:
+        stream_sessions.close(session)
+        response = jsonify({"error": "Too many transcriptions in progress, please retry"})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    except TranscriptionTimeout as e:
+        stream_sessions.close(session)
+        return jsonify({"error": str(e)}), 504
+    except ASRUnavailable as e:
+        stream_sessions.close(session)
+        return jsonify({"error": str(e)}), 503
+    except Exception as e:
+        stream_sessions.close(session)
+        print(f"Streaming transcription failed for user {user_id}: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        # Close the database connection
-        if 'cursor' in locals():
-            cursor.close()
-        if 'connection' in locals():
-            connection.close()
-
-def process_text(transcribed_text):
-    # Initialize the fields
-    room = None
-    intent = None
-    intensity = None
-    response = None
-
-    # Define keywords for each field
-    intent_keywords = ["on", "off"]
-    room_keywords = ["master", "kitchen", "guest", "hall"]
-    intensity_keywords = {
-        "low": ["low", "soft", "decrease"],
-        "high": ["high", "bright", "increase"]
-    }
 
-    # Convert text to lowercase for easier matching
-    text = transcribed_text.lower()
-
-    # Extract room
-    for keyword in room_keywords:
-        if keyword in text:
-            room = keyword
-
-    # Extract intent
-    for keyword in intent_keywords:
-        if keyword in text:
-            intent = keyword
-
-    for intensity_level, keywords in intensity_keywords.items():
-        if any(keyword in text for keyword in keywords):
-            intensity = intensity_level
-            intent = "on"
-
-    # Special handling for "on" intent
-    if intent == "on":
-        # If no intensity specified, default to "low"
-        if intensity is None:
-            intensity = "low"
-            response = f"The light is turned {intent} with {intensity} intensity in {room} room."
-        else:
-            response = f"The light is turned {intent} with {intensity} intensity in {room} room."
-    else:  # "off" intent
-        # For "off", intensity remains None
-        response = f"The light is turned {intent} in {room} room."
-
-
-    # If no room is found AND (intent or intensity is missing)
-    if not room :
-        # and (not intent or not intensity):
-        return json.dumps({
-            "room": None,
-            "intent": None,
-            "intensity": None,
-            "text": transcribed_text,
-            "response": "Please enter valid instructions."
-        }, indent=4)
-
-    # Construct the result JSON
-    result = {
-        "room": room,
-        "intent": intent,
-        "intensity": intensity,
-        "text": transcribed_text,
-        "response": response
-    }
+    result = session.result()
+    if session.command:
+        # Applied as soon as the intent is known (re-applying an unchanged command is a no-op)
+        update_light_state(user_id, session.command)
+    if session.done:
+        stream_sessions.close(session)
+        # Storing the recording isn't needed to answer the client, so it happens in the background
+        audio_writer.submit(save_stream_audio, session)
+
+    return jsonify(result), 200
+
+
+def save_stream_audio(session):
+    """
+    Saves a finished streaming session as a 16-bit WAV file and logs it in `audio_files`.
+    """
+    try:
+        audio_path = save_audio_async(session.user_id, f"{session.session_id}.wav",
+                                      lambda: encode_wav(session.audio(), stream_config['sample_rate']))
+        text = session.hypotheses[-1] if session.hypotheses else ""
+        log_audio_file(session.session_id, session.user_id, audio_path, text)
+    except Exception as e:
+        print(f"Failed to save streamed audio {session.session_id}: {e}")
+
+
+# Conversation log page sizes
+CONVERSATION_LOG_PAGE_SIZE = 10
+CONVERSATION_LOG_MAX_PAGE_SIZE = 100
+
+
+def encode_log_cursor(row):
+    """Opaque cursor pointing just past `row` in (created_at, id) order."""
+    position = f"{row['created_at'].isoformat()}|{row['id']}"
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip('=')
+
+
+def decode_log_cursor(cursor):
+    try:
+        position = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, file_id = position.split('|', 1)
+        return datetime.fromisoformat(created_at), file_id
+    except ValueError:
+        raise ValueError("Invalid cursor")
+
+
+def parse_log_time(value, name):
+    # ISO 8601; timestamps are stored in UTC, so offsets are converted and naive values taken as UTC
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"Invalid {name} timestamp, expected ISO 8601")
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment
+
+
+def build_conversation_log_query(user_id, limit, cursor=None, since=None, until=None, text=None):
+    """
+    Builds the keyset-paginated history query: newest first, ordered on (created_at, id) so it is
+    answered from the idx_audio_files_user_created index however deep the page is. Fetches one
+    row more than `limit` to tell whether there is a next page.
+
+    :return: Tuple of (query, params).
+    """
+    conditions = ["user_id = %s"]
+    params = [user_id]
+    if cursor is not None:
+        created_at, file_id = cursor
+        conditions.append("(created_at < %s OR (created_at = %s AND id < %s))")
+        params.extend((created_at, created_at, file_id))
+    if since is not None:
+        conditions.append("created_at >= %s")
+        params.append(since)
+    if until is not None:
+        conditions.append("created_at < %s")
+        params.append(until)
+    if text:
+        escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        conditions.append("transcribed_text LIKE %s")
+        params.append(f"%{escaped}%")
+    query = f"""
+        SELECT id, user_id, transcribed_text, created_at
+        FROM audio_files
+        WHERE {" AND ".join(conditions)}
+        ORDER BY created_at DESC, id DESC
+        LIMIT %s
+    """
+    params.append(limit + 1)
+    return query, params
+
+
+def conversation_log_query(user_id, args):
+    """
+    Builds the history query from the request's query parameters (see get_conversations_logs).
+
+    :return: Tuple of (query, params, limit); raises ValueError for invalid parameters.
+    """
+    try:
+        limit = int(args.get('limit', CONVERSATION_LOG_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("Invalid limit")
+    limit = min(max(limit, 1), CONVERSATION_LOG_MAX_PAGE_SIZE)
+    cursor = args.get('cursor')
+    since = args.get('since')
+    until = args.get('until')
+    query, params = build_conversation_log_query(
+        user_id,
+        limit,
+        cursor=decode_log_cursor(cursor) if cursor else None,
+        since=parse_log_time(since, 'since') if since else None,
+        until=parse_log_time(until, 'until') if until else None,
+        text=args.get('q'),
+    )
+    return query, params, limit
 
-    return json.dumps(result, indent=4)
 
 @app.route('/conversation-logs/<user_id>', methods=['GET'])
 def get_conversations_logs(user_id):
-    global cursor, connection
+    """
+    Endpoint returning a user's conversation history, newest first, one page at a time.
+
+    Query parameters: `limit` (page size, default 10), `cursor` (from the previous page's
+    X-Next-Cursor header), `since`/`until` (ISO 8601 time range) and `q` (text the transcription
+    contains). The body is the list of conversations; when there are older ones, the cursor for the
+    next page is returned in the X-Next-Cursor and Link headers.
+    """
     try:
         # Validate user_id format
         uuid.UUID(user_id)
+    except ValueError:
+        return jsonify({"error": "Invalid user ID format"}), 400
 
-        # Connect to the database
-        connection = mysql.connector.connect(**db_config)
-        cursor = connection.cursor(dictionary=True)
+    try:
+        select_query, params, limit = conversation_log_query(user_id, request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-        # Fetch the last 10 conversations for the given user_id
-        select_query = """
-            SELECT user_id, transcribed_text, created_at 
-            FROM audio_files 
-            WHERE user_id = %s 
-            ORDER BY created_at DESC 
-            LIMIT 10
-        """
-        cursor.execute(select_query, (user_id,))
-        results = cursor.fetchall()
+    try:
+        results = execute_query(select_query, params)
 
         # If no results are found, return an appropriate message
         if not results:
             return jsonify({"message": "No conversations found for this user."}), 404
 
-        # Return the results as JSON
-        return jsonify(results), 200
+        response = jsonify(results[:limit])
+        if len(results) > limit:
+            next_cursor = encode_log_cursor(results[limit - 1])
+            next_url = url_for('get_conversations_logs', user_id=user_id, _external=True,
+                               **{**request.args.to_dict(), 'cursor': next_cursor})
+            response.headers['X-Next-Cursor'] = next_cursor
+            response.headers['Link'] = f'<{next_url}>; rel="next"'
+        return response, 200
 
-    except ValueError:
-        return jsonify({"error": "Invalid user ID format"}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-    finally:
-        # Close the database connection
-        if 'cursor' in locals():
-            cursor.close()
-        if 'connection' in locals():
-            connection.close()
+
+startup_seconds = time.monotonic() - _import_started
+print(f"App initialized in {startup_seconds * 1000:.0f} ms")
+
+
+def start_background_services(retention=True):
+    """
+    Starts what the serving process runs next to the request handlers: the preference index load,
+    retention, light state snapshots and, when warmup is enabled, the transcription workers. With
+    several worker processes (see serve.py) only one of them runs retention.
+    """
+    metrics.start()
+    preference_index.ensure_loaded(load_all_preferences)
+    if retention:
+        retention_worker.start()
+    light_state.start()
+    if asr_scheduler.warmup:
+        asr_scheduler.start()
+
 
 # Run the app
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    debug = True
+    # With the debug reloader only the child process that serves requests should load the model and preferences
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_services()
+    app.run(debug=debug, port=5000)
\ No newline at end of file
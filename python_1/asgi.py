@@ -0,0 +1,571 @@
+"""
+ASGI entry point for serving the app with an async server, e.g.:
+
+    pip install uvicorn
+    uvicorn asgi:application --port 5000
+
+The lightweight read routes (/login, /users, /user-details, /conversation-logs) are served
+natively on the event loop with async MySQL access, so thousands of them can wait on the database
+without holding a thread each. With the embedded SQLite backend there is no server to wait on, and
+their queries run on the app's pool in a thread instead. Every other route runs the Flask app unchanged in a thread pool;
+transcriptions and event streams get a pool of their own, so long requests can never use up the
+threads the rest of the API needs.
+"""
+import asyncio
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode
+
+import mysql.connector
+from mysql.connector import aio as mysql_aio
+
+import App
+from App import app, db_config, pool_config, profile_cache
+from auth import InvalidToken
+from metrics import metrics
+from storage import storage_config
+
+# Thread pools for the routes that still run through Flask (can be overridden through the environment)
+asgi_config = {
+    'wsgi_threads': int(os.environ.get('ASGI_WSGI_THREADS', 32)),
+    # Transcriptions wait on the recogniser and event streams stay open, so they get their own threads
+    'long_request_threads': int(os.environ.get('ASGI_LONG_REQUEST_THREADS', 64)),
+}
+
+LONG_REQUESTS = re.compile(r"^/(transcribe(-stream)?/[^/]+|light-state/[^/]+/events)$")
+
+
+class AsyncConnectionPool:
+    """
+    Asyncio counterpart of storage.ConnectionPool: at most `pool_size` connections, callers wait up to
+    `checkout_timeout` seconds for one, idle connections are health-checked and old ones recycled.
+    """
+
+    def __init__(self, config, pool_size, checkout_timeout, health_check_interval, recycle):
+        self.config = config
+        self.pool_size = pool_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.recycle = recycle
+        self._slots = asyncio.Semaphore(pool_size)
+        self._idle = []  # (connection, last_used_at), most recently used last
+        self._created_at = {}  # id(connection) -> creation time
+        self._stats = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'reconnects': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'in_use': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    async def _connect(self):
+        connection = await mysql_aio.connect(**self.config)
+        self._stats['connections_created'] += 1
+        self._created_at[id(connection)] = time.monotonic()
+        return connection
+
+    async def _close(self, connection):
+        self._created_at.pop(id(connection), None)
+        try:
+            await connection.close()
+        except mysql.connector.Error:
+            pass
+
+    async def acquire(self):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.checkout_timeout)
+        except asyncio.TimeoutError:
+            self._stats['timeouts'] += 1
+            raise mysql.connector.errors.PoolError(
+                f"No database connection available within {self.checkout_timeout}s")
+        waited = time.monotonic() - started
+
+        try:
+            connection = await self._take_idle()
+            if connection is None:
+                connection = await self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        self._stats['checkouts'] += 1
+        self._stats['in_use'] += 1
+        self._stats['wait_time_total'] += waited
+        self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+        return connection
+
+    async def _take_idle(self):
+        while self._idle:
+            connection, last_used = self._idle.pop()
+            now = time.monotonic()
+            if now - self._created_at.get(id(connection), now) > self.recycle:
+                await self._close(connection)
+                continue
+            if now - last_used > self.health_check_interval and not await connection.is_connected():
+                try:
+                    await connection.reconnect(attempts=1, delay=0)
+                except mysql.connector.Error as err:
+                    print("Discarding stale pooled connection:", err)
+                    await self._close(connection)
+                    self._stats['discarded'] += 1
+                    continue
+                self._stats['reconnects'] += 1
+            return connection
+        return None
+
+    async def release(self, connection, discard=False):
+        try:
+            if not discard:
+                try:
+                    # Never hand out a connection with an open transaction (and its stale snapshot)
+                    if connection.in_transaction:
+                        await connection.rollback()
+                except mysql.connector.Error:
+                    discard = True
+
+            if discard:
+                await self._close(connection)
+                self._stats['discarded'] += 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+        finally:
+            self._stats['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['idle'] = len(self._idle)
+        stats['pool_size'] = self.pool_size
+        stats['wait_time_avg'] = stats['wait_time_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+
+db_pool = AsyncConnectionPool(db_config, **pool_config) if storage_config['backend'] == 'mysql' else None
+wsgi_executor = ThreadPoolExecutor(max_workers=asgi_config['wsgi_threads'], thread_name_prefix='wsgi')
+long_request_executor = ThreadPoolExecutor(max_workers=asgi_config['long_request_threads'],
+                                           thread_name_prefix='wsgi-long')
+
+
+# Helper function to execute a query on the event loop
+async def execute_query(query, params=None, fetch_one=False):
+    if db_pool is None:
+        return await asyncio.to_thread(App.execute_query, query, params, fetch_one)
+    with metrics.stage('db', 'db_query_seconds', operation='query'):
+        return await _execute_query(query, params, fetch_one)
+
+
+async def _execute_query(query, params, fetch_one):
+    connection = await db_pool.acquire()
+    discard = False
+    try:
+        cursor = await connection.cursor(dictionary=True)
+        try:
+            await cursor.execute(query, params or ())
+            if fetch_one:
+                result = await cursor.fetchone()
+                await cursor.fetchall()  # Drain remaining rows so the connection can be reused
+                return result
+            return await cursor.fetchall()
+        finally:
+            await cursor.close()
+    except (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError):
+        # The connection itself is broken, don't put it back in the pool
+        discard = True
+        raise
+    except mysql.connector.Error as err:
+        print("Query execution error:", err)
+        metrics.increment('db_errors_total', operation='query')
+        raise
+    finally:
+        await db_pool.release(connection, discard)
+
+
+class NativeRequest:
+    """The parts of an ASGI HTTP request the native routes need."""
+
+    def __init__(self, scope, body):
+        self.scope = scope
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict(parse_qsl(scope['query_string'].decode('utf-8', 'replace')))
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.body = body
+
+    def get_json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+    def url(self, **args):
+        host = self.headers.get('host') or f"{self.scope['server'][0]}:{self.scope['server'][1]}"
+        query = urlencode({**self.args, **args})
+        return f"{self.scope.get('scheme', 'http')}://{host}{self.path}{'?' + query if query else ''}"
+
+
+class NativeResponse:
+    def __init__(self, payload, status=200, headers=None):
+        # Same serialisation as Flask's jsonify (e.g. datetimes as HTTP dates)
+        self.body = b"" if payload is None else (app.json.dumps(payload) + "\n").encode()
+        self.status = status
+        self.headers = {'Content-Type': 'application/json', **(headers or {})}
+
+
+def conditional_response(request, payload, etag):
+    # Mirrors App.conditional_response: 304 when the client already has this version
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'}
+    matches = [tag.strip().removeprefix('W/') for tag in request.headers.get('if-none-match', '').split(',')]
+    if f'"{etag}"' in matches or '*' in matches:
+        response = NativeResponse(None, 304, headers)
+        del response.headers['Content-Type']
+        return response
+    return NativeResponse(payload, 200, headers)
+
+
+async def login(request):
+    data = request.get_json()
+    if not isinstance(data, dict):
+        return NativeResponse({"error": "Request body must be JSON"}, 400)
+    username = data.get('username')
+    password = data.get('password')
+
+    # Validate input fields
+    if not all([username, password]):
+        return NativeResponse({"error": "Username and password are required"}, 400)
+
+    try:
+        result = await execute_query(App.LOGIN_QUERY, (username,), fetch_one=True)
+    except mysql.connector.Error as err:
+        return NativeResponse({"error": str(err)}, 500)
+    # Password hashing is CPU work, keep it off the event loop
+    payload, status = await asyncio.get_running_loop().run_in_executor(
+        wsgi_executor, App.login_result, result, password)
+    return NativeResponse(payload, status)
+
+
+async def get_users_by_admin(request, admin_id):
+    try:
+        # Validate admin_id format
+        uuid.UUID(admin_id)
+
+        async def load():
+            return await execute_query(App.USERS_BY_ADMIN_QUERY, (admin_id,)) or None
+
+        results, etag = await profile_cache.get_or_load_async(('household', admin_id), load)
+
+        # If no results are found, return an appropriate message
+        if not results:
+            return NativeResponse({"message": "No users found for this admin ID."}, 404)
+        return conditional_response(request, results, etag)
+
+    except ValueError:
+        return NativeResponse({"error": "Invalid admin ID format"}, 400)
+    except Exception as e:
+        return NativeResponse({"error": str(e)}, 500)
+
+
+async def load_user_details(user_id):
+    user = await execute_query(App.USER_QUERY, (user_id,), fetch_one=True)
+    if not user:
+        return None
+    preferences = await execute_query(App.USER_PREFERENCES_QUERY, (user_id,))
+    return App.user_details(user, preferences)
+
+
+async def get_user_details(request, user_id):
+    try:
+        # Validate userId
+        uuid.UUID(user_id)
+    except ValueError:
+        return NativeResponse({"error": "Invalid userId format"}, 400)
+
+    try:
+        response, etag = await profile_cache.get_or_load_async(('user', user_id), lambda: load_user_details(user_id))
+        if not response:
+            return NativeResponse({"error": "User not found"}, 404)
+        return conditional_response(request, response, etag)
+
+    except mysql.connector.Error as err:
+        print(f"Database error: {err}")
+        return NativeResponse({"error": "An error occurred while fetching user details"}, 500)
+
+
+async def get_conversations_logs(request, user_id):
+    try:
+        # Validate user_id format
+        uuid.UUID(user_id)
+    except ValueError:
+        return NativeResponse({"error": "Invalid user ID format"}, 400)
+
+    try:
+        select_query, params, limit = App.conversation_log_query(user_id, request.args)
+    except ValueError as e:
+        return NativeResponse({"error": str(e)}, 400)
+
+    try:
+        results = await execute_query(select_query, params)
+
+        # If no results are found, return an appropriate message
+        if not results:
+            return NativeResponse({"message": "No conversations found for this user."}, 404)
+
+        headers = {}
+        if len(results) > limit:
+            next_cursor = App.encode_log_cursor(results[limit - 1])
+            headers['X-Next-Cursor'] = next_cursor
+            headers['Link'] = f'<{request.url(cursor=next_cursor)}>; rel="next"'
+        return NativeResponse(results[:limit], 200, headers)
+
+    except Exception as e:
+        return NativeResponse({"error": str(e)}, 500)
+
+
+# (method, path pattern, handler) of the routes served on the event loop
+NATIVE_ROUTES = [
+    ('POST', re.compile(r"^/login$"), login),
+    ('GET', re.compile(r"^/users/([^/]+)$"), get_users_by_admin),
+    ('GET', re.compile(r"^/user-details/([^/]+)$"), get_user_details),
+    ('GET', re.compile(r"^/conversation-logs/([^/]+)$"), get_conversations_logs),
+]
+
+
+def match_native_route(method, path):
+    for route_method, pattern, handler in NATIVE_ROUTES:
+        match = pattern.match(path)
+        if match and method == route_method:
+            return handler, match.groups()
+    return None, None
+
+
+def cors_headers(request):
+    # What Flask-CORS adds to the Flask routes' responses
+    origin = request.headers.get('origin')
+    if origin not in App.cors_config['origins']:
+        return {}
+    return {
+        'Access-Control-Allow-Origin': origin,
+        'Access-Control-Expose-Headers': ", ".join(App.cors_config['expose_headers']),
+        'Vary': 'Origin',
+    }
+
+
+async def authorize(request, handler, args):
+    # Mirrors App.check_session for the routes served here; returns the refusal, or None
+    try:
+        claims = App.session_tokens.verify_header(request.headers.get('authorization'))
+    except InvalidToken as e:
+        return NativeResponse({"error": str(e)}, 401)
+    if not App.auth_config['required'] or handler is login:
+        return None
+
+    admin_id = args[0] if handler is get_users_by_admin else None
+    if handler is not get_users_by_admin:
+        user_id = args[0]
+        try:
+            uuid.UUID(user_id)
+            user, _ = await profile_cache.get_or_load_async(('user', user_id), lambda: load_user_details(user_id))
+            admin_id = user['adminId'] if user else None
+        except ValueError:
+            pass
+        except mysql.connector.Error as err:
+            print(f"Could not check access: {err}")
+            return NativeResponse({"error": "Could not check access, please retry"}, 503)
+    error = App.authorization_error(claims, admin_id)
+    return NativeResponse(*error) if error else None
+
+
+async def serve_native(scope, receive, send, handler, args):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        body.extend(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    request = NativeRequest(scope, bytes(body))
+    # Recorded like the Flask routes' requests (see App.record_request_metrics)
+    started = time.perf_counter()
+    token = metrics.start_trace()
+    try:
+        response = await authorize(request, handler, args) or await handler(request, *args)
+    finally:
+        stages = metrics.end_trace(token)
+    seconds = time.perf_counter() - started
+    metrics.observe('http_request_seconds', seconds, method=scope['method'], route=handler.__name__,
+                    status=response.status)
+    headers = {**response.headers, **cors_headers(request)}
+    if metrics.profile_header.lower() in request.headers:
+        headers['Server-Timing'] = metrics.server_timing(stages, seconds)
+    await send({
+        'type': 'http.response.start',
+        'status': response.status,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers.items()]
+                   + [(b'content-length', str(len(response.body)).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': response.body})
+
+
+class RequestBody(io.RawIOBase):
+    """
+    wsgi.input fed from the ASGI receive channel as the body arrives, so Flask sees a streamed
+    upload (e.g. /transcribe-stream) chunk by chunk rather than after it has been buffered.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._buffer = b""
+        self._complete = False
+        self._condition = threading.Condition()
+
+    def feed(self, data, more):
+        with self._condition:
+            if data:
+                self._chunks.append(data)
+            if not more:
+                self._complete = True
+            self._condition.notify_all()
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        with self._condition:
+            while not self._buffer:
+                if self._chunks:
+                    self._buffer = self._chunks.pop(0)
+                elif self._complete:
+                    return 0
+                else:
+                    self._condition.wait()
+            size = min(len(target), len(self._buffer))
+            target[:size] = self._buffer[:size]
+            self._buffer = self._buffer[size:]
+            return size
+
+
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,  # Read chunked bodies to the end rather than by Content-Length
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f"HTTP_{name}"
+        environ[name] = f"{environ[name]},{value}" if name in environ else value
+    return environ
+
+
+def run_wsgi(environ, loop, send, disconnected):
+    # Runs on a pool thread: calls the Flask app and forwards its response to the event loop
+    def send_message(message):
+        asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return lambda data: None
+
+    iterable = app(environ, start_response)
+    started = False
+    try:
+        for chunk in iterable:
+            if disconnected.is_set():
+                return
+            if not started:
+                send_message({'type': 'http.response.start', 'status': response['status'],
+                              'headers': response['headers']})
+                started = True
+            if chunk:
+                send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        if not started:
+            send_message({'type': 'http.response.start', 'status': response['status'],
+                          'headers': response['headers']})
+        send_message({'type': 'http.response.body', 'body': b""})
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+async def serve_wsgi(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    body = RequestBody()
+    disconnected = threading.Event()
+
+    async def pump():
+        # Feeds the request body to the handler, then watches for the client going away
+        body_done = False
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                disconnected.set()
+                body.feed(b"", False)
+                return
+            if not body_done:
+                body_done = not message.get('more_body')
+                body.feed(message.get('body', b""), not body_done)
+
+    executor = long_request_executor if LONG_REQUESTS.match(scope['path']) else wsgi_executor
+    pumping = asyncio.create_task(pump())
+    try:
+        await loop.run_in_executor(executor, run_wsgi, wsgi_environ(scope, body), loop, send, disconnected)
+    finally:
+        pumping.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            App.start_background_services()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            while db_pool is not None and db_pool._idle:
+                connection, _ = db_pool._idle.pop()
+                await db_pool._close(connection)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    handler, args = match_native_route(scope['method'], scope['path'])
+    if handler is not None:
+        await serve_native(scope, receive, send, handler, args)
+    else:
+        await serve_wsgi(scope, receive, send)
@@ -0,0 +1,609 @@
+import math
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, CancelledError
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from metrics import metrics
+
+# Whisper checkpoints selectable by size through ASR_MODEL (any other value is used as a model id as-is)
+MODEL_REGISTRY = {
+    'tiny': 'openai/whisper-tiny',
+    'base': 'openai/whisper-base',
+    'small': 'openai/whisper-small',
+    'medium': 'openai/whisper-medium',
+}
+
+
+def resolve_model(name):
+    return MODEL_REGISTRY.get(name, name)
+
+
+def resident_memory(pid=None):
+    """Returns the resident set size of a process in bytes, or None when it can't be determined."""
+    pid = pid or os.getpid()
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f"/proc/{pid}/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+# Speech recognition configuration (can be overridden through the environment)
+asr_config = {
+    'model': resolve_model(os.environ.get('ASR_MODEL', 'medium')),
+    # Number of worker processes holding the model; 0 runs inference on a thread inside this process
+    'workers': int(os.environ.get('ASR_WORKERS', 1)),
+    'queue_size': int(os.environ.get('ASR_QUEUE_SIZE', 16)),
+    'batch_window': float(os.environ.get('ASR_BATCH_WINDOW_MS', 50)) / 1000,
+    'max_batch_size': int(os.environ.get('ASR_MAX_BATCH_SIZE', 8)),
+    'request_timeout': float(os.environ.get('ASR_REQUEST_TIMEOUT', 60)),
+    # Load the model in the background as soon as the server starts instead of on the first request
+    'warmup': os.environ.get('ASR_WARMUP', '1') == '1',
+    # Inference backend (transformers, int8 or onnx) and its CPU thread counts; 0 keeps the library default
+    'backend': os.environ.get('ASR_BACKEND', 'transformers'),
+    'intra_op_threads': int(os.environ.get('ASR_INTRA_OP_THREADS', 0)),
+    'inter_op_threads': int(os.environ.get('ASR_INTER_OP_THREADS', 0)),
+    # A worker process that keeps dying (e.g. a bad ASR_MODEL, or out of memory while loading) is restarted
+    # after `restart_backoff` seconds, doubling on every consecutive failure, and given up after `max_restarts`
+    'max_restarts': int(os.environ.get('ASR_MAX_RESTARTS', 5)),
+    'restart_backoff': float(os.environ.get('ASR_RESTART_BACKOFF', 1)),
+}
+
+# Longest wait before restarting a failed worker process
+MAX_RESTART_BACKOFF = 60
+
+# Directory where ONNX exports of the models are kept between runs
+ONNX_CACHE_DIR = os.environ.get('ASR_ONNX_CACHE_DIR', os.path.join('models', 'onnx'))
+
+
+class SchedulerBusy(Exception):
+    """Raised when the transcription queue is full; `retry_after` is a hint in seconds."""
+
+    def __init__(self, retry_after):
+        super().__init__("Transcription queue is full")
+        self.retry_after = retry_after
+
+
+class TranscriptionTimeout(Exception):
+    """Raised when a transcription did not finish within its deadline."""
+
+
+class ASRUnavailable(Exception):
+    """Raised when every worker process failed more than `max_restarts` times in a row."""
+
+
+def set_torch_threads(intra_op_threads, inter_op_threads):
+    import torch
+
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # Can only be set once, before any inter-op parallel work has started
+            print("Could not set inter-op threads:", e)
+
+
+def _load_transformers(model, intra_op_threads, inter_op_threads):
+    # Imported here so that processes which never transcribe don't pay for transformers/torch
+    from transformers import pipeline
+
+    set_torch_threads(intra_op_threads, inter_op_threads)
+    # CPU mode: device=-1, GPU: device=0
+    return pipeline('automatic-speech-recognition', model=model, device=-1)
+
+
+def _load_int8(model, intra_op_threads, inter_op_threads):
+    # Same pipeline with its Linear layers dynamically quantized to int8 (weights int8, activations
+    # quantized on the fly), which is where almost all of Whisper's CPU time goes
+    import torch
+
+    whisper = _load_transformers(model, intra_op_threads, inter_op_threads)
+    whisper.model = torch.ao.quantization.quantize_dynamic(whisper.model, {torch.nn.Linear}, dtype=torch.qint8)
+    return whisper
+
+
+def _load_onnx(model, intra_op_threads, inter_op_threads):
+    # ONNX Runtime export of the model, cached on disk so only the first load pays for the export
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForSpeechSeq2Seq
+    from transformers import AutoProcessor, pipeline
+
+    options = onnxruntime.SessionOptions()
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads:
+        options.inter_op_num_threads = inter_op_threads
+
+    export_dir = os.path.join(ONNX_CACHE_DIR, model.replace('/', '--'))
+    if os.path.isdir(export_dir):
+        ort_model = ORTModelForSpeechSeq2Seq.from_pretrained(export_dir, session_options=options)
+    else:
+        print(f"Exporting {model} to ONNX in {export_dir}")
+        ort_model = ORTModelForSpeechSeq2Seq.from_pretrained(model, export=True, session_options=options)
+        ort_model.save_pretrained(export_dir)
+
+    processor = AutoProcessor.from_pretrained(model)
+    return pipeline('automatic-speech-recognition', model=ort_model, tokenizer=processor.tokenizer,
+                    feature_extractor=processor.feature_extractor, device=-1)
+
+
+# Inference backends selectable through ASR_BACKEND
+BACKENDS = {
+    'transformers': _load_transformers,
+    'int8': _load_int8,
+    'onnx': _load_onnx,
+}
+
+
+# Pipelines loaded before worker processes are forked (see serve.py); the forked processes share
+# their weights copy-on-write instead of loading their own
+_preloaded = {}
+
+
+def preload_pipeline(model, backend='transformers', intra_op_threads=0, inter_op_threads=0):
+    """Loads a pipeline that load_pipeline returns for the same model and backend from then on."""
+    whisper = load_pipeline(model, backend, intra_op_threads, inter_op_threads)
+    _preloaded[(model, backend)] = whisper
+    return whisper
+
+
+def load_pipeline(model, backend='transformers', intra_op_threads=0, inter_op_threads=0):
+    """Loads a speech recognition pipeline for `model` on the given backend (see BACKENDS)."""
+    if (model, backend) in _preloaded:
+        return _preloaded[(model, backend)]
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown ASR backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+    return BACKENDS[backend](model, intra_op_threads, inter_op_threads)
+
+
+def run_batch(whisper, inputs):
+    """Runs one batched pipeline call and returns the transcribed text for every input."""
+    outputs = whisper(list(inputs), batch_size=len(inputs))
+    return [output['text'] for output in outputs]
+
+
+def _worker_main(index, spec, tasks, results):
+    # Entry point of a worker process: load the model once, then serve batches until told to stop
+    started = time.monotonic()
+    whisper = load_pipeline(**spec)
+    results.put((index, 'ready', time.monotonic() - started))
+    while True:
+        inputs = tasks.get()
+        if inputs is None:
+            break
+        try:
+            results.put((index, 'ok', run_batch(whisper, inputs)))
+        except Exception as e:
+            results.put((index, 'error', str(e)))
+
+
+class _Job:
+    __slots__ = ('audio', 'future', 'deadline', 'enqueued_at')
+
+    def __init__(self, audio, deadline):
+        self.audio = audio
+        self.future = Future()
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+
+
+class _ProcessWorker:
+    def __init__(self, index, spec, context, results):
+        self.index = index
+        self.spec = spec
+        self.context = context
+        self.results = results
+        self.jobs = None  # Batch currently being transcribed by this worker
+        self.started_at = None
+        self.ready = False
+        self.load_seconds = None
+        self.queued = False  # Waiting in the scheduler's idle queue
+        self.failures = 0  # Deaths since the model was last loaded
+        self.restart_at = None  # When a dead worker is due to be restarted
+        self.failed = False  # Given up on after too many failures
+        self._spawn()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def _spawn(self):
+        self.ready = False
+        self.tasks = self.context.Queue()
+        self.process = self.context.Process(
+            target=_worker_main, args=(self.index, self.spec, self.tasks, self.results),
+            name=f"asr-worker-{self.index}", daemon=True)
+        self.process.start()
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def restart(self):
+        self.jobs = None
+        self.discard_tasks()
+        self._spawn()
+
+    def discard_tasks(self):
+        # A batch the dead process never read would otherwise keep the queue's feeder thread, and so
+        # interpreter exit, blocked on the full pipe
+        self.tasks.cancel_join_thread()
+        self.tasks.close()
+
+    def run(self, jobs):
+        self.jobs = jobs
+        self.started_at = time.monotonic()
+        self.tasks.put([job.audio for job in jobs])
+
+    def stop(self, timeout):
+        if not self.process.is_alive():
+            self.discard_tasks()
+            return
+        self.tasks.put(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class _ThreadWorker:
+    def __init__(self, index, spec, scheduler):
+        self.index = index
+        self.spec = spec
+        self.scheduler = scheduler
+        self.jobs = None
+        self.started_at = None
+        self.ready = False
+        self.load_seconds = None
+        self.queued = False
+        self.failed = False
+        self.pid = os.getpid()
+        self._whisper = None
+        self._tasks = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name=f"asr-worker-{index}", daemon=True)
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def _load(self):
+        started = time.monotonic()
+        self._whisper = load_pipeline(**self.spec)
+        self.load_seconds = time.monotonic() - started
+        self.ready = True
+
+    def _loop(self):
+        try:
+            self._load()
+        except Exception as e:
+            print(f"Loading {self.spec['model']} failed, retrying on the next request:", e)
+        while True:
+            jobs = self._tasks.get()
+            if jobs is None:
+                break
+            try:
+                if self._whisper is None:
+                    self._load()
+                texts = run_batch(self._whisper, [job.audio for job in jobs])
+                self.scheduler._complete(self, 'ok', texts)
+            except Exception as e:
+                self.scheduler._complete(self, 'error', str(e))
+
+    def run(self, jobs):
+        self.jobs = jobs
+        self.started_at = time.monotonic()
+        self._tasks.put(jobs)
+
+    def stop(self, timeout):
+        self._tasks.put(None)
+        self._thread.join(timeout)
+
+
+class TranscriptionScheduler:
+    """
+    Bounded queue in front of a pool of ASR workers, each holding its own copy of the model.
+
+    Requests that arrive within `batch_window` seconds of each other are grouped (up to
+    `max_batch_size`) into one batched pipeline call on the next free worker. When `queue_size`
+    requests are already waiting, new ones are rejected with SchedulerBusy instead of piling up,
+    and every request fails with TranscriptionTimeout once `request_timeout` seconds have passed.
+
+    Worker processes that die are restarted with exponential backoff. Once every worker has failed
+    `max_restarts` times in a row the scheduler is unhealthy: waiting and new requests fail at once
+    with ASRUnavailable rather than keep reloading the model.
+    """
+
+    def __init__(self, model, workers, queue_size, batch_window, max_batch_size, request_timeout, warmup=False,
+                 backend='transformers', intra_op_threads=0, inter_op_threads=0, max_restarts=5, restart_backoff=1):
+        self.model = model
+        self.backend = backend
+        # Everything a worker needs to load its copy of the model (see load_pipeline)
+        self.spec = {
+            'model': model,
+            'backend': backend,
+            'intra_op_threads': intra_op_threads,
+            'inter_op_threads': inter_op_threads,
+        }
+        self.warmup = warmup
+        self.worker_count = workers
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.request_timeout = request_timeout
+        self.max_restarts = max_restarts
+        self.restart_backoff = restart_backoff
+        self.healthy = True
+        self._pending = queue.Queue(maxsize=queue_size)
+        self._idle_workers = queue.Queue()
+        self._workers = []
+        self._results = None
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopping = False
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'rejected': 0,
+            'timeouts': 0,
+            'errors': 0,
+            'batches': 0,
+            'batched_requests': 0,
+            'batch_time_total': 0.0,
+            'queue_wait_total': 0.0,
+            'worker_restarts': 0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        if self.worker_count > 0:
+            # Spawn (rather than fork) so workers don't inherit the web server's threads and locks
+            context = multiprocessing.get_context('spawn')
+            self._results = context.Queue()
+            for index in range(self.worker_count):
+                self._workers.append(_ProcessWorker(index, self.spec, context, self._results))
+            threading.Thread(target=self._collect, name="asr-collector", daemon=True).start()
+        else:
+            self._workers.append(_ThreadWorker(0, self.spec, self))
+
+        for worker in self._workers:
+            self._release(worker)
+        threading.Thread(target=self._dispatch, name="asr-dispatcher", daemon=True).start()
+        print(f"ASR scheduler started with {len(self._workers)} worker(s) for {self.model} ({self.backend})")
+
+    def submit(self, audio, timeout=None):
+        """
+        Queues `audio` (a {'raw': samples, 'sampling_rate': rate} dict) for transcription and returns a
+        Future resolving to its text.
+        """
+        self.start()
+        if not self.healthy:
+            raise ASRUnavailable(f"Speech recognition is unavailable: the {self.model} workers keep failing")
+        job = _Job(audio, time.monotonic() + (timeout or self.request_timeout))
+        try:
+            self._pending.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._stats['rejected'] += 1
+            raise SchedulerBusy(self.retry_after())
+        with self._lock:
+            self._stats['submitted'] += 1
+        return job.future
+
+    def transcribe(self, audio, timeout=None):
+        """Transcribes `audio` and returns the text, waiting at most the request timeout."""
+        timeout = timeout or self.request_timeout
+        return self.wait(self.submit(audio, timeout), timeout)
+
+    def wait(self, future, timeout=None):
+        """
+        Waits at most `timeout` seconds (default the request timeout) for a Future returned by submit
+        and returns its text.
+        """
+        timeout = self.request_timeout if timeout is None else timeout
+        try:
+            return future.result(timeout=timeout)
+        except (FutureTimeoutError, CancelledError):
+            future.cancel()
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise TranscriptionTimeout(f"Transcription did not finish within {timeout}s")
+
+    def retry_after(self):
+        # Rough time until the current backlog drains, in whole seconds
+        with self._lock:
+            batches = self._stats['batches']
+            batch_time = self._stats['batch_time_total'] / batches if batches else 1.0
+        backlog_batches = math.ceil(self._pending.qsize() / self.max_batch_size)
+        return max(1, math.ceil(batch_time * backlog_batches / max(1, len(self._workers))))
+
+    def _next_batch(self):
+        # Block for the first request, then keep collecting until the window closes or the batch is full
+        jobs = [self._pending.get()]
+        if jobs[0] is None:
+            return None
+        window_ends = time.monotonic() + self.batch_window
+        while len(jobs) < self.max_batch_size:
+            remaining = window_ends - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                job = self._pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if job is None:
+                self._pending.put(None)
+                break
+            jobs.append(job)
+        return jobs
+
+    def _dispatch(self):
+        while not self._stopping:
+            worker = self._idle_workers.get()
+            if worker is None:
+                break
+            with self._lock:
+                worker.queued = False
+            if not worker.is_alive():
+                continue  # Queued again once it is restarted
+            jobs = self._next_batch()
+            if jobs is None:
+                break
+
+            now = time.monotonic()
+            live = []
+            for job in jobs:
+                # Skip requests whose caller already gave up
+                if now > job.deadline or not job.future.set_running_or_notify_cancel():
+                    if not job.future.done():
+                        job.future.set_exception(TranscriptionTimeout("Expired while queued"))
+                    continue
+                live.append(job)
+
+            if not live:
+                self._release(worker)
+                continue
+
+            with self._lock:
+                self._stats['batches'] += 1
+                self._stats['batched_requests'] += len(live)
+                self._stats['queue_wait_total'] += sum(now - job.enqueued_at for job in live)
+            for job in live:
+                metrics.observe('asr_queue_wait_seconds', now - job.enqueued_at)
+            worker.run(live)
+
+    def _collect(self):
+        # Receives batch results from worker processes and restarts any worker that died
+        while not self._stopping:
+            try:
+                index, status, payload = self._results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if status == 'ready':
+                worker = self._workers[index]
+                worker.ready = True
+                worker.failures = 0
+                worker.load_seconds = payload
+                print(f"ASR worker {index} loaded {self.model} in {payload:.1f}s")
+                continue
+            self._complete(self._workers[index], status, payload)
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for worker in self._workers:
+            if worker.is_alive() or worker.failed or self._stopping:
+                continue
+            if worker.restart_at is None:
+                # Just died: fail its batch and schedule the restart
+                jobs, worker.jobs = worker.jobs, None
+                worker.ready = False
+                worker.failures += 1
+                if jobs is not None:
+                    self._complete(worker, 'error', "ASR worker died", jobs=jobs)
+                if worker.failures > self.max_restarts:
+                    worker.failed = True
+                    print(f"ASR worker {worker.index} died {worker.failures} times in a row, giving up on it")
+                    continue
+                delay = min(self.restart_backoff * 2 ** (worker.failures - 1), MAX_RESTART_BACKOFF)
+                worker.restart_at = now + delay
+                print(f"ASR worker {worker.index} died, restarting in {delay:g}s")
+            elif now >= worker.restart_at:
+                worker.restart_at = None
+                worker.restart()
+                with self._lock:
+                    self._stats['worker_restarts'] += 1
+                self._release(worker)
+
+        if self.healthy and all(worker.failed for worker in self._workers):
+            self.healthy = False
+            print("Every ASR worker failed; transcriptions are refused until the server is restarted")
+            self._fail_pending()
+
+    def _fail_pending(self):
+        while True:
+            try:
+                job = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            if job is not None and not job.future.done():
+                job.future.set_exception(ASRUnavailable("Speech recognition is unavailable"))
+
+    def _release(self, worker):
+        # Hands a worker back to the dispatcher, at most once however many paths finish with it
+        with self._lock:
+            if worker.queued:
+                return
+            worker.queued = True
+        self._idle_workers.put(worker)
+
+    def _complete(self, worker, status, payload, jobs=None):
+        if jobs is None:
+            jobs = worker.jobs
+            if jobs is None:
+                return  # Late result from a worker that was already restarted
+            elapsed = time.monotonic() - worker.started_at
+            with self._lock:
+                self._stats['batch_time_total'] += elapsed
+            metrics.observe('asr_batch_seconds', elapsed, backend=self.backend)
+        worker.jobs = None
+
+        for index, job in enumerate(jobs):
+            if job.future.done():
+                continue
+            if status == 'ok':
+                job.future.set_result(payload[index])
+            else:
+                job.future.set_exception(RuntimeError(payload))
+
+        with self._lock:
+            key = 'completed' if status == 'ok' else 'errors'
+            self._stats[key] += len(jobs)
+        if worker.is_alive():
+            self._release(worker)
+
+    def is_ready(self):
+        """True once at least one worker has the model loaded."""
+        return self.healthy and any(worker.ready for worker in self._workers)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['model'] = self.model
+        stats['backend'] = self.backend
+        stats['started'] = self._started
+        stats['healthy'] = self.healthy
+        stats['workers_failed'] = sum(1 for worker in self._workers if worker.failed)
+        stats['queue_depth'] = self._pending.qsize()
+        stats['queue_size'] = self._pending.maxsize
+        stats['workers'] = len(self._workers)
+        stats['workers_ready'] = sum(1 for worker in self._workers if worker.ready)
+        stats['model_load_seconds'] = [worker.load_seconds for worker in self._workers]
+        stats['worker_memory_bytes'] = [resident_memory(worker.pid) for worker in self._workers]
+        stats['avg_batch_size'] = stats['batched_requests'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def shutdown(self, timeout=5):
+        self._stopping = True
+        if not self._started:
+            return
+        self._idle_workers.put(None)
+        try:
+            self._pending.put_nowait(None)
+        except queue.Full:
+            pass
+        for worker in self._workers:
+            worker.stop(timeout)
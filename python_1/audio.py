@@ -0,0 +1,92 @@
+import io
+import subprocess
+import wave
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+
+try:
+    import av
+except ImportError:  # Optional; without it non-WAV audio is decoded by an ffmpeg process
+    av = None
+
+
+def resample(samples, source_rate, target_rate):
+    """
+    Band-limited resampling of float32 `samples` from `source_rate` to `target_rate`: the spectrum
+    is truncated (or zero-padded) to the new Nyquist frequency, so downsampling doesn't alias
+    content above it into the speech band the way linear interpolation does.
+    """
+    if source_rate == target_rate or len(samples) == 0:
+        return samples.astype(np.float32)
+    length = int(round(len(samples) * target_rate / source_rate))
+    spectrum = np.fft.rfft(samples)
+    bins = length // 2 + 1
+    if bins <= len(spectrum):
+        spectrum = spectrum[:bins]
+    else:
+        spectrum = np.pad(spectrum, (0, bins - len(spectrum)))
+    return (np.fft.irfft(spectrum, n=length) * (length / len(samples))).astype(np.float32)
+
+
+def _decode_wav(data, sample_rate):
+    with wave.open(io.BytesIO(data), 'rb') as wav:
+        width = wav.getsampwidth()
+        channels = wav.getnchannels()
+        rate = wav.getframerate()
+        frames = wav.readframes(wav.getnframes())
+    if width != 2:
+        raise ValueError(f"Unsupported WAV sample width: {width * 8} bits")
+    samples = np.frombuffer(frames, dtype='<i2').astype(np.float32) / 32768.0
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1)
+    return resample(samples, rate, sample_rate)
+
+
+def _decode_av(data, sample_rate):
+    # In-process decoding through PyAV's bundled FFmpeg libraries
+    chunks = []
+    try:
+        with av.open(io.BytesIO(data)) as container:
+            resampler = av.AudioResampler(format='flt', layout='mono', rate=sample_rate)
+            for frame in container.decode(audio=0):
+                chunks.extend(resampled.to_ndarray().reshape(-1) for resampled in resampler.resample(frame))
+            chunks.extend(resampled.to_ndarray().reshape(-1) for resampled in resampler.resample(None))
+    except Exception as e:
+        raise ValueError(f"Could not decode audio: {e}")
+    return np.concatenate(chunks).astype(np.float32) if chunks else np.zeros(0, dtype=np.float32)
+
+
+def _decode_ffmpeg(data, sample_rate):
+    command = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error',
+        '-i', 'pipe:0',
+        '-ac', '1', '-ar', str(sample_rate), '-f', 'f32le',
+        'pipe:1',
+    ]
+    try:
+        process = subprocess.run(command, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    except FileNotFoundError:
+        raise ValueError("ffmpeg was not found, it is needed to decode this audio format")
+    except subprocess.CalledProcessError as e:
+        raise ValueError(f"Could not decode audio: {e.stderr.decode(errors='replace').strip()}")
+    return np.frombuffer(process.stdout, dtype='<f4')
+
+
+def decode_audio(data, sample_rate=SAMPLE_RATE):
+    """
+    Decodes an encoded audio clip (bytes) to mono float32 samples at `sample_rate`.
+
+    Nothing touches the disk: 16-bit PCM WAV is decoded with the standard library, anything else
+    (e.g. the browser's WebM/Opus) in-process with PyAV when it is installed, and otherwise by
+    piping the bytes through an ffmpeg process.
+    """
+    if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
+        try:
+            return _decode_wav(data, sample_rate)
+        except (wave.Error, ValueError):
+            pass  # e.g. float or compressed WAV, let FFmpeg handle it
+    if av is not None:
+        return _decode_av(data, sample_rate)
+    return _decode_ffmpeg(data, sample_rate)
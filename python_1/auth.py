@@ -0,0 +1,211 @@
+import base64
+import hashlib
+import heapq
+import hmac
+import json
+import os
+import re
+import secrets
+import threading
+import time
+import uuid
+
+# Password hashing configuration (can be overridden through the environment). Every hash takes about
+# 128 * n * r bytes of memory and CPU time in proportion; benchmarks/bench_password_hash.py times the options
+password_config = {
+    'n': int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14)),
+    'r': int(os.environ.get('PASSWORD_SCRYPT_R', 8)),
+    'p': int(os.environ.get('PASSWORD_SCRYPT_P', 1)),
+}
+
+# Session token configuration (can be overridden through the environment)
+session_config = {
+    # Signing key; without one every start (of the launcher, see serve.py) signs with a new random key
+    'secret': os.environ.get('AUTH_SECRET') or None,
+    'ttl': int(os.environ.get('AUTH_TOKEN_TTL', 12 * 3600)),
+    'revocation_cache_size': int(os.environ.get('AUTH_REVOCATION_CACHE_SIZE', 10000)),
+}
+
+# Hashes written before scrypt: the unsalted SHA-256 hex digest of the password
+_LEGACY_HASH = re.compile(r"[0-9a-f]{64}")
+
+
+class InvalidToken(Exception):
+    """Raised when a session token is malformed, wrongly signed, expired or revoked."""
+
+
+def _encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class PasswordHasher:
+    """
+    Memory-hard password hashes, stored as "scrypt$<n>$<r>$<p>$<salt>$<hash>" so the cost parameters
+    can be raised later without invalidating existing hashes.
+
+    `verify` also accepts the unsalted SHA-256 hex digests written before, and reports those (and
+    hashes made with other parameters) as outdated so the caller can store a new hash while it still
+    has the password.
+    """
+
+    def __init__(self, n, r, p):
+        if n < 2 or n & (n - 1):
+            raise ValueError(f"PASSWORD_SCRYPT_N must be a power of two, got {n}")
+        self.n = n
+        self.r = r
+        self.p = p
+        self._lock = threading.Lock()
+        self._stats = {'hashes': 0, 'verifications': 0, 'failures': 0, 'legacy': 0, 'seconds_total': 0.0}
+        # Checked against when the username doesn't exist, so that takes as long as a wrong password
+        self._dummy = self.hash(secrets.token_hex(16))
+
+    def _scrypt(self, password, salt, n, r, p):
+        # Room for the 128 * n * r byte working set, which is above OpenSSL's default limit for n >= 2^15
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=32,
+                              maxmem=129 * n * r * p + 2 ** 20)
+
+    def _count(self, started, **values):
+        with self._lock:
+            for key, value in values.items():
+                self._stats[key] += value
+            self._stats['seconds_total'] += time.perf_counter() - started
+
+    def hash(self, password):
+        started = time.perf_counter()
+        salt = secrets.token_bytes(16)
+        digest = self._scrypt(password, salt, self.n, self.r, self.p)
+        self._count(started, hashes=1)
+        return f"scrypt${self.n}${self.r}${self.p}${_encode(salt)}${_encode(digest)}"
+
+    def verify(self, password, stored):
+        """
+        Checks `password` against a stored hash (None for a user that doesn't exist).
+
+        :return: Tuple of (matches, outdated); outdated is True when the hash should be replaced.
+        """
+        started = time.perf_counter()
+        if stored and _LEGACY_HASH.fullmatch(stored):
+            matches = hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+            self._count(started, verifications=1, legacy=1, failures=0 if matches else 1)
+            return matches, True
+
+        matches = outdated = False
+        try:
+            scheme, n, r, p, salt, digest = (stored or self._dummy).split('$')
+            n, r, p = int(n), int(r), int(p)
+            if scheme != 'scrypt':
+                raise ValueError(scheme)
+            matches = hmac.compare_digest(self._scrypt(password, _decode(salt), n, r, p), _decode(digest))
+            outdated = (n, r, p) != (self.n, self.r, self.p)
+        except ValueError:
+            print("Unrecognised password hash format")
+        matches = matches and stored is not None
+        self._count(started, verifications=1, failures=0 if matches else 1)
+        return matches, outdated
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['params'] = {'n': self.n, 'r': self.r, 'p': self.p}
+        return stats
+
+
+class SessionTokens:
+    """
+    Signed, stateless session tokens: "<payload>.<signature>", where the payload is base64url JSON
+    {"sub": adminId, "iat", "exp", "jti"} and the signature its HMAC-SHA256 under `secret`. Checking
+    one needs no database query or shared state, only the revocation cache.
+
+    Tokens ended early by `revoke` are remembered until they expire, but at most
+    `revocation_cache_size` of them: when it is full, the revocation closest to expiring is dropped.
+    """
+
+    def __init__(self, secret, ttl, revocation_cache_size):
+        if secret is None:
+            print("AUTH_SECRET is not set; session tokens are signed with a random key and end on restart")
+            secret = secrets.token_hex(32)
+        self._key = secret.encode()
+        self.ttl = ttl
+        self.revocation_cache_size = revocation_cache_size
+        self._revoked = {}  # jti -> exp
+        self._expiries = []  # heap of (exp, jti) of the revoked tokens
+        self._lock = threading.Lock()
+        self._stats = {'issued': 0, 'verified': 0, 'rejected': 0, 'revoked': 0, 'revocations_dropped': 0}
+
+    def _sign(self, payload):
+        return _encode(hmac.new(self._key, payload.encode('ascii'), hashlib.sha256).digest())
+
+    def issue(self, subject, **claims):
+        """Returns (token, claims) of a new session for `subject` (an adminId)."""
+        now = int(time.time())
+        claims = {'sub': subject, 'iat': now, 'exp': now + self.ttl, 'jti': uuid.uuid4().hex, **claims}
+        payload = _encode(json.dumps(claims, separators=(',', ':')).encode())
+        with self._lock:
+            self._stats['issued'] += 1
+        return f"{payload}.{self._sign(payload)}", claims
+
+    def verify(self, token):
+        """Returns the claims of a valid token, or raises InvalidToken."""
+        try:
+            payload, signature = token.split('.')
+            if not hmac.compare_digest(self._sign(payload), signature):
+                raise InvalidToken("Invalid session token")
+            claims = json.loads(_decode(payload))
+        except (ValueError, TypeError):
+            self._reject()
+            raise InvalidToken("Invalid session token")
+        except InvalidToken:
+            self._reject()
+            raise
+        if claims['exp'] <= time.time():
+            self._reject()
+            raise InvalidToken("Session expired")
+        if claims['jti'] in self._revoked:
+            self._reject()
+            raise InvalidToken("Session ended")
+        with self._lock:
+            self._stats['verified'] += 1
+        return claims
+
+    def verify_header(self, value):
+        """
+        Returns the claims of the Bearer token in an Authorization header value, or None when there
+        is none; raises InvalidToken for an invalid one.
+        """
+        if not value:
+            return None
+        scheme, _, token = value.partition(' ')
+        if scheme.lower() != 'bearer':
+            return None
+        return self.verify(token.strip())
+
+    def _reject(self):
+        with self._lock:
+            self._stats['rejected'] += 1
+
+    def revoke(self, jti, exp):
+        """Ends the session with id `jti` (expiring at `exp`) before it expires."""
+        now = time.time()
+        with self._lock:
+            if exp <= now or jti in self._revoked:
+                return
+            self._revoked[jti] = exp
+            heapq.heappush(self._expiries, (exp, jti))
+            self._stats['revoked'] += 1
+            # Expired tokens are rejected anyway; beyond that, give up the revocation that ends soonest
+            while self._expiries and (self._expiries[0][0] <= now or len(self._revoked) > self.revocation_cache_size):
+                expired, dropped = heapq.heappop(self._expiries)
+                del self._revoked[dropped]
+                if expired > now:
+                    self._stats['revocations_dropped'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['revocation_cache'] = len(self._revoked)
+        stats['ttl'] = self.ttl
+        return stats
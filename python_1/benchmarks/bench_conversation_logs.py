@@ -0,0 +1,122 @@
+"""
+Measures /conversation-logs page fetches against a large history for a single user, comparing
+the keyset query used by the endpoint with the equivalent LIMIT/OFFSET query at increasing depths.
+
+Fills audio_files with synthetic rows for a throwaway user (removed afterwards unless --keep), so
+run it against a development database with migrations/002_audio_files_user_created_index.sql
+applied.
+
+Usage:
+    python benchmarks/bench_conversation_logs.py [--rows 2000000] [--depths 0 1000 100000 1000000]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mysql.connector
+
+from App import db_config, build_conversation_log_query, CONVERSATION_LOG_PAGE_SIZE
+
+INSERT_BATCH = 5000
+
+
+def populate(connection, user_id, rows):
+    cursor = connection.cursor()
+    started_at = datetime(2020, 1, 1)
+    inserted = 0
+    while inserted < rows:
+        count = min(INSERT_BATCH, rows - inserted)
+        placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * count)
+        params = []
+        for i in range(inserted, inserted + count):
+            # A few rows share each second, so ties on created_at are broken by id
+            params.extend((str(uuid.uuid4()), user_id, f"bench/{i}.webm", f"turn on the kitchen light {i}",
+                           started_at + timedelta(seconds=i // 3)))
+        cursor.execute(f"INSERT INTO audio_files (id, user_id, file_path, transcribed_text, created_at) "
+                       f"VALUES {placeholders}", params)
+        connection.commit()
+        inserted += count
+        print(f"\rInserted {inserted}/{rows} rows", end="", flush=True)
+    print()
+    cursor.close()
+
+
+def time_query(connection, query, params, repeats):
+    cursor = connection.cursor(dictionary=True)
+    timings = []
+    for _ in range(repeats):
+        started = time.monotonic()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        timings.append(time.monotonic() - started)
+    cursor.close()
+    return statistics.median(timings), rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keyset vs. offset pagination of the conversation log")
+    parser.add_argument('--rows', type=int, default=2000000, help="Synthetic history rows for the test user")
+    parser.add_argument('--depths', type=int, nargs='+', default=[0, 1000, 10000, 100000, 1000000],
+                        help="Row offsets at which to fetch a page")
+    parser.add_argument('--limit', type=int, default=CONVERSATION_LOG_PAGE_SIZE)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help="Leave the synthetic rows in the database")
+    args = parser.parse_args()
+
+    connection = mysql.connector.connect(**db_config)
+    user_id = str(uuid.uuid4())
+    try:
+        populate(connection, user_id, args.rows)
+        cursor = connection.cursor()
+        cursor.execute("ANALYZE TABLE audio_files")
+        cursor.fetchall()
+
+        query, params = build_conversation_log_query(user_id, args.limit)
+        cursor.execute(f"EXPLAIN {query}", params)
+        columns = [column[0] for column in cursor.description]
+        plan = dict(zip(columns, cursor.fetchone()))
+        print(f"Plan: key={plan.get('key')} rows={plan.get('rows')} extra={plan.get('Extra')}")
+        cursor.close()
+
+        print(f"\n{'depth':>10}{'keyset ms':>12}{'offset ms':>12}")
+        for depth in sorted(depth for depth in args.depths if depth < args.rows):
+            # The keyset cursor for this depth is the row just before it (found once, untimed)
+            position = None
+            if depth:
+                lookup = connection.cursor(dictionary=True)
+                lookup.execute("SELECT id, created_at FROM audio_files WHERE user_id = %s "
+                               "ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET %s", (user_id, depth - 1))
+                row = lookup.fetchone()
+                lookup.close()
+                position = (row['created_at'], row['id'])
+
+            query, params = build_conversation_log_query(user_id, args.limit, cursor=position)
+            keyset_seconds, keyset_rows = time_query(connection, query, params, args.repeats)
+
+            offset_query = ("SELECT id, user_id, transcribed_text, created_at FROM audio_files WHERE user_id = %s "
+                            "ORDER BY created_at DESC, id DESC LIMIT %s OFFSET %s")
+            offset_seconds, offset_rows = time_query(connection, offset_query, (user_id, args.limit + 1, depth),
+                                                     args.repeats)
+            if [row['id'] for row in keyset_rows] != [row['id'] for row in offset_rows]:
+                print(f"Pages differ at depth {depth}")
+            print(f"{depth:>10}{keyset_seconds * 1000:>12.2f}{offset_seconds * 1000:>12.2f}")
+    finally:
+        if not args.keep:
+            cursor = connection.cursor()
+            while True:
+                cursor.execute("DELETE FROM audio_files WHERE user_id = %s LIMIT 50000", (user_id,))
+                connection.commit()
+                if cursor.rowcount == 0:
+                    break
+            cursor.close()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
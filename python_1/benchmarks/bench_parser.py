@@ -0,0 +1,77 @@
+"""
+Checks the command parser against the golden corpus and times it against the original
+substring-scanning implementation.
+
+Usage:
+    python benchmarks/bench_parser.py [--iterations 20000]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from command_parser import parse_commands, process_text
+
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser_golden.json')
+
+
+def legacy_process_text(transcribed_text):
+    # The previous process_text: one substring scan per keyword, last match wins, JSON string result
+    room = None
+    intent = None
+    intensity = None
+    intensity_keywords = {
+        "low": ["low", "soft", "decrease"],
+        "high": ["high", "bright", "increase"]
+    }
+    text = transcribed_text.lower()
+    for keyword in ["master", "kitchen", "guest", "hall"]:
+        if keyword in text:
+            room = keyword
+    for keyword in ["on", "off"]:
+        if keyword in text:
+            intent = keyword
+    for intensity_level, keywords in intensity_keywords.items():
+        if any(keyword in text for keyword in keywords):
+            intensity = intensity_level
+            intent = "on"
+    if intent == "on" and intensity is None:
+        intensity = "low"
+    return json.dumps({"room": room, "intent": intent, "intensity": intensity, "text": transcribed_text}, indent=4)
+
+
+def check_golden(cases):
+    failures = 0
+    for case in cases:
+        actual = parse_commands(case['text'])
+        if actual != case['commands']:
+            failures += 1
+            print(f"FAIL {case['text']!r}\n    expected {case['commands']}\n    got      {actual}")
+    print(f"Golden corpus: {len(cases) - failures}/{len(cases)} passed")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Command parser golden check and micro-benchmark")
+    parser.add_argument('--iterations', type=int, default=20000)
+    args = parser.parse_args()
+
+    with open(GOLDEN) as golden:
+        cases = json.load(golden)
+    failures = check_golden(cases)
+
+    texts = [case['text'] for case in cases]
+    for name, function in (("legacy (json.loads)", lambda text: json.loads(legacy_process_text(text))),
+                           ("process_text", process_text)):
+        seconds = timeit.timeit(lambda: [function(text) for text in texts], number=args.iterations)
+        per_call = seconds / (args.iterations * len(texts)) * 1e6
+        print(f"{name:<22}{per_call:8.2f} us/utterance")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Times password hashing with a range of scrypt cost parameters on this machine, to choose
+PASSWORD_SCRYPT_N/R/P for a login latency budget, and the session token checks every request pays.
+
+Each hash needs about 128 * n * r bytes of memory, per concurrent login. Pick the largest n whose time
+fits the budget with the expected number of logins in flight.
+
+Usage:
+    python benchmarks/bench_password_hash.py [--budget-ms 100] [--log-n 12 13 14 15 16 17] [--r 8] [--p 1]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth import PasswordHasher, SessionTokens
+
+
+def time_call(function, repeats):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=100, help="Longest acceptable hash time")
+    parser.add_argument('--log-n', type=int, nargs='+', default=[12, 13, 14, 15, 16, 17], help="log2 of n to try")
+    parser.add_argument('--r', type=int, default=8)
+    parser.add_argument('--p', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'n':>8} {'r':>3} {'p':>3} {'memory':>10} {'hash ms':>10}")
+    chosen = None
+    for log_n in args.log_n:
+        n = 2 ** log_n
+        hasher = PasswordHasher(n, args.r, args.p)
+        seconds = time_call(lambda: hasher.hash("correct horse battery staple"), args.repeats)
+        print(f"{n:>8} {args.r:>3} {args.p:>3} {128 * n * args.r / 2 ** 20:>8.0f}MB {seconds * 1000:>10.1f}")
+        if seconds * 1000 <= args.budget_ms:
+            chosen = n
+    if chosen:
+        print(f"\nWithin {args.budget_ms:g} ms: PASSWORD_SCRYPT_N={chosen} PASSWORD_SCRYPT_R={args.r} "
+              f"PASSWORD_SCRYPT_P={args.p}")
+    else:
+        print(f"\nNo setting tried fits within {args.budget_ms:g} ms")
+
+    tokens = SessionTokens('benchmark', 3600, 1000)
+    token, _ = tokens.issue('00000000-0000-0000-0000-000000000000')
+    seconds = time_call(lambda: [tokens.verify(token) for _ in range(10000)], 3) / 10000
+    print(f"Session token check: {seconds * 1e6:.1f} µs")
+
+
+if __name__ == '__main__':
+    main()
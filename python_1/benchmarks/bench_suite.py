@@ -0,0 +1,402 @@
+"""
+Benchmark suite for the voice command pipeline and the profile routes: measures p50/p95/p99
+latency and throughput of /transcribe, process_text, /register, /edit-profile and /user-details at
+each requested concurrency, and writes the results as JSON so runs on different commits can be
+compared.
+
+Everything runs in this process through Flask's test client, so no server, network or internet
+access is involved. By default the database is the app's embedded SQLite backend, in a temporary
+directory; --db mysql uses the database in App.db_config instead, and removes the rows it created
+afterwards. /transcribe needs the Whisper model in the local Hugging Face cache. It is sent the
+recordings of the labelled command corpus (benchmarks/corpus, see compare_backends.py), and the
+results include the share of them recognised as the expected command. Another corpus, or a
+directory of unlabelled WAV files, can be given with --clips; synthetic tones are only used while
+the corpus has no recordings. Every request gets slightly different audio, so the transcript cache
+never answers it.
+
+Usage:
+    python benchmarks/bench_suite.py --output before.json
+    python benchmarks/bench_suite.py --concurrency 1 4 16 --requests 500 --scenarios register user_details
+    python benchmarks/bench_suite.py --compare before.json after.json [--threshold 10]
+
+App settings can be changed through its usual environment variables, e.g. ASR_MODEL=tiny.
+"""
+import argparse
+import contextlib
+import glob
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import wave
+from datetime import datetime, timezone
+
+import numpy as np
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+
+from command_parser import process_text
+from load_test import percentile, synthetic_clip
+
+# Labelled command recordings /transcribe is sent by default (see compare_backends.py)
+CORPUS = os.path.join(BENCHMARKS, 'corpus')
+SCENARIOS = ['process_text', 'user_details', 'register', 'edit_profile', 'transcribe']
+ROOMS = ['kitchen', 'master', 'guest', 'hall']
+
+
+def load_phrases():
+    with open(os.path.join(BENCHMARKS, 'parser_golden.json')) as golden:
+        return [case['text'] for case in json.load(golden)]
+
+
+def load_clips(directory, fallback=False):
+    """
+    Returns the clips as {'audio': (float32 samples, rate), 'expected': (room, intent, intensity)}: the
+    recorded entries of the corpus.json manifest in `directory`, or every WAV in it, unlabelled
+    (expected None), when there is no manifest. With `fallback`, a directory without recordings gives
+    synthetic clips instead of an error.
+    """
+    manifest_path = os.path.join(directory, 'corpus.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest:
+            entries = json.load(manifest)
+        entries = [entry for entry in entries if os.path.exists(os.path.join(directory, entry['file']))]
+    else:
+        entries = [{'file': os.path.basename(path)} for path in sorted(glob.glob(os.path.join(directory, '*.wav')))]
+
+    clips = []
+    for entry in entries:
+        with open(os.path.join(directory, entry['file']), 'rb') as clip:
+            audio = read_wav(clip.read())
+        expected = (entry['room'], entry['intent'], entry['intensity']) if 'intent' in entry else None
+        clips.append({'audio': audio, 'expected': expected})
+    if clips:
+        return clips
+    if not fallback:
+        raise SystemExit(f"No .wav clips in {directory}")
+    print(f"No recordings in {directory} yet (see benchmarks/import_corpus.py); /transcribe gets synthetic tones, "
+          f"which measure latency but not recognition", file=sys.stderr)
+    return [{'audio': read_wav(synthetic_clip(seconds)), 'expected': None} for seconds in (1.0, 1.5, 2.0, 3.0)]
+
+
+def read_wav(data):
+    with wave.open(io.BytesIO(data)) as wav:
+        if wav.getsampwidth() != 2:
+            raise SystemExit("Clips must be 16-bit PCM WAV")
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2').astype(np.float32) / 32768
+        if wav.getnchannels() > 1:
+            samples = samples.reshape(-1, wav.getnchannels()).mean(axis=1)
+        return samples, wav.getframerate()
+
+
+def encode_clip(clip, index):
+    # One LSB of seeded noise makes each request's audio unique without audibly changing it
+    samples, sample_rate = clip
+    noise = np.random.default_rng(index).integers(-1, 2, len(samples))
+    pcm = np.clip(samples * 32767 + noise, -32768, 32767).astype('<i2')
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(pcm.tobytes())
+    return buffer.getvalue()
+
+
+def preferences(index):
+    return [{'room': room, 'intent': (index + offset) % 2, 'intensity': (index // 2 + offset) % 2}
+            for offset, room in enumerate(ROOMS)]
+
+
+class Fixture:
+    """The households the scenarios work on, registered through the app itself."""
+
+    def __init__(self, App, client, households):
+        self.App = App
+        self.client = client
+        self.run_id = uuid.uuid4().hex[:8]
+        self.admin_ids = []
+        for index in range(households):
+            response = client.post('/register', json={
+                'name': f"Bench {index}", 'username': f"bench-{self.run_id}-{index}", 'password': 'bench',
+                'houseAddress': "1 Benchmark Road", 'preferences': preferences(index),
+            })
+            if response.status_code != 201:
+                raise SystemExit(f"Could not register benchmark households: {response.get_json()}")
+            self.admin_ids.append(response.get_json()['adminId'])
+        placeholders = ", ".join(["%s"] * len(self.admin_ids))
+        rows = App.execute_query(f"SELECT userId FROM users WHERE adminId IN ({placeholders})", self.admin_ids)
+        self.user_ids = [row['userId'] for row in rows]
+
+    def cleanup(self):
+        # Households registered by the register scenario share the run id in their usernames
+        rows = self.App.execute_query("SELECT adminId FROM admin WHERE username LIKE %s",
+                                      (f"bench-{self.run_id}-%",))
+        admin_ids = [row['adminId'] for row in rows]
+        for start in range(0, len(admin_ids), 500):
+            batch = admin_ids[start:start + 500]
+            placeholders = ", ".join(["%s"] * len(batch))
+            self.App.execute_commit(f"DELETE FROM audio_files WHERE user_id IN "
+                                    f"(SELECT userId FROM users WHERE adminId IN ({placeholders}))", batch)
+            self.App.execute_commit(f"DELETE FROM admin WHERE adminId IN ({placeholders})", batch)
+
+
+def scenario_calls(name, App, client, fixture, phrases, clips, recognised):
+    """
+    Returns (prepare, call) for the scenario: call(prepare(index)) makes its request number `index`
+    and returns the response status. Only `call` is timed. Transcriptions of labelled clips append
+    whether the expected command was recognised to `recognised`.
+    """
+    users = fixture.user_ids
+    prepare = int
+
+    if name == 'process_text':
+        def call(index):
+            App.process_text(phrases[index % len(phrases)])
+            return 200
+    elif name == 'user_details':
+        def call(index):
+            return client.get(f"/user-details/{users[index % len(users)]}").status_code
+    elif name == 'register':
+        def call(index):
+            return client.post('/register', json={
+                'name': f"Bench {index}", 'username': f"bench-{fixture.run_id}-r{uuid.uuid4().hex}",
+                'password': 'bench', 'houseAddress': "1 Benchmark Road", 'preferences': preferences(index),
+            }).status_code
+    elif name == 'edit_profile':
+        def call(index):
+            return client.put(f"/edit-profile/{users[index % len(users)]}", data={
+                'name': f"Bench {index}", 'preferences': json.dumps(preferences(index)),
+            }).status_code
+    elif name == 'transcribe':
+        def prepare(index):
+            clip = clips[index % len(clips)]
+            return index, clip['expected'], encode_clip(clip['audio'], index)
+
+        def call(prepared):
+            index, expected, audio = prepared
+            response = client.post(f"/transcribe/{users[index % len(users)]}",
+                                   data={'audioFile': (io.BytesIO(audio), 'command.wav')})
+            if response.status_code == 200 and expected is not None:
+                # Parsed without the household's defaults, the way the corpus labels were made
+                command = process_text(response.get_json()['text'])
+                recognised.append((command['room'], command['intent'], command['intensity']) == expected)
+            return response.status_code
+    else:
+        raise ValueError(f"Unknown scenario {name}")
+    return prepare, call
+
+
+def measure(prepare, call, concurrency, requests, warmup, first_index):
+    """Runs `requests` calls on `concurrency` threads after `warmup` untimed ones and summarizes them."""
+    for index in range(warmup):
+        call(prepare(first_index + index))
+    first_index += warmup
+
+    latencies = [None] * requests
+    statuses = {}
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker():
+        while True:
+            index = next(counter)
+            if index >= requests:
+                return
+            prepared = prepare(first_index + index)
+            started = time.perf_counter()
+            try:
+                status = call(prepared)
+            except Exception as e:
+                status = type(e).__name__
+            latencies[index] = time.perf_counter() - started
+            with lock:
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+
+    errors = sum(count for status, count in statuses.items() if not isinstance(status, int) or status >= 400)
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'duration': duration,
+        'throughput': requests / duration,
+        'mean_ms': sum(latencies) / len(latencies) * 1000,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': max(latencies) * 1000,
+        'statuses': {str(status): count for status, count in sorted(statuses.items(), key=str)},
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=BENCHMARKS).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain'], capture_output=True, text=True,
+                                    cwd=BENCHMARKS).stdout.strip())
+        return commit or None, dirty
+    except OSError:
+        return None, None
+
+
+def run(args):
+    # Offline, and with everything the app writes (recordings, snapshots) kept out of the working tree
+    os.environ.setdefault('HF_HUB_OFFLINE', '1')
+    os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+    # The first transcription waits for the model to load
+    os.environ.setdefault('ASR_REQUEST_TIMEOUT', '600')
+    original_directory = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='bench-suite-')
+    os.chdir(workdir)
+
+    # Read by the storage configuration when the app is imported
+    os.environ['DB_BACKEND'] = args.db
+    if args.db == 'sqlite':
+        os.environ['DB_SQLITE_PATH'] = os.path.join(workdir, 'bench.sqlite3')
+
+    import App
+
+    phrases = load_phrases()
+    clips = load_clips(args.clips or CORPUS, fallback=not args.clips) if 'transcribe' in args.scenarios else []
+    labelled = any(clip['expected'] is not None for clip in clips)
+    client = App.app.test_client()
+    commit, dirty = git_revision()
+    output = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'label': args.label,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'db': args.db,
+            'asr_model': App.asr_scheduler.model,
+            'asr_backend': App.asr_scheduler.backend,
+            'households': args.households,
+            'clips': (args.clips or CORPUS) if labelled or args.clips else 'synthetic',
+        },
+        'results': [],
+    }
+
+    # The routes print as they go; keep that out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        fixture = Fixture(App, client, args.households)
+        try:
+            next_index = 0
+            for name in args.scenarios:
+                recognised = []
+                prepare, call = scenario_calls(name, App, client, fixture, phrases, clips, recognised)
+                for concurrency in args.concurrency:
+                    recognised.clear()
+                    result = {'scenario': name,
+                              **measure(prepare, call, concurrency, args.requests, args.warmup, next_index)}
+                    next_index += args.warmup + args.requests
+                    if recognised:
+                        # Share of the successful transcriptions of labelled clips that gave the expected command
+                        result['accuracy'] = sum(recognised) / len(recognised)
+                    output['results'].append(result)
+                    print(format_row(result), file=sys.stderr)
+                    if 'accuracy' in result:
+                        print(f"{'':<12}{'':<14}recognised {result['accuracy']:.1%} of the commands",
+                              file=sys.stderr)
+        finally:
+            App.shutdown_audio_storage()
+            if args.db == 'mysql':
+                fixture.cleanup()
+            App.asr_scheduler.shutdown()
+            os.chdir(original_directory)
+            shutil.rmtree(workdir, ignore_errors=True)
+    return output
+
+
+def format_row(result, label=''):
+    return (f"{label:<12}{result['scenario']:<14}{result['concurrency']:>6}{result['requests']:>8}{result['errors']:>8}"
+            f"{result['throughput']:>10.1f}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}{result['p99_ms']:>10.2f}")
+
+
+HEADER = (f"{'run':<12}{'scenario':<14}{'conc':>6}{'reqs':>8}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}")
+
+
+def compare(paths, threshold):
+    """
+    Prints the runs side by side, with every run after the first compared against it. Returns
+    whether any scenario's p95 or throughput got worse by more than `threshold` percent.
+    """
+    runs = []
+    for path in paths:
+        with open(path) as saved:
+            runs.append(json.load(saved))
+    baseline = {(result['scenario'], result['concurrency']): result for result in runs[0]['results']}
+
+    print(HEADER + f"{'p95 change':>12}{'req/s change':>14}")
+    regressed = False
+    for run_result in runs:
+        label = run_result['meta'].get('label') or (run_result['meta'].get('commit') or '?')[:10]
+        for result in run_result['results']:
+            row = format_row(result, label)
+            base = baseline.get((result['scenario'], result['concurrency']))
+            if base is not None and run_result is not runs[0]:
+                p95_change = (result['p95_ms'] / base['p95_ms'] - 1) * 100 if base['p95_ms'] else 0
+                throughput_change = (result['throughput'] / base['throughput'] - 1) * 100 if base['throughput'] else 0
+                worse = p95_change > threshold or throughput_change < -threshold
+                regressed = regressed or worse
+                row += f"{p95_change:>+11.1f}%{throughput_change:>+13.1f}%" + ("  REGRESSION" if worse else "")
+            print(row)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the voice command pipeline and the profile routes")
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8], help="Client threads; one run each")
+    parser.add_argument('--requests', type=int, default=200, help="Timed requests per scenario and concurrency")
+    parser.add_argument('--warmup', type=int, default=5, help="Untimed requests before each run")
+    parser.add_argument('--households', type=int, default=100, help="Households registered before the runs")
+    parser.add_argument('--db', choices=['sqlite', 'mysql'], default='sqlite')
+    parser.add_argument('--clips', help="Labelled corpus, or directory of 16-bit WAV command recordings "
+                                        "(default: benchmarks/corpus)")
+    parser.add_argument('--label', help="Name for this run in comparisons (default: the commit)")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help="Compare saved results against the first and exit (status 1 on regressions)")
+    parser.add_argument('--threshold', type=float, default=10,
+                        help="Percentage by which p95 or throughput may get worse before --compare flags it")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare, args.threshold) else 0)
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    if args.clips:
+        args.clips = os.path.abspath(args.clips)
+    print(HEADER, file=sys.stderr)
+    output = run(args)
+    if output_path:
+        with open(output_path, 'w') as saved:
+            json.dump(output, saved, indent=4)
+    else:
+        print(json.dumps(output, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Compares ASR inference backends on a fixed local audio corpus, measuring latency and whether
+process_text still extracts the right command from each transcription.
+
+The corpus directory holds the audio clips plus a corpus.json manifest listing the phrase spoken in
+each clip and the command expected from it:
+
+    [
+        {"file": "kitchen_on.wav", "text": "Turn on the kitchen light", "room": "kitchen", "intent": "on",
+         "intensity": "low"},
+        {"file": "hall_off.wav", "text": "Turn off the lights in the hall", "room": "hall", "intent": "off",
+         "intensity": null}
+    ]
+
+benchmarks/corpus holds the manifest of the default corpus; its clips are recordings of the phrases,
+added with import_corpus.py.
+
+With --preprocess every backend is also evaluated on the clips as the app queues them after
+preprocessing (see preprocess.py), reported as "<backend>+pre" along with the audio it had to transcribe.
+--audio-only just reports how much audio preprocessing cuts from each clip, without loading a model.
+
+Usage:
+    python benchmarks/compare_backends.py --model small --backends transformers int8 onnx
+    python benchmarks/compare_backends.py --model small --backends int8 --preprocess
+    python benchmarks/compare_backends.py --audio-only
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+
+from asr import BACKENDS, load_pipeline, resolve_model, resident_memory
+from audio import decode_audio, SAMPLE_RATE
+from command_parser import process_text
+from preprocess import preprocess_config, AudioPreprocessor
+
+
+def load_corpus(corpus_dir):
+    with open(os.path.join(corpus_dir, 'corpus.json')) as manifest:
+        entries = json.load(manifest)
+    clips = []
+    for entry in entries:
+        path = os.path.join(corpus_dir, entry['file'])
+        if not os.path.exists(path):
+            print(f"Skipping missing clip {path}")
+            continue
+        clips.append({**entry, 'path': path})
+    return clips
+
+
+def decode_corpus(clips):
+    """Adds the decoded samples of every clip, and the samples left after preprocessing."""
+    preprocessor = AudioPreprocessor(**{**preprocess_config, 'enabled': True})
+    for clip in clips:
+        with open(clip['path'], 'rb') as audio:
+            clip['samples'] = decode_audio(audio.read())
+        clip['preprocessed'] = preprocessor.process(clip['samples'])
+
+
+def report_audio(clips):
+    """Prints the audio every clip has before and after preprocessing; returns the share cut overall."""
+    print(f"{'clip':<28}{'audio s':>10}{'kept s':>10}{'cut':>8}")
+    for clip in clips:
+        before, after = len(clip['samples']) / SAMPLE_RATE, len(clip['preprocessed']) / SAMPLE_RATE
+        print(f"{clip['file']:<28}{before:>10.2f}{after:>10.2f}{1 - after / before:>8.0%}")
+    before = sum(len(clip['samples']) for clip in clips)
+    after = sum(len(clip['preprocessed']) for clip in clips)
+    print(f"{'total':<28}{before / SAMPLE_RATE:>10.2f}{after / SAMPLE_RATE:>10.2f}{1 - after / before:>8.0%}")
+    return 1 - after / before
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def evaluate(backend, model, clips, repeats, intra_op_threads, inter_op_threads, samples=None):
+    """
+    Transcribes every clip with `backend`; from its file, or from its `samples` key (see decode_corpus)
+    when one is given.
+    """
+    def clip_input(clip):
+        return clip['path'] if samples is None else {'raw': clip[samples], 'sampling_rate': SAMPLE_RATE}
+
+    started = time.monotonic()
+    whisper = load_pipeline(model, backend, intra_op_threads, inter_op_threads)
+    load_seconds = time.monotonic() - started
+
+    # One untimed call so lazy initialisation doesn't count against the first clip
+    whisper(clip_input(clips[0]))
+
+    latencies = []
+    correct = 0
+    failures = []
+    for clip in clips:
+        for _ in range(repeats):
+            started = time.monotonic()
+            text = whisper(clip_input(clip))['text']
+            latencies.append(time.monotonic() - started)
+
+        command = process_text(text)
+        expected = (clip.get('room'), clip.get('intent'), clip.get('intensity'))
+        actual = (command['room'], command['intent'], command['intensity'])
+        if actual == expected:
+            correct += 1
+        else:
+            failures.append({'file': clip['file'], 'text': text, 'expected': expected, 'actual': actual})
+
+    return {
+        'backend': backend if samples != 'preprocessed' else f"{backend}+pre",
+        'model': model,
+        'load_seconds': load_seconds,
+        'memory_bytes': resident_memory(),
+        'latency_mean': statistics.mean(latencies),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p95': percentile(latencies, 95),
+        'accuracy': correct / len(clips),
+        'audio_seconds': sum(len(clip[samples]) for clip in clips) / SAMPLE_RATE if samples else None,
+        'failures': failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ASR backends for accuracy and latency")
+    parser.add_argument('--corpus', default=os.path.join(BENCHMARKS, 'corpus'))
+    parser.add_argument('--model', default='medium', help="Whisper size or model id")
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument('--repeats', type=int, default=3, help="Timed transcriptions per clip")
+    parser.add_argument('--intra-op-threads', type=int, default=0)
+    parser.add_argument('--inter-op-threads', type=int, default=0)
+    parser.add_argument('--preprocess', action='store_true',
+                        help="Also evaluate every backend on the preprocessed clips")
+    parser.add_argument('--audio-only', action='store_true',
+                        help="Only report the audio preprocessing cuts from each clip; no model is loaded")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    clips = load_corpus(args.corpus)
+    if not clips:
+        parser.error(f"No clips found in {args.corpus}; add them with benchmarks/import_corpus.py")
+
+    if args.audio_only:
+        decode_corpus(clips)
+        report_audio(clips)
+        return
+
+    # Both variants are transcribed from the same decoded samples, so only the preprocessing differs
+    variants = ['samples', 'preprocessed'] if args.preprocess else [None]
+    if args.preprocess:
+        decode_corpus(clips)
+
+    model = resolve_model(args.model)
+    results = []
+    for backend in args.backends:
+        for samples in variants:
+            print(f"Evaluating {backend}{' on preprocessed audio' if samples == 'preprocessed' else ''} "
+                  f"on {len(clips)} clips...")
+            results.append(evaluate(backend, model, clips, args.repeats, args.intra_op_threads,
+                                    args.inter_op_threads, samples))
+
+    print(f"\n{'backend':<18}{'load s':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'accuracy':>10}{'audio s':>10}")
+    for result in results:
+        audio_seconds = f"{result['audio_seconds']:.1f}" if result['audio_seconds'] is not None else '-'
+        print(f"{result['backend']:<18}{result['load_seconds']:>8.1f}{result['latency_mean'] * 1000:>10.0f}"
+              f"{result['latency_p50'] * 1000:>10.0f}{result['latency_p95'] * 1000:>10.0f}{result['accuracy']:>10.1%}"
+              f"{audio_seconds:>10}")
+        for failure in result['failures']:
+            print(f"    {failure['file']}: {failure['text']!r} -> {failure['actual']}, expected {failure['expected']}")
+
+    # The fastest backend that parses commands at least as well as the first (reference) backend
+    reference = results[0]['accuracy']
+    eligible = [result for result in results if result['accuracy'] >= reference]
+    best = min(eligible, key=lambda result: result['latency_p50'])
+    print(f"\nFastest backend without accuracy loss: {best['backend']}")
+
+    if args.preprocess:
+        for raw, preprocessed in zip(results[::2], results[1::2]):
+            print(f"{raw['backend']}: preprocessing cuts {1 - preprocessed['audio_seconds'] / raw['audio_seconds']:.0%} "
+                  f"of the audio and p50 latency by {1 - preprocessed['latency_p50'] / raw['latency_p50']:.0%}, "
+                  f"accuracy {preprocessed['accuracy'] - raw['accuracy']:+.1%}")
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'model': model, 'clips': len(clips), 'results': results}, output, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+Adds recordings to the benchmark corpus (see compare_backends.py). Every entry of corpus.json has the
+phrase to say in its "text"; record each one, in any format the app accepts (WAV, WebM, M4A...), name
+the recording after the entry's file with any extension (kitchen_on.m4a for kitchen_on.wav) and import
+the directory. Recordings are stored as 16 kHz 16-bit mono WAV, the format the benchmarks read.
+
+Usage:
+    python benchmarks/import_corpus.py            # lists the phrases that have no clip yet
+    python benchmarks/import_corpus.py ~/recordings [--corpus benchmarks/corpus] [--overwrite]
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import wave
+
+import numpy as np
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS))
+
+from audio import decode_audio, SAMPLE_RATE
+
+
+def write_wav(path, samples):
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes((np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import recordings of the corpus phrases")
+    parser.add_argument('recordings', nargs='?', help="Directory of recordings named after the corpus files")
+    parser.add_argument('--corpus', default=os.path.join(BENCHMARKS, 'corpus'))
+    parser.add_argument('--overwrite', action='store_true', help="Replace clips that are already in the corpus")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.corpus, 'corpus.json')) as manifest:
+        entries = json.load(manifest)
+
+    missing = []
+    for entry in entries:
+        target = os.path.join(args.corpus, entry['file'])
+        if os.path.exists(target) and not args.overwrite:
+            continue
+        name = os.path.splitext(entry['file'])[0]
+        sources = sorted(glob.glob(os.path.join(glob.escape(args.recordings), f"{name}.*"))) if args.recordings else []
+        if not sources:
+            missing.append(entry)
+            continue
+        with open(sources[0], 'rb') as recording:
+            samples = decode_audio(recording.read())
+        write_wav(target, samples)
+        print(f"{entry['file']}: {len(samples) / SAMPLE_RATE:.1f}s from {sources[0]}")
+
+    print(f"{len(entries) - len(missing)} of {len(entries)} clips in {args.corpus}")
+    for entry in missing:
+        print(f"    missing {entry['file']}: \"{entry['text']}\"")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Load test for comparing serving modes: keeps a number of /transcribe uploads in flight while
+other clients poll the cheap read routes, and reports latency percentiles and throughput of both.
+
+Run it once against each mode with the same arguments, e.g.
+
+    python App.py                                   # threaded Flask server
+    python benchmarks/load_test.py --user-id <userId> --admin-id <adminId> --label flask --output flask.json
+
+    uvicorn asgi:application --port 5000            # ASGI mode
+    python benchmarks/load_test.py --user-id <userId> --admin-id <adminId> --label asgi --output asgi.json
+
+    python benchmarks/load_test.py --compare flask.json asgi.json
+"""
+import argparse
+import http.client
+import io
+import json
+import math
+import os
+import threading
+import time
+import uuid
+import wave
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def synthetic_clip(seconds=2.0, sample_rate=16000):
+    # A tone with a little noise: enough to exercise decoding and the recogniser end to end
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = 0.2 * np.sin(2 * np.pi * 220 * t) + 0.01 * np.random.default_rng(0).standard_normal(len(t))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((samples * 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def multipart(field, filename, data):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            counts = self.statuses.setdefault(name, {})
+            counts[status] = counts.get(status, 0) + 1
+
+    def summary(self, duration):
+        result = {}
+        for name, latencies in self.latencies.items():
+            result[name] = {
+                'requests': len(latencies),
+                'throughput': len(latencies) / duration,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'statuses': {str(status): count for status, count in sorted(self.statuses[name].items())},
+            }
+        return result
+
+
+def client_loop(base_url, requests, recorder, deadline):
+    # One keep-alive connection per client, cycling through its requests until the deadline
+    parts = urlsplit(base_url)
+    connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=300)
+    index = 0
+    while time.monotonic() < deadline:
+        name, method, path, body, headers = requests[index % len(requests)]
+        index += 1
+        started = time.monotonic()
+        try:
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            status = 'error'
+            connection.close()
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=300)
+        recorder.record(name, time.monotonic() - started, status)
+    connection.close()
+
+
+def run(args):
+    clip = open(args.audio, 'rb').read() if args.audio else synthetic_clip()
+    body, content_type = multipart('audioFile', os.path.basename(args.audio or 'synthetic.wav'), clip)
+    transcribe = [('transcribe', 'POST', f"/transcribe/{args.user_id}", body, {'Content-Type': content_type})]
+    cheap = [
+        ('user-details', 'GET', f"/user-details/{args.user_id}", None, {}),
+        ('conversation-logs', 'GET', f"/conversation-logs/{args.user_id}", None, {}),
+    ]
+    if args.admin_id:
+        cheap.append(('users', 'GET', f"/users/{args.admin_id}", None, {}))
+
+    recorder = Recorder()
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=client_loop, args=(args.base_url, transcribe, recorder, deadline))
+               for _ in range(args.transcribe_concurrency)]
+    threads += [threading.Thread(target=client_loop, args=(args.base_url, cheap[i % len(cheap):] + cheap[:i % len(cheap)],
+                                                           recorder, deadline))
+                for i in range(args.concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - started
+
+    return {
+        'label': args.label,
+        'base_url': args.base_url,
+        'duration': duration,
+        'concurrency': args.concurrency,
+        'transcribe_concurrency': args.transcribe_concurrency,
+        'routes': recorder.summary(duration),
+    }
+
+
+def print_results(results):
+    print(f"\n{'mode':<10}{'route':<20}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}  statuses")
+    for result in results:
+        for route, stats in sorted(result['routes'].items()):
+            print(f"{result['label']:<10}{route:<20}{stats['requests']:>10}{stats['throughput']:>10.1f}"
+                  f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}  {stats['statuses']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the API while transcriptions are in flight")
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--user-id', help="Existing userId to transcribe for and read")
+    parser.add_argument('--admin-id', help="Existing adminId for /users")
+    parser.add_argument('--audio', help="Clip to upload (default: a synthetic 2 s WAV)")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to run")
+    parser.add_argument('--concurrency', type=int, default=50, help="Clients polling the cheap routes")
+    parser.add_argument('--transcribe-concurrency', type=int, default=8, help="Transcriptions kept in flight")
+    parser.add_argument('--label', default='run', help="Name of the serving mode under test")
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS', help="Print saved results side by side and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        results = []
+        for path in args.compare:
+            with open(path) as saved:
+                results.append(json.load(saved))
+        print_results(results)
+        return
+
+    if not args.user_id:
+        parser.error("--user-id is required")
+    result = run(args)
+    print_results([result])
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=4)
+
+
+if __name__ == '__main__':
+    main()
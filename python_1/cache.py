@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Transcription cache configuration (can be overridden through the environment)
+transcript_cache_config = {
+    'max_entries': int(os.environ.get('TRANSCRIPT_CACHE_SIZE', 1024)),
+    'ttl': float(os.environ.get('TRANSCRIPT_CACHE_TTL', 24 * 3600)),
+    # Optional on-disk tier that survives restarts; disabled when unset
+    'directory': os.environ.get('TRANSCRIPT_CACHE_DIR'),
+}
+
+# Profile cache configuration for /user-details and /users (can be overridden through the environment)
+profile_cache_config = {
+    'max_entries': int(os.environ.get('PROFILE_CACHE_SIZE', 4096)),
+    'ttl': float(os.environ.get('PROFILE_CACHE_TTL', 300)),
+}
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe in-memory cache holding at most `max_entries` items for up to `ttl` seconds each;
+    the least recently used item is evicted first.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key, _MISSING)
+            if item is not _MISSING and item[0] < time.monotonic():
+                del self._items[key]
+                self._stats['expirations'] += 1
+                item = _MISSING
+            if item is _MISSING:
+                self._stats['misses'] += 1
+                return default
+            self._items.move_to_end(key)
+            self._stats['hits'] += 1
+            return item[1]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._items[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._items)
+        stats['max_entries'] = self.max_entries
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+def audio_key(samples, namespace):
+    """
+    Content hash of decoded audio (a NumPy array) or raw bytes, scoped to `namespace`: everything besides
+    the audio that shaped the transcript, e.g. the model and the preprocessing settings.
+    """
+    data = samples if isinstance(samples, bytes) else samples.tobytes()
+    digest = hashlib.blake2b(data, digest_size=16)
+    digest.update(namespace.encode())
+    return digest.hexdigest()
+
+
+class TranscriptCache:
+    """
+    Content-addressed cache of transcriptions and their parsed commands, so repeated or retried
+    uploads of the same audio skip the model. Entries live in an in-memory LRU and, when
+    `directory` is set, also as small JSON files that survive restarts.
+    """
+
+    def __init__(self, max_entries, ttl, directory=None):
+        self.memory = LRUCache(max_entries, ttl)
+        self.ttl = ttl
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._stats = {'disk_hits': 0, 'disk_misses': 0, 'disk_writes': 0, 'disk_errors': 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None or not self.directory:
+            return entry
+
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path) as cached:
+                entry = json.load(cached)
+        except (OSError, ValueError):
+            with self._lock:
+                self._stats['disk_misses'] += 1
+            return None
+
+        with self._lock:
+            self._stats['disk_hits'] += 1
+        self.memory.set(key, entry)
+        return entry
+
+    def set(self, key, text, command):
+        entry = {'text': text, 'command': command}
+        self.memory.set(key, entry)
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so readers never see a partial entry
+            temporary = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary, 'w') as cached:
+                json.dump(entry, cached)
+            os.replace(temporary, path)
+            with self._lock:
+                self._stats['disk_writes'] += 1
+        except OSError as e:
+            print(f"Could not write transcript cache entry {key}: {e}")
+            with self._lock:
+                self._stats['disk_errors'] += 1
+
+    def stats(self):
+        stats = self.memory.stats()
+        with self._lock:
+            stats.update(self._stats)
+        stats['disk_enabled'] = bool(self.directory)
+        return stats
+
+
+class ProfileCache:
+    """
+    Read-through cache of user records (with their preferences) and household listings, keyed by
+    userId and adminId. Each entry stores the response payload together with an ETag derived from
+    it, so unchanged data can be answered with 304 Not Modified.
+
+    Entries expire after `ttl` seconds and are dropped explicitly by the write paths. A load that
+    started before an invalidation of the same key is not stored, so a concurrent edit can't be
+    overwritten by the stale read that raced it.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.memory = LRUCache(max_entries, ttl)
+        self._lock = threading.Lock()
+        self._generations = {}  # key -> number of invalidations seen, for keys with a load in flight
+        self._loading = {}  # key -> number of loads in flight
+        self._stats = {'loads': 0, 'invalidations': 0, 'stale_loads': 0}
+
+    @staticmethod
+    def etag(payload):
+        data = json.dumps(payload, sort_keys=True, default=str).encode()
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def get_or_load(self, key, load):
+        """
+        Returns `(payload, etag)` for `key`, calling `load()` on a miss. A load returning None
+        (e.g. the user doesn't exist) is passed through as `(None, None)` and not cached.
+        """
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry
+
+        generation = self._begin_load(key)
+        try:
+            payload = load()
+        finally:
+            stale = self._end_load(key, generation)
+        return self._store(key, payload, stale)
+
+    async def get_or_load_async(self, key, load):
+        """Same as get_or_load, for a coroutine function `load`."""
+        entry = self.memory.get(key)
+        if entry is not None:
+            return entry
+
+        generation = self._begin_load(key)
+        try:
+            payload = await load()
+        finally:
+            stale = self._end_load(key, generation)
+        return self._store(key, payload, stale)
+
+    def _begin_load(self, key):
+        with self._lock:
+            self._loading[key] = self._loading.get(key, 0) + 1
+            return self._generations.get(key, 0)
+
+    def _end_load(self, key, generation):
+        # Returns whether the key was invalidated while it was loading
+        with self._lock:
+            stale = self._generations.get(key, 0) != generation
+            self._loading[key] -= 1
+            if not self._loading[key]:
+                del self._loading[key]
+                self._generations.pop(key, None)
+            self._stats['loads'] += 1
+            if stale:
+                self._stats['stale_loads'] += 1
+        return stale
+
+    def _store(self, key, payload, stale):
+        if payload is None:
+            return None, None
+        entry = (payload, self.etag(payload))
+        if not stale:
+            self.memory.set(key, entry)
+        return entry
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                if key in self._loading:
+                    self._generations[key] = self._generations.get(key, 0) + 1
+                self._stats['invalidations'] += 1
+        for key in keys:
+            self.memory.delete(key)
+
+    def stats(self):
+        stats = self.memory.stats()
+        with self._lock:
+            stats.update(self._stats)
+        return stats
@@ -0,0 +1,177 @@
+import re
+
+ROOMS = ('master', 'kitchen', 'guest', 'hall')
+
+# Area names used by the dashboard, mapped to rooms (see map_area_to_room)
+AREA_TO_ROOM = {
+    'kitchen': 'kitchen',
+    'living': 'hall',
+    'bedroom1': 'master',
+    'bedroom2': 'guest',
+}
+
+# Spoken words and phrases for each room, intent and intensity. Phrases are matched on word
+# boundaries, longest first, so "living room" wins over "living" and "on" never matches inside
+# "kitchen" or "conditioner".
+VOCABULARY = {
+    'room': {
+        'master': ['master', 'master bedroom', 'main bedroom', 'bedroom1', 'bedroom 1', 'bedroom one',
+                   'first bedroom'],
+        'kitchen': ['kitchen'],
+        'guest': ['guest', 'guest room', 'guest bedroom', 'bedroom2', 'bedroom 2', 'bedroom two',
+                  'second bedroom'],
+        'hall': ['hall', 'hallway', 'living', 'living room', 'lounge'],
+    },
+    'intent': {
+        'on': ['on'],
+        'off': ['off'],
+    },
+    'intensity': {
+        'low': ['low', 'lower', 'soft', 'softer', 'dim', 'dimmer', 'decrease', 'reduce'],
+        'high': ['high', 'higher', 'bright', 'brighter', 'increase', 'full'],
+    },
+}
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def _compile(vocabulary):
+    # first word -> [(remaining words, kind, value)], longest phrase first
+    index = {}
+    for kind, values in vocabulary.items():
+        for value, phrases in values.items():
+            for phrase in phrases:
+                first, *rest = phrase.split()
+                index.setdefault(first, []).append((tuple(rest), kind, value))
+    for entries in index.values():
+        entries.sort(key=lambda entry: len(entry[0]), reverse=True)
+    return index
+
+
+_INDEX = _compile(VOCABULARY)
+
+
+def tokenize(text):
+    return _TOKEN.findall(text.lower())
+
+
+def scan(text):
+    """Yields (kind, value) for every vocabulary phrase in `text`, in one left-to-right pass."""
+    tokens = tokenize(text)
+    position = 0
+    while position < len(tokens):
+        entries = _INDEX.get(tokens[position])
+        matched = 1
+        if entries:
+            for rest, kind, value in entries:
+                end = position + 1 + len(rest)
+                if tuple(tokens[position + 1:end]) == rest:
+                    yield kind, value
+                    matched = 1 + len(rest)
+                    break
+        position += matched
+
+
+def parse_commands(text, defaults=None, default_intensity='low'):
+    """
+    Splits an utterance into lighting commands, one per room.
+
+    Rooms mentioned together share the intent/intensity that follows or precedes them
+    ("kitchen and hall on", "turn on the kitchen and hall"); a room after a completed command
+    starts a new one ("kitchen on and hall off"), and a bare room after a command repeats it. An
+    intensity implies "on". Whatever the utterance leaves out comes from `defaults`, a mapping of
+    room -> {'intent', 'intensity'} (e.g. the user's stored preferences): "on" without an
+    intensity uses the room's default intensity, or `default_intensity`, and a room with no intent
+    at all uses the room's default command, or keeps intent None. With no defaults and
+    `default_intensity` None, the commands hold only what was said.
+    """
+    groups = []
+    group = {'rooms': [], 'intent': None, 'intensity': None, 'closed': False}
+
+    def start(intent=None):
+        nonlocal group
+        groups.append(group)
+        group = {'rooms': [], 'intent': intent, 'intensity': None, 'closed': False}
+
+    for kind, value in scan(text):
+        if kind == 'room':
+            if group['closed']:
+                start()
+            if value not in group['rooms']:
+                group['rooms'].append(value)
+        elif kind == 'intent' and group['rooms'] and not group['closed'] and group['intent'] not in (None, value):
+            # "turn on the kitchen and off the hall": a different intent after prefixed rooms
+            start(value)
+        else:
+            group[kind] = value
+            if group['rooms']:
+                group['closed'] = True
+    groups.append(group)
+
+    commands = []
+    seen = set()
+    previous = None
+    for group in groups:
+        if not group['rooms']:
+            continue
+        if group['intent'] is None and group['intensity'] is None and previous is not None:
+            # "kitchen on and hall too": a bare room continues the previous command
+            group['intent'], group['intensity'] = previous['intent'], previous['intensity']
+        previous = group
+
+        intent, intensity = group['intent'], group['intensity']
+        if intensity is not None:
+            intent = 'on'
+        for room in group['rooms']:
+            if room in seen:
+                # A later mention of the same room replaces the earlier command
+                commands = [command for command in commands if command['room'] != room]
+            seen.add(room)
+            default = defaults.get(room) if defaults else None
+            room_intent, room_intensity = intent, intensity
+            if room_intent is None and default:
+                room_intent = default['intent']
+            if room_intent == 'on' and room_intensity is None:
+                room_intensity = default['intensity'] if default else default_intensity
+            commands.append({'room': room, 'intent': room_intent, 'intensity': room_intensity})
+    return commands
+
+
+def describe(command):
+    room, intent, intensity = command['room'], command['intent'], command['intensity']
+    if intent == 'on':
+        return f"The light is turned on with {intensity} intensity in {room} room."
+    if intent == 'off':
+        return f"The light is turned off in {room} room."
+    return f"Please say whether to turn the light on or off in {room} room."
+
+
+def process_text(transcribed_text, defaults=None, default_intensity='low'):
+    """
+    Parses a transcription into the command payload returned by /transcribe.
+
+    The top-level room/intent/intensity/response describe the first command (or are None with a
+    prompt when no room was recognised); `commands` lists every command in the utterance.
+    `defaults` and `default_intensity` fill in what the utterance leaves out, see parse_commands.
+    """
+    commands = [{**command, 'response': describe(command)}
+                for command in parse_commands(transcribed_text, defaults, default_intensity)]
+    if not commands:
+        return {
+            "room": None,
+            "intent": None,
+            "intensity": None,
+            "text": transcribed_text,
+            "response": "Please enter valid instructions.",
+            "commands": [],
+        }
+
+    first = commands[0]
+    return {
+        "room": first['room'],
+        "intent": first['intent'],
+        "intensity": first['intensity'],
+        "text": transcribed_text,
+        "response": " ".join(command['response'] for command in commands),
+        "commands": commands,
+    }
@@ -0,0 +1,190 @@
+import glob
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Optional; without it only the uploaded originals are served
+    Image = ImageOps = None
+
+# Profile image configuration (can be overridden through the environment)
+image_config = {
+    'directory': os.environ.get('IMAGE_DIR', os.path.join('uploads', 'images')),
+    # Longest side in pixels of each WebP thumbnail
+    'sizes': tuple(int(size) for size in os.environ.get('IMAGE_THUMBNAIL_SIZES', '96,256').split(',') if size),
+    'webp_quality': int(os.environ.get('IMAGE_WEBP_QUALITY', 80)),
+}
+
+# Where images are served from (see App.serve_uploaded_file); stored in users.imagePath
+URL_PREFIX = 'uploads/images'
+
+# Leading bytes of the accepted image formats
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+
+# <sha256>.<extension> for originals, <sha256>.webp and <sha256>-<size>.webp for the variants
+_NAME = re.compile(r"(?P<digest>[0-9a-f]{64})(?:-(?P<size>\d+))?\.(?P<extension>jpg|png|gif|webp)")
+
+
+def image_format(data):
+    """Returns the file extension of an uploaded image, or raises ValueError when it isn't one."""
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    for signature, extension in SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    raise ValueError("Unsupported image format, expected JPEG, PNG, GIF or WebP")
+
+
+class ImageStore:
+    """
+    Profile images stored under the SHA-256 of their content, so the same picture uploaded for
+    several profiles (or several times) is stored once and a name never changes what it points to.
+
+    Every original gets a full-size WebP copy and a WebP thumbnail per entry in `sizes`, generated
+    on a background thread with Pillow (if it is installed). Until a variant exists, requests for it
+    are answered with the original.
+    """
+
+    def __init__(self, directory, sizes, webp_quality):
+        self.directory = directory
+        self.sizes = sizes
+        self.webp_quality = webp_quality
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-variants')
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'saved': 0,
+            'deduplicated': 0,
+            'variants_generated': 0,
+            'variant_errors': 0,
+            'variant_fallbacks': 0,
+        }
+        if Image is None:
+            print("Pillow is not installed; profile images are served without thumbnails")
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def save(self, data):
+        """
+        Stores an uploaded image and returns its path for users.imagePath. Raises ValueError when
+        the data isn't a JPEG, PNG, GIF or WebP image.
+        """
+        name = f"{hashlib.sha256(data).hexdigest()}.{image_format(data)}"
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            self._count('deduplicated')
+        else:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write to a temporary file first so a concurrent request never serves a partial image
+            temporary = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary, 'wb') as image:
+                image.write(data)
+            os.replace(temporary, path)
+            self._count('saved')
+        self.generate_variants(name)
+        return f"{URL_PREFIX}/{name}"
+
+    def _variant_names(self, name):
+        digest, extension = name.split('.')
+        names = [f"{digest}-{size}.webp" for size in self.sizes]
+        if extension != 'webp':
+            names.append(f"{digest}.webp")
+        return names
+
+    def variants(self, image_path):
+        """
+        Returns the WebP and thumbnail paths of a stored image ({"webp", "thumbnails": {size: path}}),
+        or None for images that weren't stored by content hash.
+        """
+        match = _NAME.fullmatch(re.split(r"[\\/]", image_path or '')[-1])
+        if not match or match['size']:
+            return None
+        digest = match['digest']
+        return {
+            'webp': f"{URL_PREFIX}/{digest}.webp",
+            'thumbnails': {str(size): f"{URL_PREFIX}/{digest}-{size}.webp" for size in self.sizes},
+        }
+
+    def generate_variants(self, name):
+        """Queues the WebP copy and thumbnails of a stored original, unless they exist or are queued."""
+        if Image is None:
+            return
+        missing = [variant for variant in self._variant_names(name)
+                   if not os.path.exists(os.path.join(self.directory, variant))]
+        with self._lock:
+            if not missing or name in self._pending:
+                return
+            self._pending.add(name)
+        self._executor.submit(self._generate, name)
+
+    def _generate(self, name):
+        try:
+            with metrics.stage('image_variants'):
+                with Image.open(os.path.join(self.directory, name)) as original:
+                    image = ImageOps.exif_transpose(original)
+                    if image.mode not in ('RGB', 'RGBA'):
+                        image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.mode else 'RGB')
+                    digest = name.split('.')[0]
+                    for size in self.sizes:
+                        thumbnail = image.copy()
+                        thumbnail.thumbnail((size, size), Image.LANCZOS)
+                        self._write(thumbnail, f"{digest}-{size}.webp")
+                    if not name.endswith('.webp'):
+                        self._write(image, f"{digest}.webp")
+        except Exception as e:
+            print(f"Could not generate variants of image {name}: {e}")
+            self._count('variant_errors')
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def _write(self, image, variant):
+        path = os.path.join(self.directory, variant)
+        temporary = f"{path}.tmp"
+        image.save(temporary, 'WEBP', quality=self.webp_quality, method=4)
+        os.replace(temporary, path)
+        self._count('variants_generated')
+
+    def locate(self, filename):
+        """
+        Returns (file to serve, immutable) for a request of `filename` under the image directory.
+        Content-addressed files are immutable. A variant that doesn't exist yet is queued and
+        answered with its original, which mustn't be cached under the variant's name.
+        """
+        match = _NAME.fullmatch(filename)
+        if not match:
+            # Images uploaded before the store, saved under the client's file name
+            return filename, False
+        if os.path.exists(os.path.join(self.directory, filename)):
+            return filename, True
+        originals = [os.path.basename(path) for path in glob.glob(os.path.join(self.directory, f"{match['digest']}.*"))]
+        originals = [name for name in originals if _NAME.fullmatch(name)]
+        if not originals:
+            return filename, False
+        # The WebP copy is a variant too, unless the upload was a WebP image
+        original = min(originals, key=lambda name: name.endswith('.webp'))
+        self.generate_variants(original)
+        self._count('variant_fallbacks')
+        return original, False
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        stats['thumbnails'] = Image is not None
+        return stats
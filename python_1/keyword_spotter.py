@@ -0,0 +1,211 @@
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from audio import decode_audio, SAMPLE_RATE
+
+# Keyword spotter configuration (can be overridden through the environment)
+kws_config = {
+    'enabled': os.environ.get('KWS_ENABLED', '1') == '1',
+    # Accept a match when its average frame distance is below `max_distance` and the best other
+    # command is at least `min_margin` times further away; with a single known command there is
+    # nothing to compare against, so everything goes to Whisper
+    'max_distance': float(os.environ.get('KWS_MAX_DISTANCE', 0.3)),
+    'min_margin': float(os.environ.get('KWS_MIN_MARGIN', 1.2)),
+    # Only short clips are canonical commands worth spotting
+    'max_seconds': float(os.environ.get('KWS_MAX_SECONDS', 3)),
+    'max_words': int(os.environ.get('KWS_MAX_WORDS', 6)),
+    'templates_per_command': int(os.environ.get('KWS_TEMPLATES_PER_COMMAND', 3)),
+    # Still run Whisper on spotter hits and count how often both agree, to tune the thresholds
+    'shadow': os.environ.get('KWS_SHADOW', '0') == '1',
+    'template_dir': os.environ.get('KWS_TEMPLATE_DIR'),
+}
+
+FRAME_SIZE = 400  # 25 ms
+HOP_SIZE = 320  # 20 ms, coarse enough to keep DTW cheap
+FFT_SIZE = 512
+N_MELS = 40
+
+
+def _mel_filterbank(sample_rate=SAMPLE_RATE, fft_size=FFT_SIZE, n_mels=N_MELS):
+    def hz_to_mel(hz):
+        return 2595 * np.log10(1 + hz / 700)
+
+    def mel_to_hz(mel):
+        return 700 * (10 ** (mel / 2595) - 1)
+
+    mel_points = np.linspace(hz_to_mel(0), hz_to_mel(sample_rate / 2), n_mels + 2)
+    bins = np.floor((fft_size + 1) * mel_to_hz(mel_points) / sample_rate).astype(int)
+    filterbank = np.zeros((n_mels, fft_size // 2 + 1), dtype=np.float32)
+    for m in range(1, n_mels + 1):
+        left, center, right = bins[m - 1], bins[m], bins[m + 1]
+        if center > left:
+            filterbank[m - 1, left:center] = (np.arange(left, center) - left) / (center - left)
+        if right > center:
+            filterbank[m - 1, center:right] = (right - np.arange(center, right)) / (right - center)
+    return filterbank
+
+
+_FILTERBANK = _mel_filterbank()
+_WINDOW = np.hamming(FRAME_SIZE).astype(np.float32)
+
+
+def log_mel_features(samples, trim_db=35.0):
+    """
+    Log-mel frames (20 ms hop) of a 16 kHz clip with leading/trailing silence trimmed and
+    per-utterance mean/variance normalisation, so templates compare across loudness and offset.
+    """
+    if len(samples) < FRAME_SIZE:
+        samples = np.pad(samples, (0, FRAME_SIZE - len(samples)))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME_SIZE)[::HOP_SIZE] * _WINDOW
+    power = np.abs(np.fft.rfft(frames, n=FFT_SIZE)) ** 2
+
+    energy_db = 10 * np.log10(power.sum(axis=1) + 1e-10)
+    voiced = np.flatnonzero(energy_db > energy_db.max() - trim_db)
+    power = power[voiced[0]:voiced[-1] + 1]
+
+    features = np.log(power @ _FILTERBANK.T + 1e-10)
+    features = (features - features.mean(axis=0)) / (features.std(axis=0) + 1e-5)
+    # Unit-length frames so the frame distance is a cosine distance
+    return features / (np.linalg.norm(features, axis=1, keepdims=True) + 1e-10)
+
+
+def dtw_distance(query, template):
+    """
+    Average cosine distance along the best alignment of two feature sequences.
+
+    Uses slope-constrained steps (1,1), (1,2) and (2,1) so that every row only depends on the two
+    rows before it and can be computed as one vector operation. Sequences whose lengths differ
+    by more than a factor of two can't be aligned and get an infinite distance.
+    """
+    n, m = len(query), len(template)
+    cost = 1.0 - query @ template.T
+    # D[i + 2, j + 2] is the cheapest path cost ending at (i, j); the two padding rows/columns stay infinite
+    D = np.full((n + 2, m + 2), np.inf)
+    D[2, 2] = cost[0, 0]
+    for i in range(1, n):
+        best = np.minimum(np.minimum(D[i + 1, 1:m + 1], D[i + 1, 0:m]), D[i, 1:m + 1])
+        D[i + 2, 2:] = cost[i] + best
+    return D[n + 1, m + 1] / ((n + m) / 2)
+
+
+def command_label(command):
+    """Canonical text of a parsed command, e.g. "kitchen on low" or "hall off"."""
+    return " ".join(part for part in (command['room'], command['intent'], command['intensity']) if part)
+
+
+class KeywordSpotter:
+    """
+    First-stage recognizer for the closed command vocabulary.
+
+    Clips are matched with DTW against per-user templates of each canonical command; templates are
+    learned from the user's own short commands that Whisper transcribed (and, optionally, seeded
+    for everyone from KWS_TEMPLATE_DIR). `spot` returns a command label only when the best match
+    is both close and clearly better than another command, otherwise None so the caller falls
+    back to Whisper. Until templates exist for at least two commands nothing is spotted.
+    """
+
+    def __init__(self, max_distance, min_margin, max_seconds, max_words, templates_per_command, shadow=False,
+                 enabled=True, template_dir=None):
+        self.enabled = enabled
+        self.max_distance = max_distance
+        self.min_margin = min_margin
+        self.max_seconds = max_seconds
+        self.max_words = max_words
+        self.templates_per_command = templates_per_command
+        self.shadow = shadow
+        self._templates = {}  # user_id (None for everyone) -> {label: deque of feature arrays}
+        self._lock = threading.Lock()
+        self._stats = {
+            'spotter_calls': 0,
+            'spotter_hits': 0,
+            'spotter_time_total': 0.0,
+            'whisper_calls': 0,
+            'whisper_time_total': 0.0,
+            'templates_learned': 0,
+            'shadow_agree': 0,
+            'shadow_disagree': 0,
+        }
+        if template_dir:
+            self.load_templates(template_dir)
+
+    def _add(self, user_id, label, features):
+        with self._lock:
+            by_label = self._templates.setdefault(user_id, {})
+            by_label.setdefault(label, deque(maxlen=self.templates_per_command)).append(features)
+
+    def load_templates(self, directory):
+        """Seeds shared templates from `<directory>/<label>/*.wav`, e.g. `kitchen_on_low/1.wav`."""
+        for label_dir in sorted(os.listdir(directory)):
+            path = os.path.join(directory, label_dir)
+            if not os.path.isdir(path):
+                continue
+            for name in sorted(os.listdir(path)):
+                with open(os.path.join(path, name), 'rb') as clip:
+                    self._add(None, label_dir.replace('_', ' '), log_mel_features(decode_audio(clip.read())))
+
+    def spot(self, user_id, samples):
+        """Returns the label of the confidently spotted command in `samples`, or None."""
+        if not self.enabled or len(samples) > self.max_seconds * SAMPLE_RATE:
+            return None
+
+        started = time.monotonic()
+        with self._lock:
+            candidates = []
+            for owner in (user_id, None):
+                for label, templates in self._templates.get(owner, {}).items():
+                    candidates.extend((label, template) for template in templates)
+
+        label = None
+        if candidates:
+            features = log_mel_features(samples)
+            best = {}
+            for candidate_label, template in candidates:
+                distance = dtw_distance(features, template)
+                best[candidate_label] = min(distance, best.get(candidate_label, np.inf))
+            ranked = sorted(best.items(), key=lambda item: item[1])
+            # Without a runner-up the margin can't tell a match from a different command that is merely close
+            if len(ranked) > 1:
+                (best_label, best_distance), (_, runner_up) = ranked[:2]
+                if best_distance <= self.max_distance and runner_up >= best_distance * self.min_margin:
+                    label = best_label
+
+        with self._lock:
+            self._stats['spotter_calls'] += 1
+            self._stats['spotter_hits'] += 1 if label else 0
+            self._stats['spotter_time_total'] += time.monotonic() - started
+        return label
+
+    def learn(self, user_id, samples, command, transcribed_text):
+        """Keeps `samples` as a template when Whisper heard a short, complete command in it."""
+        if not self.enabled or len(command['commands']) != 1 or not command['intent']:
+            return
+        if len(samples) > self.max_seconds * SAMPLE_RATE or len(transcribed_text.split()) > self.max_words:
+            return
+        self._add(user_id, command_label(command), log_mel_features(samples))
+        with self._lock:
+            self._stats['templates_learned'] += 1
+
+    def record_whisper(self, seconds, spotted_label=None, command=None):
+        """Records a fallback to Whisper; in shadow mode also whether it agreed with the spotter."""
+        with self._lock:
+            self._stats['whisper_calls'] += 1
+            self._stats['whisper_time_total'] += seconds
+            if spotted_label is not None and command is not None:
+                agreed = command['room'] and command_label(command) == spotted_label
+                self._stats['shadow_agree' if agreed else 'shadow_disagree'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['templates'] = sum(len(templates) for by_label in self._templates.values()
+                                     for templates in by_label.values())
+        calls = stats['spotter_calls']
+        stats['spotter_hit_rate'] = stats['spotter_hits'] / calls if calls else 0.0
+        stats['spotter_latency_avg'] = stats['spotter_time_total'] / calls if calls else 0.0
+        whisper_calls = stats['whisper_calls']
+        stats['whisper_latency_avg'] = stats['whisper_time_total'] / whisper_calls if whisper_calls else 0.0
+        return stats
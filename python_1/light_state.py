@@ -0,0 +1,231 @@
+import json
+import os
+import queue
+import threading
+import time
+
+from command_parser import ROOMS
+
+# Light state configuration (can be overridden through the environment)
+light_state_config = {
+    'snapshot_path': os.environ.get('LIGHT_STATE_SNAPSHOT', os.path.join('uploads', 'light_state.json')),
+    'snapshot_interval': float(os.environ.get('LIGHT_STATE_SNAPSHOT_INTERVAL', 10)),
+    'heartbeat_interval': float(os.environ.get('LIGHT_STATE_HEARTBEAT', 15)),
+}
+
+# Dashboard brightness levels: 0 is off, 1 warm (low), 2 bright (high)
+LEVELS = {None: 0, 'low': 1, 'high': 2}
+
+
+def room_state(intent, intensity):
+    on = intent == 'on'
+    intensity = (intensity or 'low') if on else None
+    return {'intent': 'on' if on else 'off', 'intensity': intensity, 'level': LEVELS[intensity]}
+
+
+class Subscription:
+    """
+    One connected client. Only the latest state matters, so a slow client skips intermediate
+    versions instead of making the publisher wait.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=1)
+
+    def put(self, state):
+        while True:
+            try:
+                self._queue.put_nowait(state)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class LightStateStore:
+    """
+    Authoritative light state for every household: the four rooms' on/off and intensity, updated by
+    parsed commands and pushed to subscribed clients as soon as it changes.
+
+    The state lives in memory and is written to a JSON snapshot every `snapshot_interval` seconds
+    when it has changed (and on shutdown), and read back on start. When several processes serve the
+    same households, `publish_hook(admin_id, state)` is called with every local change so it can be
+    handed to the others' `receive`.
+    """
+
+    def __init__(self, snapshot_path, snapshot_interval, heartbeat_interval):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.heartbeat_interval = heartbeat_interval
+        self._households = {}  # adminId -> {'version', 'updated_at', 'rooms'}
+        self._subscribers = {}  # adminId -> set of Subscription
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stopping = threading.Event()
+        self._thread = None
+        self.publish_hook = None
+        self._stats = {'updates': 0, 'published': 0, 'received': 0, 'snapshots': 0, 'snapshot_errors': 0}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.snapshot_path) as snapshot:
+                self._households = json.load(snapshot)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Could not read light state snapshot {self.snapshot_path}: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='light-state-snapshot', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.snapshot_interval):
+            self.snapshot()
+
+    def snapshot(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            data = json.dumps(self._households)
+            self._dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.snapshot_path) or '.', exist_ok=True)
+            # Per process, since several worker processes may write the same snapshot
+            temporary = f"{self.snapshot_path}.{os.getpid()}.tmp"
+            with open(temporary, 'w') as snapshot:
+                snapshot.write(data)
+            os.replace(temporary, self.snapshot_path)
+            with self._lock:
+                self._stats['snapshots'] += 1
+        except OSError as e:
+            print(f"Could not write light state snapshot {self.snapshot_path}: {e}")
+            with self._lock:
+                self._dirty = True
+                self._stats['snapshot_errors'] += 1
+
+    def shutdown(self):
+        self._stopping.set()
+        self.snapshot()
+
+    @staticmethod
+    def initial_state():
+        return {'version': 0, 'updated_at': None, 'updated_by': None,
+                'rooms': {room: room_state('off', None) for room in ROOMS}}
+
+    def get(self, admin_id):
+        """Returns the household's state, or None if no command has been applied to it yet."""
+        with self._lock:
+            state = self._households.get(admin_id)
+            return self._copy(state) if state else None
+
+    @staticmethod
+    def _copy(state):
+        return {**state, 'rooms': {room: dict(values) for room, values in state['rooms'].items()}}
+
+    def apply(self, admin_id, commands, user_id=None):
+        """
+        Applies parsed commands ({'room', 'intent', 'intensity'}) to the household and notifies its
+        subscribers. Commands without an intent change nothing. Returns the new state.
+        """
+        with self._lock:
+            state = self._households.get(admin_id)
+            if state is None:
+                state = self.initial_state()
+            changed = False
+            for command in commands:
+                if command.get('room') not in state['rooms'] or command.get('intent') not in ('on', 'off'):
+                    continue
+                new = room_state(command['intent'], command.get('intensity'))
+                if state['rooms'][command['room']] != new:
+                    state['rooms'][command['room']] = new
+                    changed = True
+            if not changed:
+                return self._copy(state) if state['version'] else None
+
+            state['version'] += 1
+            state['updated_at'] = time.time()
+            state['updated_by'] = user_id
+            self._households[admin_id] = state
+            self._dirty = True
+            self._stats['updates'] += 1
+            published = self._copy(state)
+            subscribers = list(self._subscribers.get(admin_id, ()))
+            self._stats['published'] += len(subscribers)
+
+        for subscription in subscribers:
+            subscription.put(published)
+        if self.publish_hook is not None:
+            self.publish_hook(admin_id, published)
+        return published
+
+    def receive(self, admin_id, state):
+        """
+        Takes a household's state as changed by another process and notifies local subscribers,
+        unless the state held here is already as recent.
+        """
+        with self._lock:
+            current = self._households.get(admin_id)
+            # Concurrent changes in two processes can reach the same version; the later one wins
+            if current and ((current['version'], current['updated_at'] or 0) >=
+                            (state['version'], state['updated_at'] or 0)):
+                return
+            self._households[admin_id] = state
+            self._dirty = True
+            self._stats['received'] += 1
+            published = self._copy(state)
+            subscribers = list(self._subscribers.get(admin_id, ()))
+            self._stats['published'] += len(subscribers)
+
+        for subscription in subscribers:
+            subscription.put(published)
+
+    def subscribe(self, admin_id):
+        subscription = Subscription()
+        with self._lock:
+            self._subscribers.setdefault(admin_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, admin_id, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(admin_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[admin_id]
+
+    def events(self, admin_id):
+        """
+        Yields a Server-Sent Events stream of the household's state: the current state (when there
+        is one), then every change, with a comment line as heartbeat so proxies keep it open.
+        """
+        subscription = self.subscribe(admin_id)
+        try:
+            state = self.get(admin_id)
+            if state:
+                yield f"id: {state['version']}\nevent: state\ndata: {json.dumps(state)}\n\n"
+            while not self._stopping.is_set():
+                state = subscription.get(self.heartbeat_interval)
+                if state is None:
+                    yield ": heartbeat\n\n"
+                else:
+                    yield f"id: {state['version']}\nevent: state\ndata: {json.dumps(state)}\n\n"
+        finally:
+            self.unsubscribe(admin_id, subscription)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['households'] = len(self._households)
+            stats['subscribers'] = sum(len(subscribers) for subscribers in self._subscribers.values())
+        return stats
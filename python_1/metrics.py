@@ -0,0 +1,232 @@
+import bisect
+import contextvars
+import glob
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Metrics configuration (can be overridden through the environment)
+metrics_config = {
+    'enabled': os.environ.get('METRICS_ENABLED', '1') == '1',
+    # Requests sending this header (with any value) get their stage breakdown back in a Server-Timing header
+    'profile_header': os.environ.get('METRICS_PROFILE_HEADER', 'X-Profile'),
+    # Directory shared by worker processes (see serve.py), so /metrics on any of them reports all of them
+    'directory': os.environ.get('METRICS_DIR') or None,
+    'flush_interval': float(os.environ.get('METRICS_FLUSH_INTERVAL', 5)),
+}
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PREFIX = 'smarthome'
+
+DESCRIPTIONS = {
+    'http_request_seconds': "Time to handle a request, until the response headers",
+    'stage_seconds': "Time spent in each stage of handling a request",
+    'db_query_seconds': "Time of a database call, including the connection checkout",
+    'db_errors_total': "Database calls that failed",
+    'asr_batch_seconds': "Time a worker took to transcribe one batch",
+    'asr_queue_wait_seconds': "Time a transcription waited for a worker",
+}
+
+
+class Metrics:
+    """
+    Counters and latency histograms for the whole app, rendered in the Prometheus text format,
+    plus per-request traces: `stage()` times a block into a histogram and, while a request is being
+    traced, into that request's stage breakdown.
+
+    With a `directory`, every process writes its values there every `flush_interval` seconds and
+    `render` adds up all processes' files.
+    """
+
+    def __init__(self, enabled, profile_header, directory, flush_interval):
+        self.enabled = enabled
+        self.profile_header = profile_header
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+        self._trace = contextvars.ContextVar('trace', default=None)
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+            histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def start_trace(self):
+        """Starts collecting the stages of the current request; returns the token for end_trace."""
+        return self._trace.set([])
+
+    def end_trace(self, token):
+        """Returns the (stage, seconds) pairs recorded since start_trace."""
+        stages = self._trace.get()
+        self._trace.reset(token)
+        return stages or []
+
+    @contextmanager
+    def stage(self, name, metric='stage_seconds', **labels):
+        """
+        Times the block as stage `name` of the current request and in histogram `metric` (by default
+        stage_seconds{stage=name}).
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            if metric == 'stage_seconds':
+                labels = {'stage': name, **labels}
+            self.observe(metric, seconds, **labels)
+            trace = self._trace.get()
+            if trace is not None:
+                trace.append((name, seconds))
+
+    @staticmethod
+    def server_timing(stages, total):
+        """Formats a trace as a Server-Timing header: one entry per stage, repeated stages added up."""
+        totals = {}
+        for name, seconds in stages:
+            count, duration = totals.get(name, (0, 0.0))
+            totals[name] = (count + 1, duration + seconds)
+        entries = [f'{name};dur={duration * 1000:.2f}' + (f';desc="{count} calls"' if count > 1 else '')
+                   for name, (count, duration) in totals.items()]
+        entries.append(f'total;dur={total * 1000:.2f}')
+        return ", ".join(entries)
+
+    def start(self):
+        if self.directory and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='metrics-flush', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            self.flush()
+
+    def shutdown(self):
+        self._stopping.set()
+        self.flush()
+
+    def _snapshot(self):
+        with self._lock:
+            return ({key: value for key, value in self._counters.items()},
+                    {key: list(values) for key, values in self._histograms.items()})
+
+    def flush(self):
+        if not self.directory:
+            return
+        counters, histograms = self._snapshot()
+        data = json.dumps({'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                           'histograms': [[name, labels, values] for (name, labels), values in histograms.items()]})
+        path = os.path.join(self.directory, f"metrics-{os.getpid()}.json")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{path}.tmp", 'w') as snapshot:
+                snapshot.write(data)
+            os.replace(f"{path}.tmp", path)
+        except OSError as e:
+            print(f"Could not write metrics to {path}: {e}")
+
+    def _collect(self):
+        if not self.directory:
+            return self._snapshot()
+        # Every process's last flush, this one's included; files of processes that have exited stay,
+        # so counters never go backwards
+        self.flush()
+        counters, histograms = {}, {}
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            try:
+                with open(path) as snapshot:
+                    data = json.load(snapshot)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in data['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in data['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.setdefault(key, [0] * len(values))
+                for index, value in enumerate(values):
+                    total[index] += value
+        return counters, histograms
+
+    def render(self, gauges=None):
+        """
+        Returns every metric in the Prometheus text exposition format. The numbers in `gauges`, a
+        (nested) stats dict such as the one on /stats, are added as gauges of this process.
+        """
+        counters, histograms = self._collect()
+        lines = []
+        families = {}
+        for (name, labels), value in counters.items():
+            families.setdefault((name, 'counter'), []).append((labels, value))
+        for (name, labels), values in histograms.items():
+            families.setdefault((name, 'histogram'), []).append((labels, values))
+
+        for (name, kind), series in sorted(families.items()):
+            metric = f"{PREFIX}_{name}"
+            if name in DESCRIPTIONS:
+                lines.append(f"# HELP {metric} {DESCRIPTIONS[name]}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for labels, value in sorted(series):
+                if kind == 'counter':
+                    lines.append(f"{metric}{_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{metric}_sum{_labels(labels)} {value[-1]}")
+                lines.append(f"{metric}_count{_labels(labels)} {cumulative}")
+
+        for name, value in _numbers(gauges or {}):
+            metric = re.sub(r'[^a-zA-Z0-9_]', '_', f"{PREFIX}_{name}")
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (key + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+def _numbers(stats, prefix=''):
+    # (name, value) of every number in a (nested) stats dict; other values are skipped
+    for key, value in stats.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _numbers(value, f"{name}_")
+        elif isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+
+
+metrics = Metrics(**metrics_config)
@@ -0,0 +1,10 @@
+-- One preference row per (userId, room) so profile writes can upsert with ON DUPLICATE KEY UPDATE.
+-- Remove duplicates left behind by the old per-room INSERTs, keeping one row per user and room.
+DELETE p1 FROM user_preferences p1
+JOIN user_preferences p2
+  ON p1.userId = p2.userId
+ AND p1.room = p2.room
+ AND p1.preferenceId > p2.preferenceId;
+
+ALTER TABLE user_preferences
+    ADD UNIQUE KEY uq_user_room (userId, room);
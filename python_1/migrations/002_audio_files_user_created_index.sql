@@ -0,0 +1,4 @@
+-- Conversation history is read per user, newest first, and paginated on (created_at, id).
+-- InnoDB appends the primary key (id) to secondary indexes, so this index covers the full sort order.
+ALTER TABLE audio_files
+    ADD INDEX idx_audio_files_user_created (user_id, created_at);
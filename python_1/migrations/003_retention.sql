@@ -0,0 +1,20 @@
+-- Per-household retention policies; NULL columns fall back to the RETENTION_* environment defaults
+-- and 0 disables a step.
+CREATE TABLE retention_policies (
+    adminId VARCHAR(36) PRIMARY KEY,
+    compress_after_days INT,
+    archive_after_days INT,
+    delete_after_days INT,
+    quota_mb INT,
+    FOREIGN KEY (adminId) REFERENCES admin(adminId) ON DELETE CASCADE
+);
+
+-- Conversation rows moved out of audio_files once they pass a household's archive age.
+CREATE TABLE audio_files_archive (
+    id VARCHAR(36) PRIMARY KEY,
+    user_id VARCHAR(36) NOT NULL,
+    file_path VARCHAR(255) NOT NULL,
+    transcribed_text TEXT,
+    created_at TIMESTAMP NOT NULL,
+    KEY idx_audio_files_archive_user_created (user_id, created_at)
+);
@@ -0,0 +1,121 @@
+import threading
+import time
+from functools import lru_cache
+
+from command_parser import ROOMS
+
+# Seconds to wait before retrying a failed load
+RETRY_INTERVAL = 30
+
+# Each room takes three bits of a user's preference word: stored, on, high
+_BITS_PER_ROOM = 3
+_STORED, _ON, _HIGH = 1, 2, 4
+_ROOM_SHIFT = {room: index * _BITS_PER_ROOM for index, room in enumerate(ROOMS)}
+
+
+def encode(preferences, bits=0):
+    """
+    Folds `user_preferences` rows ({'room', 'intent', 'intensity'} with 0/1 flags) into a
+    preference word, on top of the rooms already set in `bits`.
+    """
+    for pref in preferences:
+        shift = _ROOM_SHIFT.get(pref.get('room'))
+        if shift is None:
+            continue
+        value = _STORED | (_ON if pref.get('intent') else 0) | (_HIGH if pref.get('intensity') else 0)
+        bits = (bits & ~(0b111 << shift)) | (value << shift)
+    return bits
+
+
+@lru_cache(maxsize=None)
+def decode(bits):
+    """
+    Expands a preference word into the room -> {'intent', 'intensity'} defaults used by the command
+    parser. There are only 2^12 possible words, so every result is shared; don't modify it.
+    """
+    defaults = {}
+    for room, shift in _ROOM_SHIFT.items():
+        value = (bits >> shift) & 0b111
+        if value & _STORED:
+            defaults[room] = {
+                'intent': 'on' if value & _ON else 'off',
+                'intensity': 'high' if value & _HIGH else 'low',
+            }
+    return defaults
+
+
+class PreferenceIndex:
+    """
+    In-memory copy of `user_preferences`, one small integer per user, so commands can be resolved
+    against a user's room defaults without a database query.
+
+    The index is filled once by `ensure_loaded` (in the background, lookups before it finishes just
+    get no defaults) and then kept current by the profile write paths through `update`/`replace`.
+    """
+
+    def __init__(self):
+        self._bits = {}  # userId -> preference word
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loader = None
+        self._last_attempt = None
+        self.loaded = False
+        self._stats = {'lookups': 0, 'updates': 0, 'load_errors': 0, 'load_seconds': None}
+
+    def ensure_loaded(self, load_rows):
+        """
+        Starts loading every row returned by `load_rows()` in the background, unless it already is
+        (a failed load is retried at most every RETRY_INTERVAL seconds).
+        """
+        with self._load_lock:
+            if self.loaded or (self._loader is not None and self._loader.is_alive()):
+                return
+            if self._last_attempt is not None and time.monotonic() - self._last_attempt < RETRY_INTERVAL:
+                return
+            self._last_attempt = time.monotonic()
+            self._loader = threading.Thread(target=self._load, args=(load_rows,), name='preference-index', daemon=True)
+            self._loader.start()
+
+    def _load(self, load_rows):
+        started = time.monotonic()
+        try:
+            rows = load_rows()
+        except Exception as e:
+            print(f"Could not load user preferences: {e}")
+            with self._lock:
+                self._stats['load_errors'] += 1
+            return
+
+        bits = {}
+        for row in rows:
+            bits[row['userId']] = encode([row], bits.get(row['userId'], 0))
+        with self._lock:
+            # Writes that happened while loading are newer than the snapshot
+            bits.update(self._bits)
+            self._bits = bits
+            self._stats['load_seconds'] = time.monotonic() - started
+        self.loaded = True
+
+    def defaults(self, user_id):
+        """Returns the user's room defaults for the command parser (empty when none are stored)."""
+        self._stats['lookups'] += 1
+        return decode(self._bits.get(user_id, 0))
+
+    def update(self, user_id, preferences):
+        """Applies upserted preference rows for one user on top of what is stored."""
+        with self._lock:
+            self._bits[user_id] = encode(preferences or [], self._bits.get(user_id, 0))
+            self._stats['updates'] += 1
+
+    def replace(self, user_id, preferences):
+        """Replaces everything stored for one user with `preferences`."""
+        with self._lock:
+            self._bits[user_id] = encode(preferences or [])
+            self._stats['updates'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._bits)
+        stats['loaded'] = self.loaded
+        return stats
@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from audio import SAMPLE_RATE, resample
+from metrics import metrics
+
+# Preprocessing applied to a clip before Whisper sees it (can be overridden through the environment)
+preprocess_config = {
+    'enabled': os.environ.get('AUDIO_PREPROCESS', '1') == '1',
+    # Peak level after normalisation, with the gain capped so silence isn't blown up into noise
+    'target_peak': float(os.environ.get('AUDIO_TARGET_PEAK', 0.9)),
+    'max_gain_db': float(os.environ.get('AUDIO_MAX_GAIN_DB', 20)),
+    # VAD trimming: a frame is speech when its RMS exceeds `vad_threshold` times the noise floor
+    'trim': os.environ.get('AUDIO_TRIM', '1') == '1',
+    'vad_threshold': float(os.environ.get('AUDIO_VAD_THRESHOLD', 3.0)),
+    'vad_min_rms': float(os.environ.get('AUDIO_VAD_MIN_RMS', 0.01)),
+    # Audio kept around the detected speech so the first and last syllables aren't clipped
+    'padding_ms': int(os.environ.get('AUDIO_TRIM_PADDING_MS', 250)),
+    # Spectral noise gate: bins below `noise_gate_threshold` times the noise spectrum are attenuated
+    'noise_gate': os.environ.get('AUDIO_NOISE_GATE', '0') == '1',
+    'noise_gate_threshold': float(os.environ.get('AUDIO_NOISE_GATE_THRESHOLD', 1.5)),
+    'noise_gate_attenuation_db': float(os.environ.get('AUDIO_NOISE_GATE_ATTENUATION_DB', 20)),
+}
+
+FRAME_MS = 30
+# A frame only counts as speech when enough of its neighbourhood is loud too, so a click or a pop
+# at the edges of the clip doesn't stop the trim
+SPEECH_CONTEXT_FRAMES = 5
+SPEECH_MIN_FRAMES = 3
+# Noise gate STFT: 32 ms frames with 75% overlap
+GATE_FFT_SIZE = 512
+GATE_HOP = 128
+
+
+def frame_rms(samples, frame_size):
+    """RMS of every whole frame of `samples`."""
+    count = len(samples) // frame_size
+    frames = samples[:count * frame_size].reshape(count, frame_size)
+    return np.sqrt(np.mean(frames ** 2, axis=1))
+
+
+def normalize(samples, target_peak, max_gain_db):
+    """Removes the DC offset and scales the clip to `target_peak`, amplifying by at most `max_gain_db`."""
+    samples = samples - np.mean(samples)
+    peak = np.max(np.abs(samples))
+    if peak == 0:
+        return samples.astype(np.float32)
+    gain = min(target_peak / peak, 10 ** (max_gain_db / 20))
+    return (samples * gain).astype(np.float32)
+
+
+def speech_frames(energies, threshold, min_rms):
+    """
+    Boolean speech mask of the frames with RMS `energies`. The noise floor is the 10th percentile of
+    the clip's frame energies, so it adapts to the recording rather than being fixed.
+    """
+    noise_floor = np.percentile(energies, 10)
+    loud = energies > max(min_rms, threshold * noise_floor)
+    context = np.convolve(loud.astype(np.int32), np.ones(SPEECH_CONTEXT_FRAMES, dtype=np.int32), mode='same')
+    return loud & (context >= SPEECH_MIN_FRAMES)
+
+
+def trim_silence(samples, sample_rate, threshold, min_rms, padding_ms):
+    """
+    Cuts leading and trailing non-speech, keeping `padding_ms` around the speech. Clips where no
+    speech is detected are returned unchanged and left to the recogniser.
+    """
+    frame_size = int(sample_rate * FRAME_MS / 1000)
+    if len(samples) < frame_size * SPEECH_CONTEXT_FRAMES:
+        return samples
+    speech = np.flatnonzero(speech_frames(frame_rms(samples, frame_size), threshold, min_rms))
+    if len(speech) == 0:
+        return samples
+    padding = int(sample_rate * padding_ms / 1000)
+    start = max(0, speech[0] * frame_size - padding)
+    end = min(len(samples), (speech[-1] + 1) * frame_size + padding)
+    return samples[start:end]
+
+
+def spectral_gate(samples, threshold, attenuation_db):
+    """
+    Attenuates every STFT bin that isn't `threshold` times louder than the noise in its frequency
+    band. The noise spectrum is the mean of the quietest 20% of frames. Gains are smoothed over
+    three frames to avoid "musical noise" artefacts.
+    """
+    if len(samples) < GATE_FFT_SIZE * 2:
+        return samples
+    window = np.hanning(GATE_FFT_SIZE + 1)[:-1].astype(np.float32)
+    half = GATE_FFT_SIZE // 2
+    padded = np.pad(samples, (half, half + GATE_HOP), mode='reflect')
+    frames = sliding_window_view(padded, GATE_FFT_SIZE)[::GATE_HOP]
+    spectrum = np.fft.rfft(frames * window, axis=1)
+    magnitude = np.abs(spectrum)
+
+    energies = np.mean(magnitude ** 2, axis=1)
+    quiet = energies <= np.percentile(energies, 20)
+    noise = np.mean(magnitude[quiet], axis=0)
+    floor = 10 ** (-attenuation_db / 20)
+    gains = np.where(magnitude > threshold * noise, 1.0, floor)
+    gains = np.apply_along_axis(lambda band: np.convolve(band, np.ones(3) / 3, mode='same'), 0, gains)
+
+    # Weighted overlap-add of the filtered frames
+    cleaned = np.fft.irfft(spectrum * gains, n=GATE_FFT_SIZE, axis=1) * window
+    positions = (np.arange(len(frames))[:, None] * GATE_HOP + np.arange(GATE_FFT_SIZE)).ravel()
+    output = np.bincount(positions, weights=cleaned.ravel(), minlength=len(padded))
+    norm = np.bincount(positions, weights=np.tile(window ** 2, len(frames)), minlength=len(padded))
+    output = output / np.maximum(norm, 1e-8)
+    return output[half:half + len(samples)].astype(np.float32)
+
+
+class AudioPreprocessor:
+    """
+    Prepares a decoded clip for Whisper, whose cost grows with clip length: resamples it to 16 kHz,
+    normalises its level, trims leading and trailing silence and, optionally, gates background
+    noise. Each step is timed as a request stage (see metrics.stage).
+    """
+
+    def __init__(self, enabled, target_peak, max_gain_db, trim, vad_threshold, vad_min_rms, padding_ms,
+                 noise_gate, noise_gate_threshold, noise_gate_attenuation_db):
+        self.enabled = enabled
+        self.target_peak = target_peak
+        self.max_gain_db = max_gain_db
+        self.trim = trim
+        self.vad_threshold = vad_threshold
+        self.vad_min_rms = vad_min_rms
+        self.padding_ms = padding_ms
+        self.noise_gate = noise_gate
+        self.noise_gate_threshold = noise_gate_threshold
+        self.noise_gate_attenuation_db = noise_gate_attenuation_db
+        self._lock = threading.Lock()
+        self._stats = {'clips': 0, 'input_seconds': 0.0, 'output_seconds': 0.0}
+
+    @property
+    def fingerprint(self):
+        """Short hash of the settings that shape the output, for keying results computed from it."""
+        if not self.enabled:
+            return 'off'
+        settings = [self.target_peak, self.max_gain_db, self.trim, self.vad_threshold, self.vad_min_rms,
+                    self.padding_ms, self.noise_gate, self.noise_gate_threshold, self.noise_gate_attenuation_db]
+        return hashlib.blake2b(json.dumps(settings).encode(), digest_size=4).hexdigest()
+
+    def process(self, samples, sample_rate=SAMPLE_RATE):
+        """Returns the float32 samples, at SAMPLE_RATE, to transcribe instead of `samples`."""
+        input_seconds = len(samples) / sample_rate
+        if sample_rate != SAMPLE_RATE:
+            with metrics.stage('resample'):
+                samples = resample(samples, sample_rate, SAMPLE_RATE)
+        if self.enabled and len(samples):
+            with metrics.stage('normalize'):
+                samples = normalize(samples, self.target_peak, self.max_gain_db)
+            if self.trim:
+                with metrics.stage('trim'):
+                    samples = trim_silence(samples, SAMPLE_RATE, self.vad_threshold, self.vad_min_rms,
+                                           self.padding_ms)
+            if self.noise_gate:
+                with metrics.stage('noise_gate'):
+                    samples = spectral_gate(samples, self.noise_gate_threshold, self.noise_gate_attenuation_db)
+
+        with self._lock:
+            self._stats['clips'] += 1
+            self._stats['input_seconds'] += input_seconds
+            self._stats['output_seconds'] += len(samples) / SAMPLE_RATE
+        return samples
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['enabled'] = self.enabled
+        # Share of the audio Whisper no longer has to transcribe
+        stats['trimmed_ratio'] = 1 - stats['output_seconds'] / stats['input_seconds'] if stats['input_seconds'] else 0.0
+        return stats
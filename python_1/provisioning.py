@@ -0,0 +1,336 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+import mysql.connector
+
+from command_parser import AREA_TO_ROOM, ROOMS
+
+# Bulk provisioning configuration (can be overridden through the environment)
+provisioning_config = {
+    # Records written per transaction, with one multi-row INSERT per table
+    'batch_size': int(os.environ.get('PROVISION_BATCH_SIZE', 200)),
+}
+
+ROLES = ('owner', 'resident')
+
+# Errors that say a row itself is wrong; anything else (e.g. the database going away) stops the run
+ROW_ERRORS = (mysql.connector.errors.IntegrityError, mysql.connector.errors.DataError,
+              mysql.connector.errors.ProgrammingError)
+
+
+def parse_preferences(preferences):
+    """
+    Validates a list of {'room', 'intent', 'intensity'} preferences (rooms may also be given as areas,
+    as on /register) and returns it with every room mapped to its canonical name.
+    """
+    if preferences is None:
+        return []
+    if not isinstance(preferences, list):
+        raise ValueError("preferences must be a list")
+    parsed = []
+    for pref in preferences:
+        if not isinstance(pref, dict):
+            raise ValueError(f"Invalid preference: {pref}")
+        room = pref.get('room')
+        if isinstance(room, dict):
+            room = room.get('room')
+        room = AREA_TO_ROOM.get(room, room)
+        if room not in ROOMS:
+            raise ValueError(f"Invalid room in preferences: {pref.get('room')}")
+        if pref.get('intent') not in (0, 1):
+            raise ValueError(f"Invalid intent in preferences: {pref.get('intent')}")
+        if pref.get('intensity') not in (0, 1):
+            raise ValueError(f"Invalid intensity in preferences: {pref.get('intensity')}")
+        parsed.append({'room': room, 'intent': pref['intent'], 'intensity': pref['intensity']})
+    return parsed
+
+
+def _text(record, field):
+    value = record.get(field)
+    if not isinstance(value, str) or not value.strip():
+        raise ValueError(f"{field} is required")
+    return value
+
+
+def _uuid(record, field):
+    try:
+        return str(uuid.UUID(str(record.get(field))))
+    except ValueError:
+        raise ValueError(f"Invalid {field}: {record.get(field)}")
+
+
+class _Row:
+    # One accepted line of the stream and everything it writes
+    def __init__(self, line, kind):
+        self.line = line
+        self.kind = kind
+        self.admin = None  # admin row of a new household
+        self.users = []  # (userId, name, adminId, role) of new users
+        self.preferences = []  # (userId, preferences) to upsert
+        self.admin_id = None  # household the row belongs to, once known
+        self.username = None  # username of the household, resolved against the database when admin_id is None
+        self.user_id = None  # existing user whose preferences are updated
+        self.household_line = None  # line of the household in this stream the row belongs to
+
+    def result(self):
+        result = {'line': self.line, 'type': self.kind, 'adminId': self.admin_id}
+        if self.kind == 'preferences':
+            result['userId'] = self.user_id
+        else:
+            result['userIds'] = [user[0] for user in self.users]
+        return result
+
+
+class Provisioner:
+    """
+    Onboards households in bulk from a newline-delimited JSON stream, one record per line:
+
+    - {"type": "household", "name", "username", "password", "houseAddress", "preferences",
+      "residents": [{"name", "role", "preferences"}, ...]} creates an admin, its owner profile and
+      any residents, like /register followed by /add-profile;
+    - {"type": "resident", "adminId" or "username", "name", "role", "preferences"} adds a profile to a
+      household, created earlier in the stream or already registered;
+    - {"type": "preferences", "userId", "preferences"} upserts an existing user's room preferences.
+
+    Records are written `batch_size` at a time in one transaction, with one multi-row INSERT per
+    table. A line that can't be parsed, or refers to something that doesn't exist, is reported and
+    skipped without affecting the others; when a batch still fails, its records are retried one
+    transaction each so the error lands on the line that caused it.
+
+    Database access goes through the app's `transaction` helper, and passwords are hashed with
+    `hash_password` (the app's PasswordHasher.hash).
+    """
+
+    def __init__(self, transaction, hash_password, batch_size):
+        self.transaction = transaction
+        self.hash_password = hash_password
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._stats = {
+            'runs': 0,
+            'lines': 0,
+            'rejected': 0,
+            'batches': 0,
+            'batch_retries': 0,
+            'households': 0,
+            'users': 0,
+            'preferences': 0,
+            'seconds_total': 0.0,
+        }
+
+    def _count(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self._stats[key] += value
+
+    def run(self, lines, committed=None):
+        """
+        Ingests every record in `lines` (str or bytes) and returns a summary: the number of households,
+        users and preference rows written, the ids created for every accepted line, and an error for
+        every rejected one. When the database fails for a reason other than a bad record the run stops
+        there and the summary's `aborted` holds the error; batches written before then stay written.
+
+        `committed(admin_ids, users)` is called after every batch with the households it touched and
+        the (userId, preferences) of every user it wrote.
+        """
+        started = time.monotonic()
+        summary = {'households': 0, 'users': 0, 'preferences': 0, 'created': [], 'errors': [], 'aborted': None}
+        usernames = {}  # username -> (adminId or None if it failed, line) of the households in this stream
+        batch = []
+        count = 0
+        try:
+            for count, line in enumerate(lines, 1):
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8', errors='replace')
+                if not line.strip():
+                    continue
+                try:
+                    batch.append(self._parse(count, line, usernames))
+                except ValueError as e:
+                    summary['errors'].append({'line': count, 'error': str(e)})
+                    continue
+                if len(batch) >= self.batch_size:
+                    self._write_batch(batch, usernames, summary, committed)
+                    batch = []
+            if batch:
+                self._write_batch(batch, usernames, summary, committed)
+        except mysql.connector.Error as e:
+            print(f"Provisioning stopped at line {count}: {e}")
+            summary['aborted'] = f"Stopped at line {count}: {e}"
+
+        self._count(runs=1, lines=count, rejected=len(summary['errors']), households=summary['households'],
+                    users=summary['users'], preferences=summary['preferences'],
+                    seconds_total=time.monotonic() - started)
+        return summary
+
+    def _parse(self, line, text, usernames):
+        try:
+            record = json.loads(text)
+        except ValueError as e:
+            raise ValueError(f"Invalid JSON: {e}")
+        if not isinstance(record, dict):
+            raise ValueError("Each line must be a JSON object")
+
+        kind = record.get('type')
+        row = _Row(line, kind)
+        if kind == 'household':
+            name = _text(record, 'name')
+            username = _text(record, 'username')
+            password = _text(record, 'password')
+            if username in usernames:
+                raise ValueError(f"Username {username} is already used on line {usernames[username][1]}")
+            residents = record.get('residents') or []
+            if not isinstance(residents, list):
+                raise ValueError("residents must be a list")
+            row.admin_id = str(uuid.uuid4())
+            row.username = username
+            row.admin = (row.admin_id, name, username, self.hash_password(password), record.get('houseAddress'))
+            self._add_user(row, name, 'owner', record.get('preferences'))
+            for resident in residents:
+                if not isinstance(resident, dict):
+                    raise ValueError(f"Invalid resident: {resident}")
+                self._add_user(row, _text(resident, 'name'), resident.get('role') or 'resident',
+                               resident.get('preferences'))
+            usernames[username] = (row.admin_id, line)
+        elif kind == 'resident':
+            if record.get('adminId') is not None:
+                row.admin_id = _uuid(record, 'adminId')
+            else:
+                username = _text(record, 'username')
+                row.username = username
+                if username in usernames:
+                    row.admin_id, row.household_line = usernames[username]
+                    if row.admin_id is None:
+                        raise ValueError(f"Household {username} on line {row.household_line} was not created")
+            self._add_user(row, _text(record, 'name'), record.get('role') or 'resident', record.get('preferences'))
+        elif kind == 'preferences':
+            row.user_id = _uuid(record, 'userId')
+            preferences = parse_preferences(record.get('preferences'))
+            if not preferences:
+                raise ValueError("preferences are required")
+            row.preferences.append((row.user_id, preferences))
+        else:
+            raise ValueError(f"Unknown record type: {kind}")
+        return row
+
+    @staticmethod
+    def _add_user(row, name, role, preferences):
+        if role not in ROLES:
+            raise ValueError(f"Invalid role: {role}")
+        user_id = str(uuid.uuid4())
+        row.users.append((user_id, name, row.admin_id, role))
+        row.preferences.append((user_id, parse_preferences(preferences)))
+
+    def _write_batch(self, batch, usernames, summary, committed):
+        try:
+            written, rejected = self._write(batch)
+            self._count(batches=1)
+        except ROW_ERRORS as e:
+            # Find the record(s) responsible by writing every one on its own
+            print(f"Provisioning batch rolled back ({e}), retrying its {len(batch)} records one by one")
+            self._count(batch_retries=1)
+            written, rejected = [], []
+            for row in batch:
+                try:
+                    row_written, row_rejected = self._write([row])
+                except ROW_ERRORS as row_error:
+                    row_written, row_rejected = [], [(row, str(row_error))]
+                written += row_written
+                rejected += row_rejected
+
+        for row, error in rejected:
+            summary['errors'].append({'line': row.line, 'error': error})
+            if row.kind == 'household':
+                # Later lines can't add residents to it
+                usernames[row.username] = (None, row.line)
+        for row in written:
+            summary['created'].append(row.result())
+            summary['households'] += 1 if row.admin else 0
+            summary['users'] += len(row.users)
+            summary['preferences'] += sum(len(preferences) for _, preferences in row.preferences)
+        summary['errors'].sort(key=lambda error: error['line'])
+        summary['created'].sort(key=lambda result: result['line'])
+
+        if committed is not None and written:
+            admin_ids = list(dict.fromkeys(row.admin_id for row in written))
+            committed(admin_ids, [update for row in written for update in row.preferences])
+
+    def _write(self, rows):
+        """
+        Writes `rows` in one transaction. Rows referring to a household or user that doesn't exist,
+        or creating a username that does, are left out. Returns (written rows, [(row, error), ...]).
+        """
+        rejected = []
+        with self.transaction() as cursor:
+            households = [row for row in rows if row.admin]
+            taken = self._select(cursor, "SELECT username FROM admin WHERE username IN ({})",
+                                 [row.username for row in households])
+            for row in households:
+                if row.username in taken:
+                    rejected.append((row, f"Username {row.username} already exists"))
+            created = {row.admin_id for row in households if row.username not in taken}
+
+            # Residents of households that were registered before this stream
+            lookups = [row for row in rows if row.kind == 'resident' and row.admin_id is None and row.username]
+            found = self._select(cursor, "SELECT username, adminId FROM admin WHERE username IN ({})",
+                                 [row.username for row in lookups], pairs=True)
+            for row in lookups:
+                row.admin_id = found.get(row.username)
+                row.users = [(user_id, name, row.admin_id, role) for user_id, name, _, role in row.users]
+
+            residents = [row for row in rows if row.kind == 'resident']
+            existing = self._select(cursor, "SELECT adminId FROM admin WHERE adminId IN ({})",
+                                    [row.admin_id for row in residents if row.admin_id and row.admin_id not in created])
+            for row in residents:
+                if row.admin_id in created or row.admin_id in existing:
+                    continue
+                if row.household_line:
+                    rejected.append((row, f"Household {row.username} on line {row.household_line} was not created"))
+                else:
+                    rejected.append((row, f"Household {row.username or row.admin_id} not found"))
+
+            updates = [row for row in rows if row.kind == 'preferences']
+            users = self._select(cursor, "SELECT userId, adminId FROM users WHERE userId IN ({})",
+                                 [row.user_id for row in updates], pairs=True)
+            for row in updates:
+                if row.user_id in users:
+                    row.admin_id = users[row.user_id]
+                else:
+                    rejected.append((row, f"User {row.user_id} not found"))
+
+            skipped = {id(row) for row, _ in rejected}
+            written = [row for row in rows if id(row) not in skipped]
+            self._insert(cursor, "admin (adminId, name, username, password, houseAddress)",
+                         [row.admin for row in written if row.admin])
+            self._insert(cursor, "users (userId, name, adminId, role)",
+                         [user for row in written for user in row.users])
+            self._insert(cursor, "user_preferences (preferenceId, userId, room, intent, intensity)",
+                         [(str(uuid.uuid4()), user_id, pref['room'], pref['intent'], pref['intensity'])
+                          for row in written for user_id, preferences in row.preferences for pref in preferences],
+                         "ON DUPLICATE KEY UPDATE intent = VALUES(intent), intensity = VALUES(intensity)")
+        return written, rejected
+
+    @staticmethod
+    def _select(cursor, query, values, pairs=False):
+        # The first column (or first -> second column) of every row matching one of `values`
+        values = list(dict.fromkeys(values))
+        if not values:
+            return {} if pairs else set()
+        cursor.execute(query.format(", ".join(["%s"] * len(values))), values)
+        rows = [tuple(row.values()) if isinstance(row, dict) else row for row in cursor.fetchall()]
+        return {row[0]: row[1] for row in rows} if pairs else {row[0] for row in rows}
+
+    @staticmethod
+    def _insert(cursor, table, rows, suffix=""):
+        if not rows:
+            return
+        placeholders = "(" + ", ".join(["%s"] * len(rows[0])) + ")"
+        query = f"INSERT INTO {table} VALUES {', '.join([placeholders] * len(rows))} {suffix}"
+        cursor.execute(query, [value for row in rows for value in row])
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,378 @@
+import gzip
+import json
+import os
+import subprocess
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+# Retention configuration (can be overridden through the environment). The age and quota settings are
+# the default policy for households without a row in retention_policies; 0 disables a step
+retention_config = {
+    'enabled': os.environ.get('RETENTION_ENABLED', '1') == '1',
+    'interval': float(os.environ.get('RETENTION_INTERVAL', 3600)),
+    'batch_size': int(os.environ.get('RETENTION_BATCH_SIZE', 200)),
+    # Pause between batches so retention never competes with requests for the database or the disk
+    'batch_pause': float(os.environ.get('RETENTION_BATCH_PAUSE', 0.5)),
+    'codec': os.environ.get('RETENTION_CODEC', 'opus'),
+    'archive': os.environ.get('RETENTION_ARCHIVE', 'table'),
+    'archive_dir': os.environ.get('RETENTION_ARCHIVE_DIR', os.path.join('uploads', 'archive')),
+    'default_policy': {
+        'compress_after_days': int(os.environ.get('RETENTION_COMPRESS_AFTER_DAYS', 0)),
+        'archive_after_days': int(os.environ.get('RETENTION_ARCHIVE_AFTER_DAYS', 0)),
+        'delete_after_days': int(os.environ.get('RETENTION_DELETE_AFTER_DAYS', 0)),
+        'quota_mb': int(os.environ.get('RETENTION_QUOTA_MB', 0)),
+    },
+}
+
+# Codecs old recordings are re-encoded with (mono, 16 kHz, which is all the recogniser ever uses)
+CODECS = {
+    'opus': {'extension': '.opus', 'format': 'ogg', 'args': ['-c:a', 'libopus', '-b:a', '16k', '-application', 'voip']},
+    'flac': {'extension': '.flac', 'format': 'flac', 'args': ['-c:a', 'flac', '-compression_level', '8']},
+}
+
+ARCHIVES = ('table', 'jsonl')
+
+
+def transcode(path, codec):
+    """Re-encodes the recording at `path` with `codec` next to it and returns the new path."""
+    spec = CODECS[codec]
+    target = os.path.splitext(path)[0] + spec['extension']
+    temporary = f"{target}.tmp"
+    command = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+        '-i', path,
+        '-ac', '1', '-ar', '16000', *spec['args'],
+        '-f', spec['format'], temporary,
+    ]
+    try:
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
+    except subprocess.CalledProcessError as e:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise ValueError(f"Could not transcode {path}: {e.stderr.decode(errors='replace').strip()}")
+    os.replace(temporary, target)
+    return target
+
+
+class RetentionWorker:
+    """
+    Background job that keeps stored recordings and conversation rows within each household's
+    retention policy, one household and one batch at a time:
+
+    1. compress: recordings older than `compress_after_days` are re-encoded with `codec`;
+    2. archive: rows older than `archive_after_days` move out of audio_files, into the
+       audio_files_archive table or gzipped JSON-lines files under `archive_dir`;
+    3. delete: recordings and archived rows older than `delete_after_days` are removed;
+    4. quota: the oldest recordings are removed until the household's are under `quota_mb`.
+
+    Database access goes through the app's `execute_query` and `transaction` helpers.
+    """
+
+    def __init__(self, execute_query, transaction, enabled, interval, batch_size, batch_pause, codec, archive,
+                 archive_dir, default_policy):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown retention codec {codec!r}, expected one of {', '.join(CODECS)}")
+        if archive not in ARCHIVES:
+            raise ValueError(f"Unknown retention archive {archive!r}, expected one of {', '.join(ARCHIVES)}")
+        self.execute_query = execute_query
+        self.transaction = transaction
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.codec = codec
+        self.archive = archive
+        self.archive_dir = archive_dir
+        self.default_policy = default_policy
+        self._stopping = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'runs': 0,
+            'running': False,
+            'phase': None,
+            'last_run_at': None,
+            'last_run_seconds': None,
+            'households': 0,
+            'compressed': 0,
+            'bytes_saved': 0,
+            'archived': 0,
+            'deleted_rows': 0,
+            'deleted_files': 0,
+            'quota_deleted_files': 0,
+            'errors': 0,
+        }
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+        self._thread.start()
+
+    def shutdown(self, timeout=10):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _set(self, **values):
+        with self._lock:
+            self._stats.update(values)
+
+    def _pause(self):
+        # Returns True when the worker should stop
+        return self._stopping.wait(self.batch_pause)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Retention run failed: {e}")
+                self._count('errors')
+            self._stopping.wait(self.interval)
+
+    def run_once(self):
+        started = time.monotonic()
+        self._set(running=True, last_run_at=datetime.now(timezone.utc).isoformat())
+        try:
+            policies = {row['adminId']: row for row in self.execute_query("SELECT * FROM retention_policies") or []}
+            households = self.execute_query("SELECT adminId FROM admin") or []
+            for household in households:
+                if self._stopping.is_set():
+                    return
+                admin_id = household['adminId']
+                policy = {**self.default_policy,
+                          **{key: value for key, value in policies.get(admin_id, {}).items() if value is not None}}
+                self.apply(admin_id, policy)
+                self._count('households')
+        finally:
+            with self._lock:
+                self._stats['runs'] += 1
+                self._stats['running'] = False
+                self._stats['phase'] = None
+                self._stats['last_run_seconds'] = time.monotonic() - started
+
+    def apply(self, admin_id, policy):
+        users = [row['userId'] for row in
+                 self.execute_query("SELECT userId FROM users WHERE adminId = %s", (admin_id,)) or []]
+        if not users:
+            return
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        steps = (
+            ('compress', policy['compress_after_days'], self.compress),
+            ('archive', policy['archive_after_days'], self.archive_rows),
+            ('delete', policy['delete_after_days'], self.delete),
+            ('quota', policy['quota_mb'], self.enforce_quota),
+        )
+        for phase, setting, step in steps:
+            if not setting or self._stopping.is_set():
+                continue
+            self._set(phase=f"{phase}:{admin_id}")
+            if phase == 'quota':
+                step(users, setting * 1024 * 1024)
+            else:
+                step(admin_id, users, now - timedelta(days=setting))
+
+    @staticmethod
+    def _in(users):
+        return ", ".join(["%s"] * len(users))
+
+    def compress(self, admin_id, users, cutoff):
+        extension = CODECS[self.codec]['extension']
+        position = (datetime(1970, 1, 1), '')
+        while not self._stopping.is_set():
+            # Walk the household's old rows once, oldest first, so failed files aren't retried in a loop
+            query = f"""
+                SELECT id, file_path, created_at FROM audio_files
+                WHERE user_id IN ({self._in(users)}) AND created_at < %s
+                  AND (created_at > %s OR (created_at = %s AND id > %s))
+                  AND file_path <> '' AND file_path NOT LIKE %s
+                ORDER BY created_at, id
+                LIMIT %s
+            """
+            rows = self.execute_query(query, (*users, cutoff, position[0], position[0], position[1],
+                                              f"%{extension}", self.batch_size)) or []
+            for row in rows:
+                self._compress_file(row)
+            if len(rows) < self.batch_size or self._pause():
+                return
+            position = (rows[-1]['created_at'], rows[-1]['id'])
+
+    def _compress_file(self, row):
+        path = row['file_path']
+        if not os.path.exists(path):
+            # Nothing left to keep; stop pointing at a missing recording
+            self._update_file_path(row['id'], '')
+            return
+        try:
+            original = os.stat(path)
+            size = original.st_size
+            target = transcode(path, self.codec)
+            # Keep the recording's age, which the quota step goes by
+            os.utime(target, ns=(original.st_atime_ns, original.st_mtime_ns))
+            self._update_file_path(row['id'], target)
+            self._count('bytes_saved', size - os.path.getsize(target))
+            os.remove(path)
+            self._count('compressed')
+        except (OSError, ValueError) as e:
+            print(f"Retention could not compress {path}: {e}")
+            self._count('errors')
+
+    def _update_file_path(self, file_id, file_path):
+        with self.transaction() as cursor:
+            cursor.execute("UPDATE audio_files SET file_path = %s WHERE id = %s", (file_path, file_id))
+            cursor.execute("UPDATE audio_files_archive SET file_path = %s WHERE id = %s", (file_path, file_id))
+
+    def archive_rows(self, admin_id, users, cutoff):
+        select_query = f"""
+            SELECT id, user_id, file_path, transcribed_text, created_at FROM audio_files
+            WHERE user_id IN ({self._in(users)}) AND created_at < %s
+            ORDER BY created_at, id
+            LIMIT %s
+        """
+        while not self._stopping.is_set():
+            with self.transaction() as cursor:
+                cursor.execute(select_query, (*users, cutoff, self.batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    return
+                if self.archive == 'table':
+                    placeholders = ", ".join(["(%s, %s, %s, %s, %s)"] * len(rows))
+                    cursor.execute(f"""
+                        INSERT INTO audio_files_archive (id, user_id, file_path, transcribed_text, created_at)
+                        VALUES {placeholders}
+                        ON DUPLICATE KEY UPDATE id = id
+                    """, [row[column] for row in rows
+                          for column in ('id', 'user_id', 'file_path', 'transcribed_text', 'created_at')])
+                else:
+                    # Written before the rows are deleted; if the delete fails they are archived twice, never lost
+                    self._append_jsonl(admin_id, rows)
+                cursor.execute(f"DELETE FROM audio_files WHERE id IN ({self._in(rows)})",
+                               [row['id'] for row in rows])
+            self._count('archived', len(rows))
+            if len(rows) < self.batch_size or self._pause():
+                return
+
+    def _archive_path(self, admin_id, month):
+        return os.path.join(self.archive_dir, admin_id, f"{month}.jsonl.gz")
+
+    def _append_jsonl(self, admin_id, rows):
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(row['created_at'].strftime('%Y-%m'), []).append(row)
+        for month, month_rows in by_month.items():
+            path = self._archive_path(admin_id, month)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Each append is a separate gzip member; gzip readers treat the file as one stream
+            with gzip.open(path, 'at') as archive:
+                for row in month_rows:
+                    archive.write(json.dumps({**row, 'created_at': row['created_at'].isoformat()}) + "\n")
+
+    def delete(self, admin_id, users, cutoff):
+        for table in ('audio_files', 'audio_files_archive'):
+            select_query = f"""
+                SELECT id, file_path FROM {table}
+                WHERE user_id IN ({self._in(users)}) AND created_at < %s
+                ORDER BY created_at, id
+                LIMIT %s
+            """
+            while not self._stopping.is_set():
+                rows = self.execute_query(select_query, (*users, cutoff, self.batch_size)) or []
+                if not rows:
+                    break
+                for row in rows:
+                    self._remove_file(row['file_path'], 'deleted_files')
+                with self.transaction() as cursor:
+                    cursor.execute(f"DELETE FROM {table} WHERE id IN ({self._in(rows)})", [row['id'] for row in rows])
+                self._count('deleted_rows', len(rows))
+                if len(rows) < self.batch_size or self._pause():
+                    break
+
+        # JSON-lines archives are kept per month; drop the months that ended before the cutoff
+        household_dir = os.path.join(self.archive_dir, admin_id)
+        if self.archive == 'jsonl' and os.path.isdir(household_dir):
+            for name in os.listdir(household_dir):
+                month = name.split('.', 1)[0]
+                try:
+                    month_end = (datetime.strptime(month, '%Y-%m') + timedelta(days=31)).replace(day=1)
+                except ValueError:
+                    continue
+                if month_end <= cutoff:
+                    self._delete_archive_month(os.path.join(household_dir, name))
+
+    def _delete_archive_month(self, path):
+        # The recordings of the archived rows go first; a month file that can't be read is kept for the next run
+        try:
+            with gzip.open(path, 'rt') as archive:
+                file_paths = [json.loads(line)['file_path'] for line in archive if line.strip()]
+        except (OSError, EOFError, ValueError, KeyError) as e:
+            print(f"Retention could not read archive {path}: {e}")
+            self._count('errors')
+            return
+        for file_path in file_paths:
+            self._remove_file(file_path, 'deleted_files')
+        self._remove_file(path, 'deleted_files')
+        self._count('deleted_rows', len(file_paths))
+
+    def _remove_file(self, path, counter):
+        if not path:
+            return
+        try:
+            os.remove(path)
+            self._count(counter)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Retention could not remove {path}: {e}")
+            self._count('errors')
+
+    def enforce_quota(self, users, quota_bytes):
+        recordings = []
+        for user_id in users:
+            directory = os.path.join("uploads", user_id)
+            if not os.path.isdir(directory):
+                continue
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        recordings.append((stat.st_mtime, stat.st_size, entry.path, entry.name))
+        total = sum(size for _, size, _, _ in recordings)
+        if total <= quota_bytes:
+            return
+
+        recordings.sort()
+        removed = []
+        for _, size, path, name in recordings:
+            if total <= quota_bytes:
+                break
+            self._remove_file(path, 'quota_deleted_files')
+            total -= size
+            # Recordings are named after their audio_files id
+            removed.append(name.split('.', 1)[0])
+            if len(removed) == self.batch_size:
+                self._clear_file_paths(removed)
+                removed = []
+                if self._pause():
+                    return
+        self._clear_file_paths(removed)
+
+    def _clear_file_paths(self, file_ids):
+        if not file_ids:
+            return
+        with self.transaction() as cursor:
+            for table in ('audio_files', 'audio_files_archive'):
+                cursor.execute(f"UPDATE {table} SET file_path = '' WHERE id IN ({self._in(file_ids)})", file_ids)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['enabled'] = self.enabled
+        stats['codec'] = self.codec
+        stats['archive'] = self.archive
+        return stats
@@ -0,0 +1,418 @@
+"""
+Production server: loads the Whisper model once in a parent process, then forks worker processes that
+serve the app from one shared listening socket. The workers share the model's weights with the parent
+copy-on-write, so adding workers adds their working memory but not another copy of the model.
+
+    python serve.py [--workers 8] [--torch-threads 2] [--host 0.0.0.0] [--port 5000]
+
+Signals to the parent process:
+    HUP       replace every worker with a fresh one without dropping connections
+    TERM/INT  stop: workers finish their in-flight requests (up to SERVE_GRACEFUL_TIMEOUT seconds)
+    USR1      print the resident and proportional memory of every process
+
+Relies on fork, so it runs on Linux and macOS only; use App.py or asgi.py elsewhere.
+"""
+import argparse
+import atexit
+import gc
+import json
+import os
+import selectors
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import traceback
+
+from werkzeug.serving import make_server
+from werkzeug.wsgi import ClosingIterator
+
+# Server configuration (can be overridden through the environment or the command line)
+serve_config = {
+    'host': os.environ.get('SERVE_HOST', '127.0.0.1'),
+    'port': int(os.environ.get('SERVE_PORT', 5000)),
+    'workers': int(os.environ.get('SERVE_WORKERS', os.cpu_count() or 1)),
+    # Torch intra-op threads per worker; 0 divides the cores evenly between the workers
+    'torch_threads': int(os.environ.get('SERVE_TORCH_THREADS', 0)),
+    # Load the model before forking; without it every worker loads its own copy on first use
+    'preload': os.environ.get('SERVE_PRELOAD', '1') == '1',
+    'graceful_timeout': float(os.environ.get('SERVE_GRACEFUL_TIMEOUT', 30)),
+}
+
+
+class PeerBus:
+    """
+    A worker's connection to the other workers, relayed by the parent: one JSON message per line over
+    a socket pair. App uses it to keep the other workers' caches and light state in step with its own.
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+        self._lock = threading.Lock()
+
+    def publish(self, message):
+        data = (json.dumps(message, default=str) + '\n').encode()
+        with self._lock:
+            try:
+                self._channel.sendall(data)
+            except OSError as e:
+                print(f"Could not notify the other workers: {e}")
+
+    def listen(self, apply):
+        threading.Thread(target=self._receive, args=(apply,), name='peer-bus', daemon=True).start()
+
+    def _receive(self, apply):
+        with self._channel.makefile('rb') as lines:
+            for line in lines:
+                try:
+                    apply(json.loads(line))
+                except Exception as e:
+                    print(f"Could not apply a message from another worker: {e}")
+
+
+class InFlight:
+    """WSGI middleware counting the requests whose responses haven't been sent yet, so a stopping worker can wait."""
+
+    def __init__(self, app):
+        self.app = app
+        self.count = 0
+        self._idle = threading.Condition()
+
+    def __call__(self, environ, start_response):
+        with self._idle:
+            self.count += 1
+        try:
+            return ClosingIterator(self.app(environ, start_response), self._done)
+        except BaseException:
+            self._done()
+            raise
+
+    def _done(self):
+        with self._idle:
+            self.count -= 1
+            if not self.count:
+                self._idle.notify_all()
+
+    def wait(self, timeout):
+        with self._idle:
+            return self._idle.wait_for(lambda: not self.count, timeout)
+
+
+def preload_model():
+    """Loads the scheduler's model into this process; returns whether it was loaded."""
+    import App
+    from asr import preload_pipeline, set_torch_threads
+
+    spec = App.asr_scheduler.spec
+    if spec['backend'] == 'onnx':
+        # ONNX Runtime's thread pools don't survive fork
+        print("The onnx backend can't be shared between workers; each worker loads its own copy")
+        return False
+    started = time.monotonic()
+    try:
+        # A single thread while loading keeps torch from starting its thread pool before the fork;
+        # every worker sets its own count afterwards
+        set_torch_threads(1, 0)
+        preload_pipeline(spec['model'], spec['backend'])
+    except Exception as e:
+        print(f"Could not preload {spec['model']}, each worker loads its own copy:", e)
+        return False
+    print(f"Loaded {spec['model']} ({spec['backend']}) in {time.monotonic() - started:.1f} s")
+    return True
+
+
+def memory(pid):
+    """Returns (rss, pss) of a process in bytes from /proc, or None where that isn't available."""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as rollup:
+            for line in rollup:
+                name, _, rest = line.partition(':')
+                if name in ('Rss', 'Pss'):
+                    values[name] = int(rest.split()[0]) * 1024
+    except (OSError, ValueError):
+        return None
+    return values.get('Rss'), values.get('Pss')
+
+
+def run_worker(index, listener, channel, config, preloaded):
+    import App
+    from asr import set_torch_threads
+
+    # The parent handles Ctrl+C and reloads and tells the workers to stop with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+
+    if preloaded:
+        set_torch_threads(config['torch_threads'], 0)
+    App.peer_bus = PeerBus(channel)
+    App.peer_bus.listen(App.apply_peer_message)
+    # The transcription "workers" are threads in this process using the preloaded model (ASR_WORKERS=0)
+    App.start_background_services(retention=index == 0)
+
+    app = InFlight(App.app)
+    server = make_server(config['host'], config['port'], app, threaded=True, fd=listener.fileno())
+    # server.shutdown() waits for serve_forever to return, so it can't run on the thread that's serving
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    print(f"Worker {index} (pid {os.getpid()}) serving")
+    server.serve_forever()
+
+    # Open event streams end once the light state store stops
+    App.light_state.shutdown()
+    if not app.wait(config['graceful_timeout']):
+        print(f"Worker {index} stopping with {app.count} requests still in flight")
+    server.server_close()
+
+
+class WorkerProcess:
+    def __init__(self, index, pid, channel):
+        self.index = index
+        self.pid = pid
+        self.channel = channel
+        self.buffer = b''
+        self.started_at = time.monotonic()
+        # Set once the worker has been told to stop; it's killed if still running at that time
+        self.kill_at = None
+
+
+class Launcher:
+    """
+    Parent process: forks the workers, replaces those that die, relays messages between them and turns
+    signals into reloads and shutdowns.
+    """
+
+    def __init__(self, listener, config, preloaded):
+        self.listener = listener
+        self.config = config
+        self.preloaded = preloaded
+        self.workers = {}  # pid -> WorkerProcess
+        self.selector = selectors.DefaultSelector()
+        self.stopping = False
+        self._signals = []
+        self._respawn = {}  # worker index -> time at which to restart it
+        # Latest light state of each household and the sessions ended before they expire, so that new workers
+        # start from them
+        self._light_states = {}  # adminId -> (version, updated_at, message line)
+        self._revocations = {}  # session id -> (expiry, message line)
+
+    def spawn(self, index):
+        parent_end, worker_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                parent_end.close()
+                self.selector.close()
+                for worker in self.workers.values():
+                    if worker.channel is not None:
+                        worker.channel.close()
+                run_worker(index, self.listener, worker_end, self.config, self.preloaded)
+                # Leaving through os._exit skips atexit, which flushes the audio log and snapshots the light state
+                atexit._run_exitfuncs()
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+
+        worker_end.close()
+        # A worker that stops reading mustn't stall the relay for the others
+        parent_end.settimeout(1)
+        worker = WorkerProcess(index, pid, parent_end)
+        self.workers[pid] = worker
+        self.selector.register(parent_end, selectors.EVENT_READ, worker)
+        self._catch_up(worker)
+        return worker
+
+    def _catch_up(self, worker):
+        for _, _, line in self._light_states.values():
+            self._send(worker, line)
+        now = time.time()
+        self._revocations = {jti: revocation for jti, revocation in self._revocations.items() if revocation[0] > now}
+        for _, line in self._revocations.values():
+            self._send(worker, line)
+
+    def _send(self, worker, data):
+        if worker.channel is None:
+            return
+        try:
+            worker.channel.sendall(data)
+        except OSError as e:
+            print(f"Could not relay a message to worker {worker.index} (pid {worker.pid}): {e}")
+
+    def _relay(self, worker):
+        try:
+            data = worker.channel.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._close_channel(worker)
+            return
+        *lines, worker.buffer = (worker.buffer + data).split(b'\n')
+        for line in lines:
+            line += b'\n'
+            self._remember(line)
+            for other in list(self.workers.values()):
+                if other is not worker:
+                    self._send(other, line)
+
+    def _remember(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            return
+        if message.get('kind') == 'revoke':
+            self._revocations[message['jti']] = (message['exp'], line)
+            return
+        if message.get('kind') != 'light_state':
+            return
+        state = message['state']
+        latest = (state['version'], state['updated_at'] or 0, line)
+        current = self._light_states.get(message['admin_id'])
+        if current is None or latest[:2] >= current[:2]:
+            self._light_states[message['admin_id']] = latest
+
+    def _close_channel(self, worker):
+        if worker.channel is not None:
+            self.selector.unregister(worker.channel)
+            worker.channel.close()
+            worker.channel = None
+
+    def stop_worker(self, worker):
+        if worker.kill_at is None:
+            worker.kill_at = time.monotonic() + self.config['graceful_timeout'] + 5
+            try:
+                os.kill(worker.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            self._close_channel(worker)
+            if worker.kill_at is None and not self.stopping:
+                lived = time.monotonic() - worker.started_at
+                print(f"Worker {worker.index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)} "
+                      f"after {lived:.0f} s, restarting")
+                # Don't spin when workers die right after starting
+                self._respawn[worker.index] = time.monotonic() + (1 if lived < 5 else 0)
+
+    def reload(self):
+        print(f"Reloading {len(self.workers)} workers")
+        for worker in [worker for worker in self.workers.values() if worker.kill_at is None]:
+            self.spawn(worker.index)
+            self.stop_worker(worker)
+
+    def stop(self):
+        print("Stopping")
+        self.stopping = True
+        self._respawn.clear()
+        for worker in list(self.workers.values()):
+            self.stop_worker(worker)
+
+    def memory_report(self):
+        processes = [('parent', os.getpid())]
+        processes += [(f"worker {worker.index}", worker.pid)
+                      for worker in sorted(self.workers.values(), key=lambda worker: worker.index)]
+        for label, pid in processes:
+            usage = memory(pid)
+            if usage is None:
+                print(f"{label} (pid {pid}): memory usage unavailable")
+            else:
+                rss, pss = usage
+                print(f"{label} (pid {pid}): rss {rss / 2 ** 20:.0f} MB, pss {pss / 2 ** 20:.0f} MB")
+
+    def _queue_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1):
+            signal.signal(signum, self._queue_signal)
+        for index in range(self.config['workers']):
+            self.spawn(index)
+
+        while self.workers or not self.stopping:
+            for key, _ in self.selector.select(timeout=0.5):
+                if key.data.channel is not None:
+                    self._relay(key.data)
+            self.reap()
+
+            while self._signals:
+                signum = self._signals.pop(0)
+                if signum == signal.SIGHUP and not self.stopping:
+                    self.reload()
+                elif signum in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+                    self.stop()
+                elif signum == signal.SIGUSR1:
+                    self.memory_report()
+
+            now = time.monotonic()
+            for index, respawn_at in list(self._respawn.items()):
+                if respawn_at <= now:
+                    del self._respawn[index]
+                    self.spawn(index)
+            for worker in list(self.workers.values()):
+                if worker.kill_at is not None and worker.kill_at <= now:
+                    print(f"Worker {worker.index} (pid {worker.pid}) did not stop in time, killing it")
+                    worker.kill_at = float('inf')
+                    os.kill(worker.pid, signal.SIGKILL)
+
+        self.selector.close()
+        self.listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the app from several worker processes sharing one model")
+    parser.add_argument('--host', default=serve_config['host'])
+    parser.add_argument('--port', type=int, default=serve_config['port'])
+    parser.add_argument('--workers', type=int, default=serve_config['workers'])
+    parser.add_argument('--torch-threads', type=int, default=serve_config['torch_threads'])
+    parser.add_argument('--no-preload', dest='preload', action='store_false', default=serve_config['preload'])
+    args = parser.parse_args()
+
+    config = {**serve_config, 'host': args.host, 'port': args.port, 'workers': max(1, args.workers),
+              'preload': args.preload}
+    config['torch_threads'] = args.torch_threads or max(1, (os.cpu_count() or 1) // config['workers'])
+
+    # Each worker transcribes on a thread of its own process rather than starting ASR processes, and loads
+    # the model with its share of the cores when it wasn't preloaded. Set before App reads its configuration
+    os.environ['ASR_WORKERS'] = '0'
+    os.environ['ASR_INTRA_OP_THREADS'] = str(config['torch_threads'])
+    # Streaming sessions live in the worker that opened them, and the next request of a session may reach another
+    if config['workers'] > 1:
+        os.environ['STREAM_SESSIONS'] = '0'
+    # The tokenizers library's thread pool doesn't survive fork
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+    # /metrics on any worker reports all of them, through files in a shared directory
+    metrics_directory = None
+    if not os.environ.get('METRICS_DIR'):
+        metrics_directory = os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='smarthome-metrics-')
+
+    import App  # noqa: F401 (imported once here so the workers share it too)
+
+    listener = socket.create_server((config['host'], config['port']), backlog=1024)
+    preloaded = config['preload'] and preload_model()
+    # Keep the garbage collector from writing to (and so copying) the pages of everything loaded so far
+    gc.freeze()
+    print(f"Serving on http://{config['host']}:{config['port']} with {config['workers']} workers, "
+          f"{config['torch_threads']} torch threads each")
+    try:
+        Launcher(listener, config, preloaded).run()
+    finally:
+        if metrics_directory:
+            shutil.rmtree(metrics_directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+"""
+Storage backends behind the app's connection pool (`App.db_pool`): a MySQL server, or an embedded
+SQLite file for single-box deployments (a home hub) and offline tests and benchmarks.
+
+Both pools have the same interface (acquire, release, stats) and their connections the subset of
+the MySQL connector interface the app uses. SQLite connections accept the app's MySQL statements:
+placeholders, upserts, LIKE escapes and locking reads are rewritten to their SQLite equivalents,
+and SQLite errors are raised as mysql.connector errors, so route handlers behave the same on both.
+"""
+import functools
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+import mysql.connector
+
+# Storage backend configuration (can be overridden through the environment)
+storage_config = {
+    # 'mysql' (App.db_config) or 'sqlite'
+    'backend': os.environ.get('DB_BACKEND', 'mysql'),
+    'sqlite_path': os.environ.get('DB_SQLITE_PATH', os.path.join('backend', 'voice_control_system.sqlite3')),
+    # Compiled statements kept per SQLite connection, so repeated queries skip parsing and planning
+    'sqlite_cached_statements': int(os.environ.get('DB_SQLITE_CACHED_STATEMENTS', 256)),
+}
+
+# The schema of App.py's CREATE TABLE statements, created (with its indexes) when a SQLite database is opened.
+# MySQL indexes foreign keys by itself; SQLite needs idx_users_admin for it
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS admin (
+    adminId TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    houseAddress TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    userId TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    adminId TEXT REFERENCES admin(adminId) ON DELETE CASCADE,
+    imagePath TEXT,
+    role TEXT NOT NULL DEFAULT 'resident' CHECK (role IN ('owner', 'resident'))
+);
+CREATE INDEX IF NOT EXISTS idx_users_admin ON users (adminId);
+CREATE TABLE IF NOT EXISTS user_preferences (
+    preferenceId TEXT PRIMARY KEY,
+    userId TEXT REFERENCES users(userId) ON DELETE CASCADE,
+    room TEXT NOT NULL CHECK (room IN ('kitchen', 'master', 'guest', 'hall')),
+    intent INTEGER NOT NULL DEFAULT 0,
+    intensity INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (userId, room)
+);
+CREATE TABLE IF NOT EXISTS audio_files (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    transcribed_text TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_audio_files_user_created ON audio_files (user_id, created_at);
+CREATE TABLE IF NOT EXISTS audio_files_archive (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    transcribed_text TEXT,
+    created_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_audio_files_archive_user_created ON audio_files_archive (user_id, created_at);
+CREATE TABLE IF NOT EXISTS retention_policies (
+    adminId TEXT PRIMARY KEY REFERENCES admin(adminId) ON DELETE CASCADE,
+    compress_after_days INTEGER,
+    archive_after_days INTEGER,
+    delete_after_days INTEGER,
+    quota_mb INTEGER
+);
+"""
+
+# Timestamps are stored as UTC text in the format log_audio_file writes, so they sort and compare as strings
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def _adapt_datetime(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.strftime(TIMESTAMP_FORMAT)
+
+
+# TIMESTAMP columns are read back as naive UTC datetimes, like MySQL's with time_zone '+00:00'
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.fromisoformat(value.decode()))
+
+_UPSERT = re.compile(r"ON DUPLICATE KEY UPDATE\s+(.*?)\s*$", re.S | re.I)
+_VALUES = re.compile(r"VALUES\((\w+)\)", re.I)
+
+
+@functools.lru_cache(maxsize=256)
+def translate(query):
+    """Rewrites one of the app's MySQL statements for SQLite."""
+    query = query.replace('%s', '?')
+    query = re.sub(r"\s+FOR UPDATE\b", "", query, flags=re.I)
+    # MySQL escapes LIKE wildcards with a backslash by default, SQLite only when told to
+    query = re.sub(r"\bLIKE \?", r"LIKE ? ESCAPE '\\'", query, flags=re.I)
+    match = _UPSERT.search(query)
+    if match:
+        assignments = match.group(1)
+        if re.fullmatch(r"(\w+)\s*=\s*\1", assignments):
+            # MySQL's idiom for "ignore duplicates"
+            replacement = "ON CONFLICT DO NOTHING"
+        else:
+            replacement = "ON CONFLICT DO UPDATE SET " + _VALUES.sub(r"excluded.\1", assignments)
+        query = query[:match.start()] + replacement
+    return query
+
+
+def _mysql_error(error):
+    if isinstance(error, sqlite3.IntegrityError):
+        return mysql.connector.errors.IntegrityError(msg=str(error))
+    if isinstance(error, sqlite3.OperationalError):
+        return mysql.connector.errors.OperationalError(msg=str(error))
+    if isinstance(error, sqlite3.ProgrammingError):
+        return mysql.connector.errors.ProgrammingError(msg=str(error))
+    return mysql.connector.errors.DatabaseError(msg=str(error))
+
+
+class SQLiteCursor:
+    def __init__(self, connection, dictionary):
+        self._cursor = connection.cursor()
+        self._dictionary = dictionary
+
+    def execute(self, query, params=()):
+        try:
+            self._cursor.execute(translate(query), tuple(params))
+        except sqlite3.Error as e:
+            raise _mysql_error(e) from e
+
+    def _row(self, row):
+        if row is None or not self._dictionary:
+            return row
+        return dict(zip((column[0] for column in self._cursor.description), row))
+
+    def fetchone(self):
+        return self._row(self._cursor.fetchone())
+
+    def fetchall(self):
+        return [self._row(row) for row in self._cursor.fetchall()]
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, path, busy_timeout, cached_statements):
+        # Autocommit unless a transaction was started explicitly, like a MySQL connection
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=busy_timeout,
+                                           detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=cached_statements)
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA synchronous = NORMAL")
+
+    def cursor(self, dictionary=False):
+        return SQLiteCursor(self._connection, dictionary)
+
+    @property
+    def in_transaction(self):
+        return self._connection.in_transaction
+
+    def start_transaction(self):
+        # Take the write lock up front; upgrading a read transaction later can deadlock
+        self._connection.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        if self._connection.in_transaction:
+            self._connection.commit()
+
+    def rollback(self):
+        if self._connection.in_transaction:
+            self._connection.rollback()
+
+    def is_connected(self):
+        return True
+
+    def close(self):
+        self._connection.close()
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of MySQL connections shared by every route handler.
+
+    At most `pool_size` connections exist at once; callers wait up to `checkout_timeout`
+    seconds for a free one. Connections idle longer than `health_check_interval` are pinged
+    (and reconnected if stale) before being handed out, and connections older than `recycle`
+    seconds are replaced.
+    """
+
+    def __init__(self, config, pool_size, checkout_timeout, health_check_interval, recycle):
+        self.config = config
+        self.pool_size = pool_size
+        self.checkout_timeout = checkout_timeout
+        self.health_check_interval = health_check_interval
+        self.recycle = recycle
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = []  # (connection, last_used_at), most recently used last
+        self._lock = threading.Lock()
+        self._stats = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'reconnects': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'in_use': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+        self._created_at = {}  # id(connection) -> creation time, used for recycling
+
+    def _connect(self):
+        connection = mysql.connector.connect(**self.config)
+        with self._lock:
+            self._stats['connections_created'] += 1
+            self._created_at[id(connection)] = time.monotonic()
+        return connection
+
+    def _close(self, connection):
+        with self._lock:
+            self._created_at.pop(id(connection), None)
+        try:
+            connection.close()
+        except mysql.connector.Error:
+            pass
+
+    def acquire(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise mysql.connector.errors.PoolError(
+                f"No database connection available within {self.checkout_timeout}s")
+        waited = time.monotonic() - started
+
+        try:
+            connection = self._take_idle()
+            if connection is None:
+                connection = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+        return connection
+
+    def _take_idle(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+                connection, last_used = self._idle.pop()
+
+            now = time.monotonic()
+            with self._lock:
+                created_at = self._created_at.get(id(connection), now)
+            if now - created_at > self.recycle:
+                self._close(connection)
+                continue
+            if now - last_used > self.health_check_interval and not connection.is_connected():
+                try:
+                    connection.reconnect(attempts=1, delay=0)
+                except mysql.connector.Error as err:
+                    print("Discarding stale pooled connection:", err)
+                    self._close(connection)
+                    with self._lock:
+                        self._stats['discarded'] += 1
+                    continue
+                with self._lock:
+                    self._stats['reconnects'] += 1
+            return connection
+
+    def release(self, connection, discard=False):
+        try:
+            if not discard:
+                try:
+                    # Never hand out a connection with an open transaction (and its stale snapshot)
+                    if connection.in_transaction:
+                        connection.rollback()
+                except mysql.connector.Error:
+                    discard = True
+
+            if discard:
+                self._close(connection)
+                with self._lock:
+                    self._stats['discarded'] += 1
+            else:
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+        finally:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['backend'] = 'mysql'
+        stats['pool_size'] = self.pool_size
+        stats['wait_time_avg'] = stats['wait_time_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+
+class SQLitePool:
+    """
+    ConnectionPool counterpart for an embedded SQLite database: at most `pool_size` connections
+    to the file at `path`, callers wait up to `checkout_timeout` seconds for a free one. The schema
+    and its indexes are created when the pool is opened.
+
+    The database runs in WAL mode, so reads never wait on the writer; writers wait up to
+    `checkout_timeout` seconds for each other. Every connection keeps `cached_statements` compiled
+    statements, so the app's fixed queries are prepared once per connection.
+
+    A SQLite connection must never be used on both sides of a fork, so connections are only opened
+    on checkout, and a forked child (see serve.py) starts with an empty pool of its own.
+    """
+
+    def __init__(self, path, pool_size, checkout_timeout, cached_statements):
+        self.path = path
+        self.pool_size = pool_size
+        self.checkout_timeout = checkout_timeout
+        self.cached_statements = cached_statements
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._idle = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'checkouts': 0,
+            'connections_created': 0,
+            'discarded': 0,
+            'timeouts': 0,
+            'in_use': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+        self._inherited = []
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = self._connect()
+        try:
+            connection._connection.executescript(SQLITE_SCHEMA)
+        finally:
+            connection.close()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Closing the parent's connections here could release its locks or checkpoint its WAL, so they are
+        # only set aside (and kept referenced, or garbage collection would close them)
+        self._inherited.extend(self._idle)
+        self._idle = []
+        self._slots = threading.BoundedSemaphore(self.pool_size)
+        self._lock = threading.Lock()
+        self._stats['in_use'] = 0
+
+    def _connect(self):
+        connection = SQLiteConnection(self.path, self.checkout_timeout, self.cached_statements)
+        with self._lock:
+            self._stats['connections_created'] += 1
+        return connection
+
+    def acquire(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise mysql.connector.errors.PoolError(
+                f"No database connection available within {self.checkout_timeout}s")
+        waited = time.monotonic() - started
+
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            try:
+                connection = self._connect()
+            except sqlite3.Error as e:
+                self._slots.release()
+                raise _mysql_error(e) from e
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+        return connection
+
+    def release(self, connection, discard=False):
+        try:
+            if not discard:
+                try:
+                    connection.rollback()
+                except sqlite3.Error:
+                    discard = True
+
+            if discard:
+                connection.close()
+                with self._lock:
+                    self._stats['discarded'] += 1
+            else:
+                with self._lock:
+                    self._idle.append(connection)
+        finally:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['backend'] = 'sqlite'
+        stats['pool_size'] = self.pool_size
+        stats['wait_time_avg'] = stats['wait_time_total'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        return stats
+
+
+def create_pool(mysql_config, pool_config, backend, sqlite_path, sqlite_cached_statements):
+    """Opens the connection pool of the configured backend (see storage_config)."""
+    if backend == 'mysql':
+        return ConnectionPool(mysql_config, **pool_config)
+    if backend == 'sqlite':
+        return SQLitePool(sqlite_path, pool_config['pool_size'], pool_config['checkout_timeout'],
+                          sqlite_cached_statements)
+    raise ValueError(f"DB_BACKEND must be 'mysql' or 'sqlite', got {backend!r}")
@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+from audio import resample
+
+# Streaming transcription configuration (can be overridden through the environment)
+stream_config = {
+    'sample_rate': 16000,
+    # VAD: a frame is speech when its RMS energy exceeds `vad_threshold` times the noise floor
+    'frame_ms': 30,
+    'vad_threshold': float(os.environ.get('STREAM_VAD_THRESHOLD', 3.0)),
+    'vad_min_rms': float(os.environ.get('STREAM_VAD_MIN_RMS', 0.01)),
+    # Trailing silence that ends an utterance
+    'end_silence_ms': int(os.environ.get('STREAM_END_SILENCE_MS', 600)),
+    # Audio kept before the detected speech start so the first syllable isn't clipped
+    'pre_roll_ms': 200,
+    # Re-transcribe the utterance-so-far after this much new audio
+    'partial_interval_ms': int(os.environ.get('STREAM_PARTIAL_INTERVAL_MS', 500)),
+    'max_utterance_seconds': float(os.environ.get('STREAM_MAX_UTTERANCE_SECONDS', 10)),
+    'session_ttl': float(os.environ.get('STREAM_SESSION_TTL', 30)),
+    # Utterances sent over several requests; they need every request to reach the same process
+    'sessions': os.environ.get('STREAM_SESSIONS', '1') == '1',
+}
+
+
+def pcm_to_float32(data, sample_format='s16le'):
+    """Converts raw little-endian PCM bytes (s16le or f32le) to float32 samples in [-1, 1]."""
+    if sample_format == 'f32le':
+        return np.frombuffer(data, dtype='<f4').astype(np.float32)
+    return np.frombuffer(data, dtype='<i2').astype(np.float32) / 32768.0
+
+
+class EnergyVAD:
+    """
+    Frame-energy voice activity detector with an adaptive noise floor.
+
+    Tracks where speech started and flags the end of the utterance once `end_silence_ms` of
+    non-speech frames follow it.
+    """
+
+    def __init__(self, sample_rate, frame_ms, threshold, min_rms, end_silence_ms):
+        self.frame_size = int(sample_rate * frame_ms / 1000)
+        self.threshold = threshold
+        self.min_rms = min_rms
+        self.end_silence_frames = max(1, end_silence_ms // frame_ms)
+        self.noise_floor = None
+        self.frames = 0
+        self.speech_start_frame = None
+        self.silent_frames = 0
+        self.ended = False
+        self._remainder = np.zeros(0, dtype=np.float32)
+
+    @property
+    def speech_started(self):
+        return self.speech_start_frame is not None
+
+    def process(self, samples):
+        samples = np.concatenate((self._remainder, samples))
+        count = len(samples) // self.frame_size
+        self._remainder = samples[count * self.frame_size:]
+        if count == 0:
+            return
+
+        frames = samples[:count * self.frame_size].reshape(count, self.frame_size)
+        energies = np.sqrt(np.mean(frames ** 2, axis=1))
+        for energy in energies:
+            if self.noise_floor is None:
+                # Don't let a stream that starts mid-word set the floor to speech level
+                self.noise_floor = min(energy, self.min_rms / self.threshold)
+            is_speech = energy > max(self.min_rms, self.threshold * self.noise_floor)
+            if is_speech:
+                if self.speech_start_frame is None:
+                    self.speech_start_frame = self.frames
+                self.silent_frames = 0
+            else:
+                # Only non-speech frames update the noise estimate
+                self.noise_floor = 0.95 * self.noise_floor + 0.05 * energy
+                if self.speech_started:
+                    self.silent_frames += 1
+                    if self.silent_frames >= self.end_silence_frames:
+                        self.ended = True
+            self.frames += 1
+
+
+class StreamingSession:
+    """
+    One utterance being streamed in.
+
+    Audio is fed in arbitrary chunks. Once speech is detected, the utterance-so-far is
+    re-transcribed every `partial_interval_ms` of new audio and each hypothesis is parsed; the
+    command fires early as soon as two consecutive hypotheses agree on a room and intent.
+    Otherwise it is decided by a final transcription when the VAD detects the end of the
+    utterance (or the stream ends).
+    """
+
+    def __init__(self, user_id, transcribe, parse, config, sample_rate=16000, sample_format='s16le',
+                 session_id=None):
+        self.session_id = session_id or str(uuid.uuid4())
+        self.user_id = user_id
+        self.transcribe = transcribe
+        self.parse = parse
+        self.config = config
+        self.sample_rate = sample_rate
+        self.sample_format = sample_format
+        self.lock = threading.Lock()
+        self.created_at = time.monotonic()
+        self.updated_at = self.created_at
+        self.vad = EnergyVAD(config['sample_rate'], config['frame_ms'], config['vad_threshold'],
+                             config['vad_min_rms'], config['end_silence_ms'])
+        self._chunks = []
+        self._pending_bytes = b''
+        self.samples = 0
+        self._last_partial_samples = 0
+        self._last_parse = None
+        self.speech_detected_at = None
+        self.hypotheses = []
+        self.command = None
+        self.early = False
+        self.command_latency = None
+        self.done = False
+
+    def audio(self):
+        """The audio received so far at the configured sample rate."""
+        audio = np.concatenate(self._chunks) if self._chunks else np.zeros(0, dtype=np.float32)
+        return resample(audio, self.sample_rate, self.config['sample_rate'])
+
+    def _utterance(self):
+        # Audio from just before the detected speech start to now
+        audio = self.audio()
+        start_frame = self.vad.speech_start_frame or 0
+        start = start_frame * self.vad.frame_size - int(self.config['sample_rate'] * self.config['pre_roll_ms'] / 1000)
+        return audio[max(0, start):]
+
+    def feed(self, data):
+        """Appends a chunk of raw PCM bytes and advances VAD, partial decoding and early intent."""
+        if self.done:
+            return
+        self.updated_at = time.monotonic()
+
+        # Keep any trailing partial sample for the next chunk
+        width = 4 if self.sample_format == 'f32le' else 2
+        data = self._pending_bytes + data
+        usable = len(data) - len(data) % width
+        self._pending_bytes = data[usable:]
+        chunk = pcm_to_float32(data[:usable], self.sample_format)
+        if len(chunk) == 0:
+            return
+
+        # Chunks are kept at the client's rate and resampled as a whole (see audio), since resampling each one
+        # on its own clicks at the chunk edges; the VAD only looks at frame energy, so it can take them one by one
+        self._chunks.append(chunk)
+        samples = resample(chunk, self.sample_rate, self.config['sample_rate'])
+        self.samples += len(samples)
+        self.vad.process(samples)
+        if self.vad.speech_started and self.speech_detected_at is None:
+            self.speech_detected_at = time.monotonic()
+
+        if self.vad.ended or self.samples >= self.config['max_utterance_seconds'] * self.config['sample_rate']:
+            self.finish()
+            return
+
+        interval = self.config['partial_interval_ms'] * self.config['sample_rate'] // 1000
+        if self.vad.speech_started and self.samples - self._last_partial_samples >= interval:
+            self._last_partial_samples = self.samples
+            self._partial()
+
+    def _decode(self):
+        text = self.transcribe({'raw': self._utterance(), 'sampling_rate': self.config['sample_rate']})
+        self.hypotheses.append(text)
+        return text, self.parse(text)
+
+    def _partial(self):
+        text, result = self._decode()
+        key = (result['room'], result['intent'], result['intensity'])
+        if result['room'] and result['intent'] and key == self._last_parse:
+            self.early = True
+            self._decide(result)
+        self._last_parse = key
+
+    def finish(self):
+        """Decides the command from the whole utterance if it hasn't fired early."""
+        if self.done:
+            return
+        if not self.vad.speech_started:
+            self._decide(self.parse(""))
+            return
+        text, result = self._decode()
+        self._decide(result)
+
+    def _decide(self, result):
+        self.command = result
+        self.done = True
+        if self.speech_detected_at is not None:
+            self.command_latency = time.monotonic() - self.speech_detected_at
+
+    def result(self):
+        return {
+            **(self.command or {}),
+            "sessionId": self.session_id,
+            "done": self.done,
+            "early": self.early,
+            "partials": self.hypotheses,
+            "latency": self.command_latency,
+        }
+
+
+class StreamSessions:
+    """Open streaming sessions by id, so one utterance can be sent over several requests."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'sessions': 0,
+            'early_commands': 0,
+            'final_commands': 0,
+            'expired': 0,
+            'latency_total': 0.0,
+        }
+
+    def get(self, session_id):
+        self._expire()
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def add(self, session):
+        self._expire()
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._stats['sessions'] += 1
+
+    def close(self, session):
+        with self._lock:
+            self._sessions.pop(session.session_id, None)
+            if session.done:
+                self._stats['early_commands' if session.early else 'final_commands'] += 1
+                self._stats['latency_total'] += session.command_latency or 0.0
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, session in self._sessions.items() if now - session.updated_at > self.ttl]
+            for key in expired:
+                del self._sessions[key]
+            self._stats['expired'] += len(expired)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open'] = len(self._sessions)
+        commands = stats['early_commands'] + stats['final_commands']
+        stats['latency_avg'] = stats['latency_total'] / commands if commands else 0.0
+        return stats
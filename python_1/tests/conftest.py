@@ -0,0 +1,52 @@
+"""
+The tests run the app in this process, through Flask's test client, on the embedded SQLite
+backend in a temporary directory, so they need neither a database server nor the Whisper model.
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# The app reads its configuration when it is imported, and writes below the working directory
+_workdir = tempfile.mkdtemp(prefix='app-tests-')
+# Registered before the app is imported, so it runs after the app's own exit handlers have written their files
+atexit.register(shutil.rmtree, _workdir, ignore_errors=True)
+os.environ.update({
+    'DB_BACKEND': 'sqlite',
+    'DB_SQLITE_PATH': os.path.join(_workdir, 'tests.sqlite3'),
+    'ASR_WORKERS': '0',
+    'ASR_WARMUP': '0',
+    'AUDIO_PERSIST': '0',
+    'AUTH_SECRET': 'tests',
+    'PASSWORD_SCRYPT_N': '1024',
+    # Written at exit, when the working directory may no longer be the temporary one
+    'LIGHT_STATE_SNAPSHOT': os.path.join(_workdir, 'light_state.json'),
+})
+os.chdir(_workdir)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def App():
+    import App
+    return App
+
+
+@pytest.fixture
+def client(App):
+    return App.app.test_client()
+
+
+@pytest.fixture
+def register(client):
+    """Registers a household and returns (adminId, session token)."""
+    def register(username):
+        response = client.post('/register', json={'name': username, 'username': username, 'password': 'secret',
+                                                  'houseAddress': '1 Test Street', 'preferences': []})
+        assert response.status_code == 201, response.get_json()
+        login = client.post('/login', json={'username': username, 'password': 'secret'}).get_json()
+        return login['adminId'], login['token']
+    return register
@@ -0,0 +1,19 @@
+import json
+import os
+
+import pytest
+
+from command_parser import process_text
+
+CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'corpus')
+
+with open(os.path.join(CORPUS, 'corpus.json')) as manifest:
+    ENTRIES = json.load(manifest)
+
+
+@pytest.mark.parametrize('entry', ENTRIES, ids=[entry['file'] for entry in ENTRIES])
+def test_corpus_labels_match_the_parsed_phrase(entry):
+    # A clip transcribed word for word must count as correct, so accuracy only measures recognition
+    command = process_text(entry['text'])
+    assert (command['room'], command['intent'], command['intensity']) == \
+        (entry['room'], entry['intent'], entry['intensity'])
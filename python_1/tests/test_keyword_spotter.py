@@ -0,0 +1,37 @@
+import numpy as np
+
+from audio import SAMPLE_RATE
+from keyword_spotter import kws_config, KeywordSpotter
+
+
+def chirp(start_hz, end_hz, seconds=1.0):
+    """A stand-in for a spoken command: a frequency sweep with a little noise."""
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    phase = 2 * np.pi * (start_hz * t + (end_hz - start_hz) * t ** 2 / (2 * seconds))
+    noise = np.random.default_rng(int(start_hz)).normal(0, 0.01, len(t))
+    return (0.3 * np.sin(phase) + noise).astype(np.float32)
+
+
+def command(label):
+    room, intent = label.split()
+    return {'room': room, 'intent': intent, 'intensity': None, 'commands': [{}]}
+
+
+def spotter():
+    return KeywordSpotter(**{**kws_config, 'enabled': True, 'template_dir': None})
+
+
+def test_a_single_known_command_is_never_spotted():
+    kws = spotter()
+    kws.learn('user', chirp(300, 900), command("kitchen on"), "kitchen on")
+    # A different command close enough to pass max_distance on its own must still go to Whisper
+    kws.max_distance = np.inf
+    assert kws.spot('user', chirp(350, 1000)) is None
+    assert kws.spot('user', chirp(300, 900)) is None
+
+
+def test_a_clear_match_is_spotted_once_another_command_is_known():
+    kws = spotter()
+    kws.learn('user', chirp(300, 900), command("kitchen on"), "kitchen on")
+    kws.learn('user', chirp(2000, 600), command("hall off"), "hall off")
+    assert kws.spot('user', chirp(300, 900)) == "kitchen on"
@@ -0,0 +1,24 @@
+import numpy as np
+
+from preprocess import preprocess_config, AudioPreprocessor
+
+
+def test_trimming_a_padded_command_halves_its_audio():
+    # A second of speech-level signal with a second of room noise on either side
+    rng = np.random.default_rng(0)
+    speech = rng.normal(0, 0.3, 16000) * np.sin(np.linspace(0, np.pi, 16000))
+    clip = np.concatenate([rng.normal(0, 0.005, 16000), speech, rng.normal(0, 0.005, 16000)]).astype(np.float32)
+
+    kept = AudioPreprocessor(**{**preprocess_config, 'enabled': True, 'trim': True}).process(clip)
+    # The speech plus the padding kept on each side
+    padding = preprocess_config['padding_ms'] / 1000
+    assert 1.0 <= len(kept) / 16000 <= 1.0 + 2 * padding
+    assert len(kept) / len(clip) < 0.55
+
+
+def test_the_fingerprint_follows_the_settings():
+    base = AudioPreprocessor(**{**preprocess_config, 'enabled': True})
+    assert base.fingerprint == AudioPreprocessor(**{**preprocess_config, 'enabled': True}).fingerprint
+    assert base.fingerprint != AudioPreprocessor(**{**preprocess_config, 'enabled': True,
+                                                     'padding_ms': preprocess_config['padding_ms'] + 50}).fingerprint
+    assert AudioPreprocessor(**{**preprocess_config, 'enabled': False}).fingerprint == 'off'
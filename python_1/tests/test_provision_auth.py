@@ -0,0 +1,55 @@
+import json
+import uuid
+
+import pytest
+
+
+@pytest.fixture
+def auth_required(App, monkeypatch):
+    monkeypatch.setitem(App.auth_config, 'required', True)
+    monkeypatch.setitem(App.auth_config, 'operator_key', 'operator-secret')
+
+
+def resident_line(admin_id, name):
+    return json.dumps({'type': 'resident', 'adminId': admin_id, 'name': name})
+
+
+def test_household_token_cannot_provision_into_another_household(App, client, register, auth_required):
+    _, token_a = register(f"a-{uuid.uuid4().hex[:8]}")
+    admin_b, _ = register(f"b-{uuid.uuid4().hex[:8]}")
+
+    response = client.post('/provision', data=resident_line(admin_b, 'Intruder'),
+                           headers={'Authorization': f"Bearer {token_a}"})
+
+    assert response.status_code == 403
+    users = App.execute_query("SELECT name FROM users WHERE adminId = %s", (admin_b,))
+    assert 'Intruder' not in [user['name'] for user in users]
+
+
+def test_provision_without_credentials_is_refused(client, register, auth_required):
+    admin_b, _ = register(f"b-{uuid.uuid4().hex[:8]}")
+
+    response = client.post('/provision', data=resident_line(admin_b, 'Anonymous'))
+
+    assert response.status_code == 401
+
+
+def test_operator_key_provisions_any_household(client, register, auth_required):
+    admin_b, _ = register(f"b-{uuid.uuid4().hex[:8]}")
+
+    response = client.post('/provision', data=resident_line(admin_b, 'Resident'),
+                           headers={'X-Operator-Key': 'operator-secret'})
+
+    assert response.status_code == 200
+    assert response.get_json()['users'] == 1
+
+
+def test_provision_is_disabled_without_an_operator_key(App, client, register, monkeypatch):
+    monkeypatch.setitem(App.auth_config, 'required', True)
+    monkeypatch.setitem(App.auth_config, 'operator_key', None)
+    _, token = register(f"a-{uuid.uuid4().hex[:8]}")
+
+    response = client.post('/provision', data='', headers={'Authorization': f"Bearer {token}",
+                                                           'X-Operator-Key': 'guess'})
+
+    assert response.status_code == 403
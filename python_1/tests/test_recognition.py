@@ -0,0 +1,26 @@
+import uuid
+
+import numpy as np
+
+from keyword_spotter import command_label
+
+
+def test_whisper_templates_keep_the_user_default_intensity(App, register, monkeypatch):
+    admin_id, _ = register(f"r-{uuid.uuid4().hex[:8]}")
+    user_id = App.execute_query("SELECT userId FROM users WHERE adminId = %s", (admin_id,), fetch_one=True)['userId']
+    App.store_preferences(user_id, [{'room': 'kitchen', 'intent': 1, 'intensity': 1}])
+
+    learned = []
+    monkeypatch.setattr(App.asr_scheduler, 'submit', lambda clip: None)
+    monkeypatch.setattr(App.asr_scheduler, 'wait', lambda future, timeout=None: "kitchen on")
+    monkeypatch.setattr(App.keyword_spotter, 'spot', lambda user_id, samples: None)
+    monkeypatch.setattr(App.keyword_spotter, 'learn',
+                        lambda user_id, samples, command, text: learned.append(command_label(command)))
+
+    clip = np.random.default_rng(0).normal(0, 0.1, App.SAMPLE_RATE).astype(np.float32)
+    _, whisper_result = App.recognize_command(user_id, clip)
+
+    # The template holds what was said, so a later spotter hit resolves to the same command as Whisper did
+    assert learned == ["kitchen on"]
+    assert whisper_result['intensity'] == 'high'
+    assert App.resolve_command(user_id, learned[0])['intensity'] == whisper_result['intensity']
@@ -0,0 +1,81 @@
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+import retention
+from retention import RetentionWorker
+
+
+@pytest.fixture
+def household(App, register):
+    """A registered household's (adminId, userId)."""
+    admin_id, _ = register(f"ret-{uuid.uuid4().hex[:8]}")
+    user_id = App.execute_query("SELECT userId FROM users WHERE adminId = %s", (admin_id,), fetch_one=True)['userId']
+    return admin_id, user_id
+
+
+def make_worker(App, tmp_path, archive='jsonl'):
+    return RetentionWorker(App.execute_query, App.transaction, enabled=False, interval=3600, batch_size=10,
+                           batch_pause=0, codec='opus', archive=archive, archive_dir=str(tmp_path / 'archive'),
+                           default_policy=dict(retention.retention_config['default_policy']))
+
+
+def add_recording(App, user_id, created_at, content=b'RIFF'):
+    file_id = uuid.uuid4().hex
+    path = os.path.join('uploads', user_id, f"{file_id}.wav")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as recording:
+        recording.write(content)
+    App.execute_query("INSERT INTO audio_files (id, user_id, file_path, transcribed_text, created_at) "
+                      "VALUES (%s, %s, %s, %s, %s)", (file_id, user_id, path, "kitchen on", created_at))
+    return file_id, path
+
+
+def test_every_step_is_off_by_default():
+    policy = retention.retention_config['default_policy']
+    assert policy['compress_after_days'] == 0
+    assert policy['archive_after_days'] == 0
+
+
+def test_deleting_jsonl_archives_removes_their_recordings(App, household, tmp_path):
+    admin_id, user_id = household
+    worker = make_worker(App, tmp_path)
+    _, path = add_recording(App, user_id, datetime(2020, 1, 15))
+
+    worker.archive_rows(admin_id, [user_id], datetime(2020, 6, 1))
+    assert os.path.exists(path)
+    assert os.listdir(tmp_path / 'archive' / admin_id) == ['2020-01.jsonl.gz']
+
+    worker.delete(admin_id, [user_id], datetime(2020, 6, 1))
+    assert not os.path.exists(path)
+    assert os.listdir(tmp_path / 'archive' / admin_id) == []
+    assert worker.stats()['deleted_rows'] == 1
+
+
+def test_compressed_recordings_keep_their_age_for_the_quota(App, household, tmp_path, monkeypatch):
+    admin_id, user_id = household
+    worker = make_worker(App, tmp_path)
+
+    def transcode(path, codec):
+        target = os.path.splitext(path)[0] + '.opus'
+        shutil.copyfile(path, target)
+        return target
+    monkeypatch.setattr(retention, 'transcode', transcode)
+
+    now = datetime.now()
+    old_id, old_path = add_recording(App, user_id, now - timedelta(days=30), b'x' * 1000)
+    new_id, new_path = add_recording(App, user_id, now - timedelta(days=1), b'x' * 1000)
+    os.utime(old_path, ((now - timedelta(days=30)).timestamp(),) * 2)
+    os.utime(new_path, ((now - timedelta(days=1)).timestamp(),) * 2)
+
+    worker.compress(admin_id, [user_id], now - timedelta(days=7))
+    compressed = App.execute_query("SELECT file_path FROM audio_files WHERE id = %s", (old_id,), fetch_one=True)
+    assert compressed['file_path'].endswith('.opus')
+
+    # Re-encoding the old recording must not make it look like the newest one
+    worker.enforce_quota([user_id], 1500)
+    assert not os.path.exists(compressed['file_path'])
+    assert os.path.exists(new_path)
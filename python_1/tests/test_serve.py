@@ -0,0 +1,18 @@
+import json
+import socket
+import time
+
+from serve import Launcher, WorkerProcess
+
+
+def test_new_workers_are_sent_the_revoked_sessions():
+    launcher = Launcher(None, {}, preloaded=False)
+    for jti, exp in (('current', time.time() + 3600), ('expired', time.time() - 1)):
+        launcher._remember((json.dumps({'kind': 'revoke', 'jti': jti, 'exp': exp}) + '\n').encode())
+
+    parent_end, worker_end = socket.socketpair()
+    with parent_end, worker_end:
+        launcher._catch_up(WorkerProcess(0, 0, parent_end))
+        parent_end.shutdown(socket.SHUT_WR)
+        messages = [json.loads(line) for line in worker_end.makefile('rb')]
+    assert [message['jti'] for message in messages] == ['current']
@@ -0,0 +1,27 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from write_behind import WriteBehindLog
+
+
+def test_rows_of_recordings_saved_during_shutdown_are_written(App, monkeypatch, tmp_path):
+    written = []
+    log = WriteBehindLog('audio_files', written.extend, max_queue=100, batch_size=10, flush_interval=60,
+                         spill_path=str(tmp_path / 'spill.jsonl'))
+    writer = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(App, 'audio_log', log)
+    monkeypatch.setattr(App, 'audio_writer', writer)
+
+    started = threading.Event()
+
+    def save():
+        # A recording that is still being written when the app starts shutting down
+        started.set()
+        time.sleep(0.2)
+        log.append({'id': 'late'})
+
+    writer.submit(save)
+    started.wait()
+    App.shutdown_audio_storage()
+    assert written == [{'id': 'late'}]
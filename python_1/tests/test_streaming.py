@@ -0,0 +1,70 @@
+import uuid
+
+import numpy as np
+import pytest
+
+from asr import ASRUnavailable
+from audio import resample
+from streaming import stream_config, StreamingSession
+
+
+def utterance(rate):
+    """Half a second of room noise followed by a second of loud "speech", as s16le PCM."""
+    rng = np.random.default_rng(0)
+    samples = np.concatenate([rng.normal(0, 0.001, rate // 2), rng.normal(0, 0.3, rate)])
+    return (np.clip(samples, -1, 1) * 32767).astype('<i2')
+
+
+def test_sessions_resample_the_whole_stream():
+    pcm = utterance(8000)
+    # Partial transcriptions are pushed out of reach; only the audio is checked
+    config = {**stream_config, 'partial_interval_ms': 10 ** 6}
+    session = StreamingSession('user', lambda clip: "", lambda text: {}, config, sample_rate=8000)
+    for start in range(0, len(pcm), 1000):
+        session.feed(pcm[start:start + 1000].tobytes())
+
+    expected = resample(pcm.astype(np.float32) / 32768.0, 8000, stream_config['sample_rate'])
+    np.testing.assert_allclose(session.audio(), expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('error, status', [(RuntimeError("decoder crashed"), 500),
+                                           (ASRUnavailable("Speech recognition is unavailable"), 503)])
+def test_failed_transcriptions_close_the_session(App, client, register, monkeypatch, error, status):
+    admin_id, _ = register(f"s-{uuid.uuid4().hex[:8]}")
+    user_id = App.execute_query("SELECT userId FROM users WHERE adminId = %s", (admin_id,), fetch_one=True)['userId']
+
+    def transcribe(clip, timeout=None):
+        raise error
+    monkeypatch.setattr(App.asr_scheduler, 'transcribe', transcribe)
+
+    response = client.post(f'/transcribe-stream/{user_id}?final=0', data=utterance(16000).tobytes())
+    assert response.status_code == status
+    assert response.get_json() == {"error": str(error)}
+    assert App.stream_sessions.stats()['open'] == 0
+
+
+def test_sessions_span_several_requests(App, client, register, monkeypatch):
+    admin_id, _ = register(f"s-{uuid.uuid4().hex[:8]}")
+    user_id = App.execute_query("SELECT userId FROM users WHERE adminId = %s", (admin_id,), fetch_one=True)['userId']
+    monkeypatch.setattr(App.asr_scheduler, 'transcribe', lambda clip, timeout=None: "kitchen on")
+
+    pcm = utterance(16000)
+    first = client.post(f'/transcribe-stream/{user_id}?final=0', data=pcm[:8000].tobytes()).get_json()
+    assert not first['done']
+    last = client.post(f'/transcribe-stream/{user_id}?session={first["sessionId"]}&final=1',
+                       data=pcm[8000:].tobytes()).get_json()
+    assert last['done'] and last['room'] == 'kitchen'
+
+
+def test_sessions_are_refused_when_several_processes_serve(App, client, register, monkeypatch):
+    admin_id, _ = register(f"s-{uuid.uuid4().hex[:8]}")
+    user_id = App.execute_query("SELECT userId FROM users WHERE adminId = %s", (admin_id,), fetch_one=True)['userId']
+    monkeypatch.setattr(App.asr_scheduler, 'transcribe', lambda clip, timeout=None: "kitchen on")
+    # As set by serve.py with more than one worker
+    monkeypatch.setitem(stream_config, 'sessions', False)
+
+    pcm = utterance(16000).tobytes()
+    assert client.post(f'/transcribe-stream/{user_id}?final=0', data=pcm).status_code == 400
+    assert client.post(f'/transcribe-stream/{user_id}?session={uuid.uuid4()}', data=pcm).status_code == 400
+    whole = client.post(f'/transcribe-stream/{user_id}', data=pcm)
+    assert whole.status_code == 200 and whole.get_json()['room'] == 'kitchen'
@@ -0,0 +1,170 @@
+import json
+import os
+import queue
+import threading
+import time
+
+# Write-behind configuration for the audio_files log (can be overridden through the environment)
+audio_log_config = {
+    'max_queue': int(os.environ.get('AUDIO_LOG_QUEUE_SIZE', 10000)),
+    'batch_size': int(os.environ.get('AUDIO_LOG_BATCH_SIZE', 100)),
+    'flush_interval': float(os.environ.get('AUDIO_LOG_FLUSH_INTERVAL', 1.0)),
+    'spill_path': os.environ.get('AUDIO_LOG_SPILL_PATH', os.path.join('uploads', 'audio_files.spill.jsonl')),
+}
+
+
+class WriteBehindLog:
+    """
+    Bounded in-process queue of rows drained by a background writer.
+
+    `append` never blocks on the database: rows are flushed by `write_rows(rows)` in batches of up
+    to `batch_size`, or every `flush_interval` seconds, whichever comes first. When a flush fails
+    (or the queue is full) the rows are appended to a local JSON-lines spill file instead, which is
+    replayed after the next successful flush. Pending rows are flushed on shutdown.
+    """
+
+    def __init__(self, name, write_rows, max_queue, batch_size, flush_interval, spill_path):
+        self.name = name
+        self.write_rows = write_rows
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats = {
+            'appended': 0,
+            'written': 0,
+            'batches': 0,
+            'spilled': 0,
+            'replayed': 0,
+            'flush_errors': 0,
+            'flush_time_total': 0.0,
+        }
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f"{self.name}-writer", daemon=True)
+                self._thread.start()
+
+    def append(self, row):
+        self.start()
+        with self._stats_lock:
+            self._stats['appended'] += 1
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            # Never make the request wait; keep the row on disk until the writer catches up
+            self._spill([row])
+
+    def _next_batch(self):
+        rows = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(rows) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                row = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if row is None:
+                break  # Woken up by shutdown
+            rows.append(row)
+        return rows
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                rows = self._next_batch()
+                if rows and self._flush(rows):
+                    self._replay()
+            except Exception as e:
+                print(f"{self.name}: writer error: {e}")
+
+    def _flush(self, rows):
+        started = time.monotonic()
+        try:
+            self.write_rows(rows)
+        except Exception as e:
+            print(f"{self.name}: writing {len(rows)} rows failed, spilling to {self.spill_path}: {e}")
+            with self._stats_lock:
+                self._stats['flush_errors'] += 1
+            self._spill(rows)
+            return False
+        with self._stats_lock:
+            self._stats['written'] += len(rows)
+            self._stats['batches'] += 1
+            self._stats['flush_time_total'] += time.monotonic() - started
+        return True
+
+    def _spill(self, rows):
+        if not rows:
+            return
+        with self._spill_lock:
+            try:
+                os.makedirs(os.path.dirname(self.spill_path) or '.', exist_ok=True)
+                with open(self.spill_path, 'a') as spill:
+                    for row in rows:
+                        spill.write(json.dumps(row) + "\n")
+            except OSError as e:
+                print(f"{self.name}: could not spill {len(rows)} rows, they are lost: {e}")
+                return
+        with self._stats_lock:
+            self._stats['spilled'] += len(rows)
+
+    def _replay(self):
+        # Move the spill file aside so new spills don't interleave with the replay
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            replay_path = f"{self.spill_path}.replay"
+            os.replace(self.spill_path, replay_path)
+
+        with open(replay_path) as spill:
+            rows = [json.loads(line) for line in spill if line.strip()]
+        os.remove(replay_path)
+
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            if not self._flush(batch):
+                # _flush spilled the failed batch; keep the remainder for the next attempt too
+                self._spill(rows[start + self.batch_size:])
+                return
+            with self._stats_lock:
+                self._stats['replayed'] += len(batch)
+
+    def flush(self):
+        """Writes everything queued so far on the calling thread."""
+        rows = []
+        while True:
+            try:
+                row = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if row is not None:
+                rows.append(row)
+        for start in range(0, len(rows), self.batch_size):
+            self._flush(rows[start:start + self.batch_size])
+
+    def shutdown(self, timeout=10):
+        self._stopping.set()
+        if self._thread is not None:
+            # The writer may be waiting up to `flush_interval` for a batch to fill; wake it to write what it has
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass
+            self._thread.join(timeout)
+        self.flush()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['spill_pending'] = os.path.exists(self.spill_path)
+        return stats